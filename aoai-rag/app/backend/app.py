@@ -1,15 +1,19 @@
-import io
+import asyncio
 import json
 import logging
 import mimetypes
 import os
+import tempfile
 import time
-from typing import AsyncGenerator
+from typing import Any, AsyncGenerator, Awaitable, Callable, Optional
 
 import aiohttp
+import numpy as np
 from openai import APIError, AsyncAzureOpenAI, AsyncOpenAI
 
+from azure.core.exceptions import ResourceNotFoundError
 from azure.cosmos import CosmosClient, PartitionKey
+from azure.cosmos.aio import CosmosClient as AsyncCosmosClient
 from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
 from azure.monitor.opentelemetry import configure_azure_monitor
 from azure.search.documents.aio import SearchClient
@@ -19,20 +23,51 @@ from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
 from quart import (
     Blueprint,
     Quart,
+    Response,
     abort,
     current_app,
     jsonify,
     make_response,
     request,
-    send_file,
     send_from_directory,
 )
 
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
-from approaches.readpluginsretrieve import ReadPluginsRetrieve
+from approaches.readpluginsretrieve import DEFAULT_PLUGIN_URLS, ReadPluginsRetrieve
 from approaches.readretrieveread import ReadRetrieveReadApproach
 from approaches.retrievethenread import RetrieveThenReadApproach
 from approaches.chatreadretrieveread_cosmosdb import ChatReadRetrieveReadApproachCosmosDB
+from approaches.coalescing import CoalescingAskApproach, CoalescingChatApproach
+from core.answercache import AnswerCache, answer_cache_scope
+from core.blobcache import (
+    BlobCache,
+    BlobStreamBody,
+    CachedFileBody,
+    CachingBlobBody,
+    make_conditional,
+)
+from core.chatlog import ChatLogWriter, CosmosChatLogSink, SqliteChatLogSink
+from core.clientpool import AioHttpConnectionPool, HttpxConnectionPool
+from core.contextpacker import ContextPacker
+from core.embeddingbatcher import EmbeddingBatcher
+from core.embeddingcache import EmbeddingCache
+from core.metrics import RetryCountingPolicy, count_openai_retries, metrics
+from core.modelhelper import (
+    num_tokens_from_messages_batch,
+    num_tokens_from_texts,
+    token_count_cache,
+)
+from core.pluginregistry import PluginRegistry
+from core.searchcache import SearchCache
+from core.sessionstore import (
+    CosmosSessionBackend,
+    InMemorySessionBackend,
+    SessionStore,
+    UnknownSessionError,
+)
+from core.singleflight import SingleFlight
+from core.streaming import format_as_lean_ndjson
+from httptools import AsyncHttpClient
 
 # Replace these with your own values, either in environment variables or directly here
 AZURE_STORAGE_ACCOUNT = os.getenv("AZURE_STORAGE_ACCOUNT", "mystorageaccount")
@@ -49,13 +84,108 @@ KB_FIELDS_CONTENT = os.getenv("KB_FIELDS_CONTENT", "content")
 KB_FIELDS_CATEGORY = os.getenv("KB_FIELDS_CATEGORY", "category")
 KB_FIELDS_SOURCEPAGE = os.getenv("KB_FIELDS_SOURCEPAGE", "sourcepage")
 
+# 채팅 접근법에서 쿼리 생성과 동시에 원래 질문으로 검색을 먼저 수행할지 여부 (요청의 overrides.speculative_retrieval로 덮어쓸 수 있다)
+USE_SPECULATIVE_RETRIEVAL = os.getenv("USE_SPECULATIVE_RETRIEVAL", "false").lower() == "true"
+
+# 비슷한 질문에 대한 응답을 재사용하는 시맨틱 응답 캐시 설정
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "false").lower() == "true"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.97"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+
+# 모든 접근법이 공유하는 쿼리 임베딩 캐시 설정. EMBEDDING_CACHE_PATH를 지정하면 워커가 재시작돼도 캐시가 유지된다.
+EMBEDDING_CACHE_MAX_MB = int(os.getenv("EMBEDDING_CACHE_MAX_MB", "64"))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH")
+# 동시에 들어온 요청의 쿼리 임베딩을 한 번의 API 호출로 계산한다. 보내는 중인 호출이 없으면 바로 보내고, 그동안 들어온 쿼리는
+# 앞의 호출이 끝나거나 최대 EMBEDDING_BATCH_WINDOW_MS가 지나면 모아서 보낸다. 0이면 모으지 않는다.
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5"))
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "16"))
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "8000"))
+
+# 검색 결과 캐시 설정. prepdocs.py가 인덱스를 갱신하면 블롭 컨테이너의 INDEX_VERSION_BLOB 블롭 메타데이터의 index_version이 바뀌고,
+# 늦어도 SEARCH_CACHE_VERSION_CHECK_INTERVAL초 안에 검색 결과 캐시와 응답 캐시가 비워진다.
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "300"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "1000"))
+SEARCH_CACHE_VERSION_CHECK_INTERVAL = float(os.getenv("SEARCH_CACHE_VERSION_CHECK_INTERVAL", "30"))
+INDEX_VERSION_BLOB = "_index_version"
+INDEX_VERSION_METADATA_KEY = "index_version"
+
+# /content로 제공하는 블롭(인용된 페이지 PDF)의 디스크 캐시 설정. CONTENT_CACHE_MAX_MB를 0으로 지정하면 캐시하지 않고 블롭에서 바로 스트리밍한다.
+CONTENT_CACHE_PATH = os.getenv("CONTENT_CACHE_PATH") or os.path.join(tempfile.gettempdir(), "aoai-rag-content")
+CONTENT_CACHE_MAX_MB = int(os.getenv("CONTENT_CACHE_MAX_MB", "256"))
+CONTENT_CACHE_MAX_FILE_MB = int(os.getenv("CONTENT_CACHE_MAX_FILE_MB", "16"))
+CONTENT_CACHE_TTL = float(os.getenv("CONTENT_CACHE_TTL", "3600"))
+
+# /chat_stream의 기본 응답 형식. "lean"이면 응답 텍스트 조각만 보낸다(overrides의 stream_format으로 요청마다 지정할 수 있다).
+# lean 형식에서 STREAM_COALESCE_MS, STREAM_COALESCE_BYTES를 지정하면 그 시간/바이트 범위 안의 조각을 하나의 이벤트로 합친다.
+STREAM_FORMAT = os.getenv("STREAM_FORMAT", "openai")
+STREAM_COALESCE_MS = float(os.getenv("STREAM_COALESCE_MS", "0"))
+STREAM_COALESCE_BYTES = int(os.getenv("STREAM_COALESCE_BYTES", "0"))
+
+# 업스트림(OpenAI, AI Search, Blob Storage)별 연결 풀 크기와 keep-alive 시간.
+# 워커가 시작될 때 POOL_WARMUP_CONNECTIONS개의 연결을 미리 열어서 첫 요청이 DNS/TLS 연결 비용을 치르지 않도록 한다.
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", "100"))
+SEARCH_POOL_SIZE = int(os.getenv("SEARCH_POOL_SIZE", "50"))
+BLOB_POOL_SIZE = int(os.getenv("BLOB_POOL_SIZE", "50"))
+POOL_KEEPALIVE_SECONDS = float(os.getenv("POOL_KEEPALIVE_SECONDS", "120"))
+POOL_WARMUP_CONNECTIONS = int(os.getenv("POOL_WARMUP_CONNECTIONS", "2"))
+POOL_WARMUP_TIMEOUT = float(os.getenv("POOL_WARMUP_TIMEOUT", "10"))
+
+# /ask의 rpr 접근법이 사용하는 플러그인 매니페스트 URL(쉼표로 구분). 워커가 시작될 때 한 번에 가져오고 PLUGIN_CACHE_TTL마다 재검증한다.
+PLUGIN_URLS = os.getenv("PLUGIN_URLS", ",".join(DEFAULT_PLUGIN_URLS)).split(",")
+PLUGIN_CACHE_TTL = float(os.getenv("PLUGIN_CACHE_TTL", "300"))
+PLUGIN_FETCH_TIMEOUT = float(os.getenv("PLUGIN_FETCH_TIMEOUT", "5"))
+# 에이전트가 플러그인 API를 호출할 때의 연결 풀 크기와 호출당 제한 시간
+PLUGIN_POOL_SIZE = int(os.getenv("PLUGIN_POOL_SIZE", "20"))
+PLUGIN_REQUEST_TIMEOUT = float(os.getenv("PLUGIN_REQUEST_TIMEOUT", "10"))
+
+# 대화 기록(ChatReadRetrieveReadApproachCosmosDB)의 write-behind 큐 설정. CHAT_LOG_SQLITE_PATH를 지정하면 Cosmos DB 대신 로컬 SQLite 파일에 기록한다.
+CHAT_LOG_SQLITE_PATH = os.getenv("CHAT_LOG_SQLITE_PATH")
+CHAT_LOG_MAX_QUEUE = int(os.getenv("CHAT_LOG_MAX_QUEUE", "10000"))
+CHAT_LOG_BATCH_SIZE = int(os.getenv("CHAT_LOG_BATCH_SIZE", "100"))
+CHAT_LOG_FLUSH_SECONDS = float(os.getenv("CHAT_LOG_FLUSH_SECONDS", "1"))
+
+# 같은 질문(정규화한 질문, overrides, 직전 SINGLEFLIGHT_HISTORY_TURNS개의 대화)이 동시에 들어오면 한 번만 실행해서 응답을 함께 사용한다.
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "true").lower() == "true"
+SINGLEFLIGHT_HISTORY_TURNS = int(os.getenv("SINGLEFLIGHT_HISTORY_TURNS", "2"))
+
+# /chat, /chat_stream의 세션 모드. 요청에 history와 함께 session_id를 보내면 서버가 대화를 저장해 두고 다음 턴에 토큰 수를 재사용한다.
+# CHAT_SESSION_COSMOS_ENDPOINT를 설정하면 모든 워커가 Cosmos DB 컨테이너(파티션 키 /id, TTL 사용)의 세션을 공유하므로, 클라이언트는 첫 턴 이후에 history 없이 session_id와 message만 보낸다.
+# 설정하지 않으면 워커마다 최대 CHAT_SESSION_MAX_SESSIONS개의 세션을 메모리에 보관하고, 클라이언트는 항상 history를 함께 보내야 한다.
+# 세션은 마지막 턴 이후 CHAT_SESSION_TTL초 동안, 세션마다 최근 CHAT_SESSION_MAX_TURNS개의 턴만 보관한다.
+CHAT_SESSION_COSMOS_ENDPOINT = os.getenv("CHAT_SESSION_COSMOS_ENDPOINT")
+CHAT_SESSION_COSMOS_DATABASE = os.getenv("CHAT_SESSION_COSMOS_DATABASE", "ChatGPT")
+CHAT_SESSION_COSMOS_CONTAINER = os.getenv("CHAT_SESSION_COSMOS_CONTAINER", "ChatSessions")
+CHAT_SESSION_MAX_SESSIONS = int(os.getenv("CHAT_SESSION_MAX_SESSIONS", "10000"))
+CHAT_SESSION_TTL = float(os.getenv("CHAT_SESSION_TTL", "3600"))
+CHAT_SESSION_MAX_TURNS = int(os.getenv("CHAT_SESSION_MAX_TURNS", "50"))
+
+# 프롬프트에 넣는 검색 결과(출처)의 최대 토큰 수와, 접근법이 나머지 프롬프트의 토큰 수를 넘기지 않을 때 시스템 프롬프트, 질문, 대화 이력을 위해 남겨 둘 토큰 수
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "4000"))
+CONTEXT_RESERVE_TOKENS = int(os.getenv("CONTEXT_RESERVE_TOKENS", "2048"))
+
+# 워커 안에서 공유하는 메시지별 토큰 수 캐시의 최대 항목 수
+TOKEN_COUNT_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_COUNT_CACHE_MAX_ENTRIES", "10000"))
+
 CONFIG_OPENAI_TOKEN = "openai_token"
 CONFIG_CREDENTIAL = "azure_credential"
 CONFIG_ASK_APPROACHES = "ask_approaches"
 CONFIG_CHAT_APPROACHES = "chat_approaches"
 CONFIG_BLOB_CLIENT = "blob_client"
+CONFIG_BLOB_CONTAINER_CLIENT = "blob_container_client"
+CONFIG_BLOB_CACHE = "blob_cache"
 CONFIG_SEARCH_CLIENT = "search_client"
 CONFIG_OPENAI_CLIENT = "openai_client"
+CONFIG_ANSWER_CACHE = "answer_cache"
+CONFIG_EMBEDDING_CACHE = "embedding_cache"
+CONFIG_SEARCH_CACHE = "search_cache"
+CONFIG_CONNECTION_POOLS = "connection_pools"
+CONFIG_SINGLEFLIGHT = "singleflight"
+CONFIG_PLUGIN_REGISTRY = "plugin_registry"
+CONFIG_CHAT_LOG = "chat_log"
+CONFIG_SESSION_STORE = "session_store"
+CONFIG_SESSION_COSMOS_CLIENT = "session_cosmos_client"
+CONFIG_CONTEXT_PACKER = "context_packer"
 APPLICATIONINSIGHTS_CONNECTION_STRING = os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING")
 
 bp = Blueprint("routes", __name__, static_folder='static')
@@ -78,22 +208,46 @@ async def assets(path):
 
 # 독립적인 환경에서 예제를 실행하기 위해 애플리케이션 내부의 블롭 스토리지에 콘텐츠 파일을 배포한다.
 # *** NOTE *** 이 예제는 콘텐츠 파일이 공개된 것이거나, 적어도 모든 사용자가 모든 파일에 접근할 수 있다고 가정한다.
-# 이 예제는 속도가 느리고 메모리도 부족하다.
+# 블롭은 메모리에 모으지 않고 청크 단위로 스트리밍하며, 최근에 인용된 파일은 디스크 캐시에서 제공한다.
+# Range 요청(PDF 뷰어)과 ETag/Last-Modified 조건부 요청(304)을 지원한다.
 @bp.route("/content/<path>")
 async def content_file(path):
-    logging.info("content_file: " + path)
-    blob_container = current_app.config[CONFIG_BLOB_CLIENT].get_container_client(AZURE_STORAGE_CONTAINER)
-    logging.info("blob_container: " + blob_container.get_blob_client(path).url)
-    blob = await blob_container.get_blob_client(path).download_blob()
-    if not blob.properties or not blob.properties.has_key("content_settings"):
-        abort(404)
-    mime_type = blob.properties["content_settings"]["content_type"]
-    if mime_type == "application/octet-stream":
-        mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    blob_file = io.BytesIO()
-    await blob.readinto(blob_file)
-    blob_file.seek(0)
-    return await send_file(blob_file, mimetype=mime_type, as_attachment=False, attachment_filename=path)
+    blob_client = current_app.config[CONFIG_BLOB_CONTAINER_CLIENT].get_blob_client(path)
+    blob_cache = current_app.config[CONFIG_BLOB_CACHE]
+    cached = blob_cache.get(path) if blob_cache else None
+    properties = None
+    if not cached or not blob_cache.is_fresh(cached):
+        try:
+            properties = await blob_client.get_blob_properties()
+        except ResourceNotFoundError:
+            abort(404)
+        if cached:
+            # TTL이 지난 캐시는 ETag가 같으면 블롭을 다시 읽지 않고 계속 사용한다.
+            cached = blob_cache.revalidate(path) if properties.etag.strip('"') == cached.etag else None
+
+    if cached:
+        etag, last_modified, mime_type, size = cached.etag, cached.last_modified, cached.content_type, cached.size
+        body = CachedFileBody(cached.file_path)
+    else:
+        etag, last_modified, size = properties.etag.strip('"'), properties.last_modified, properties.size
+        mime_type = properties.content_settings.content_type
+        if not mime_type or mime_type == "application/octet-stream":
+            mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if blob_cache and blob_cache.accepts(size) and not request.if_none_match.contains(etag):
+            if request.range is None:
+                # 블롭을 응답으로 보내면서 같은 청크를 캐시 파일에도 쓴다.
+                body = CachingBlobBody(blob_cache, path, blob_client, etag, last_modified, mime_type, size)
+            else:
+                body = BlobStreamBody(blob_client, size)
+                blob_cache.put_in_background(path, blob_client, etag, last_modified, mime_type, size)
+        else:
+            body = BlobStreamBody(blob_client, size)
+
+    response = Response(body, mimetype=mime_type)
+    response.content_length = size
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return await make_conditional(response, request, size)
 
 @bp.route("/ask", methods=["POST"])
 async def ask():
@@ -105,7 +259,16 @@ async def ask():
         impl = current_app.config[CONFIG_ASK_APPROACHES].get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
-        r = await impl.run(request_json["question"], request_json.get("overrides") or {})
+        overrides = request_json.get("overrides") or {}
+        answer_cache = current_app.config[CONFIG_ANSWER_CACHE]
+        if answer_cache:
+            scope = answer_cache_scope("ask", approach, overrides)
+            query_vector = await current_app.config[CONFIG_EMBEDDING_CACHE].embed(request_json["question"])
+            if cached := answer_cache.lookup(scope, query_vector):
+                return jsonify(cached)
+        r = await impl.run(request_json["question"], overrides)
+        if answer_cache:
+            answer_cache.store(scope, query_vector, r)
         return jsonify(r)
     except Exception as e:
         logging.exception("Exception in /ask")
@@ -121,17 +284,92 @@ async def chat():
         impl = current_app.config[CONFIG_CHAT_APPROACHES].get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
-        r = await impl.run_without_streaming(request_json["history"], request_json.get("overrides", {}))
+        session_id = request_json.get("session_id")
+        history = await read_chat_history(request_json)
+        overrides = request_json.get("overrides", {})
+        if session_id:
+            # 대화 기록은 세션마다 다른 파티션 키로 쓴다(ChatReadRetrieveReadApproachCosmosDB).
+            overrides = {**overrides, "session_id": session_id}
+        answer_cache = current_app.config[CONFIG_ANSWER_CACHE]
+        if answer_cache:
+            scope = answer_cache_scope("chat", approach, overrides, history[:-1])
+            query_vector = await current_app.config[CONFIG_EMBEDDING_CACHE].embed(history[-1]["user"])
+            if cached := answer_cache.lookup(scope, query_vector):
+                if session_id:
+                    await current_app.config[CONFIG_SESSION_STORE].append(session_id, history[-1]["user"], cached["answer"] or "")
+                return jsonify(cached)
+        r = await impl.run_without_streaming(history, overrides)
+        if answer_cache:
+            answer_cache.store(scope, query_vector, r)
+        if session_id:
+            await current_app.config[CONFIG_SESSION_STORE].append(session_id, history[-1]["user"], r["answer"] or "")
         return jsonify(r)
+    except UnknownSessionError as e:
+        # 클라이언트는 전체 대화를 history에 담아 다시 보내야 한다.
+        return jsonify({"error": str(e), "code": e.code}), 409
     except Exception as e:
         logging.exception("Exception in /chat")
         return jsonify({"error": str(e)}), 500
 
+async def read_chat_history(request_json: dict[str, Any]) -> list[dict[str, Any]]:
+    # 세션 모드에서는 서버에 저장된 턴(토큰 수 포함)이 보낸 대화와 일치할 때 그 턴을 사용한다.
+    session_id = request_json.get("session_id")
+    if not session_id:
+        return request_json["history"]
+    # history 없이 보낸 요청은 공유 세션 백엔드에 저장된 턴으로 대화를 이어간다.
+    return await current_app.config[CONFIG_SESSION_STORE].history(session_id, request_json.get("history"), request_json.get("message"))
 
 async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str, None]:
     async for event in r:
         yield json.dumps(event, ensure_ascii=False) + "\n"
 
+def answer_chunk(delta: dict[str, Any], context: Optional[dict[str, Any]] = None) -> dict[str, Any]:
+    choice = {"delta": delta, "finish_reason": None, "index": 0}
+    if context is not None:
+        choice["context"] = context
+    return {"choices": [choice], "object": "chat.completion.chunk"}
+
+async def replay_cached_answer(cached: dict[str, Any], lean: bool = False, chunk_size: int = 32) -> AsyncGenerator[dict, None]:
+    # 캐시된 응답을 스트리밍 응답과 같은 형식의 청크로 나눠서 돌려준다.
+    context = {key: value for key, value in cached.items() if key != "answer"}
+    answer = cached["answer"] or ""
+    if lean:
+        yield context
+        for i in range(0, len(answer), chunk_size):
+            yield {"delta": answer[i:i + chunk_size]}
+        yield {"done": True, "finish_reason": "stop"}
+        return
+    yield answer_chunk({"role": "assistant"}, context)
+    for i in range(0, len(answer), chunk_size):
+        yield answer_chunk({"content": answer[i:i + chunk_size]})
+
+async def on_streamed_answer(r: AsyncGenerator[dict, None], callback: Callable[[dict[str, Any]], Awaitable[None]]) -> AsyncGenerator[dict, None]:
+    # 스트리밍이 끝까지 완료된 경우에만 모은 응답으로 callback을 호출한다.
+    context: dict[str, Any] = {}
+    answer = []
+    async for event in r:
+        if "delta" in event:
+            answer.append(event["delta"])
+        elif "data_points" in event:
+            context = event
+        elif event.get("choices"):
+            choice = event["choices"][0]
+            if "context" in choice:
+                context = choice["context"]
+            answer.append(choice["delta"].get("content") or "")
+        yield event
+    await callback({**context, "answer": "".join(answer)})
+
+def store_streamed_answer(r: AsyncGenerator[dict, None], answer_cache: AnswerCache, scope: str, query_vector: np.ndarray) -> AsyncGenerator[dict, None]:
+    async def store(result: dict[str, Any]) -> None:
+        answer_cache.store(scope, query_vector, result)
+    return on_streamed_answer(r, store)
+
+def save_streamed_turn(r: AsyncGenerator[dict, None], session_store: SessionStore, session_id: str, question: str) -> AsyncGenerator[dict, None]:
+    async def save(result: dict[str, Any]) -> None:
+        await session_store.append(session_id, question, result["answer"])
+    return on_streamed_answer(r, save)
+
 @bp.route("/chat_stream", methods=["POST"])
 async def chat_stream():
     if not request.is_json:
@@ -142,14 +380,66 @@ async def chat_stream():
         impl = current_app.config[CONFIG_CHAT_APPROACHES].get(approach)
         if not impl:
             return jsonify({"error": "unknown approach"}), 400
-        response_generator = impl.run_with_streaming(request_json["history"], request_json.get("overrides", {}))
-        response = await make_response(format_as_ndjson(response_generator))
+        session_id = request_json.get("session_id")
+        history = await read_chat_history(request_json)
+        overrides = request_json.get("overrides", {})
+        if session_id:
+            # 대화 기록은 세션마다 다른 파티션 키로 쓴다(ChatReadRetrieveReadApproachCosmosDB).
+            overrides = {**overrides, "session_id": session_id}
+        lean = (overrides.get("stream_format") or STREAM_FORMAT) == "lean"
+        run_with_streaming = impl.run_with_lean_streaming if lean else impl.run_with_streaming
+        answer_cache = current_app.config[CONFIG_ANSWER_CACHE]
+        if answer_cache:
+            scope = answer_cache_scope("chat", approach, overrides, history[:-1])
+            query_vector = await current_app.config[CONFIG_EMBEDDING_CACHE].embed(history[-1]["user"])
+            if cached := answer_cache.lookup(scope, query_vector):
+                response_generator = replay_cached_answer(cached, lean)
+            else:
+                response_generator = store_streamed_answer(run_with_streaming(history, overrides), answer_cache, scope, query_vector)
+        else:
+            response_generator = run_with_streaming(history, overrides)
+        if session_id:
+            response_generator = save_streamed_turn(response_generator, current_app.config[CONFIG_SESSION_STORE], session_id, history[-1]["user"])
+        if lean:
+            response = await make_response(format_as_lean_ndjson(response_generator, STREAM_COALESCE_MS, STREAM_COALESCE_BYTES))
+        else:
+            response = await make_response(format_as_ndjson(response_generator))
         response.timeout = None # type: ignore
         return response
+    except UnknownSessionError as e:
+        # 클라이언트는 전체 대화를 history에 담아 다시 보내야 한다.
+        return jsonify({"error": str(e), "code": e.code}), 409
     except Exception as e:
         logging.exception("Exception in /chat")
         return jsonify({"error": str(e)}), 500
 
+@bp.route("/cache_stats", methods=["GET"])
+async def cache_stats():
+    answer_cache = current_app.config[CONFIG_ANSWER_CACHE]
+    return jsonify({
+        "answer_cache": answer_cache.stats() if answer_cache else None,
+        "embedding_cache": current_app.config[CONFIG_EMBEDDING_CACHE].stats(),
+        "embedding_batcher": current_app.config[CONFIG_EMBEDDING_CACHE].batcher.stats() if current_app.config[CONFIG_EMBEDDING_CACHE].batcher else None,
+        "search_cache": current_app.config[CONFIG_SEARCH_CACHE].stats(),
+        "content_cache": current_app.config[CONFIG_BLOB_CACHE].stats() if current_app.config[CONFIG_BLOB_CACHE] else None,
+        "token_count_cache": token_count_cache.stats(),
+        "singleflight": current_app.config[CONFIG_SINGLEFLIGHT].stats() if current_app.config[CONFIG_SINGLEFLIGHT] else None,
+        "plugin_registry": current_app.config[CONFIG_PLUGIN_REGISTRY].stats(),
+        "chat_log": current_app.config[CONFIG_CHAT_LOG].stats() if current_app.config[CONFIG_CHAT_LOG] else None,
+        "chat_sessions": current_app.config[CONFIG_SESSION_STORE].stats(),
+        "context_packer": current_app.config[CONFIG_CONTEXT_PACKER].stats(),
+    })
+
+@bp.route("/metrics", methods=["GET"])
+async def prometheus_metrics():
+    # 이 요청을 처리한 워커의 단계별 지연 시간, 프롬프트 토큰 수, 업스트림 재시도 횟수를 Prometheus 텍스트 형식으로 반환한다.
+    # 워커마다 값이 따로 쌓이므로 워커를 디버깅할 때만 사용하고, 전체 값은 OpenTelemetry로 내보낸 Azure Monitor 지표를 본다.
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@bp.route("/pool_stats", methods=["GET"])
+async def pool_stats():
+    return jsonify({pool.name: pool.stats() for pool in current_app.config[CONFIG_CONNECTION_POOLS]})
+
 # @bp.before_request
 # async def ensure_openai_token():
 #     openai_token = current_app.config[CONFIG_OPENAI_TOKEN]
@@ -170,33 +460,61 @@ async def setup_clients():
     # 키가 필요한 경우에는 각 서비스의 키를 보유한 AzureKeyCredential 인스턴스를 사용한다.
     # DefaultAzureCredential 작업중에 블로킹 에러가 발생할 시, 매개 변수를 사용하면 문제 있는 크리덴셜을 제외할 수 있다(ex.exclude_shared_token_cache_credential=True)
     azure_credential = DefaultAzureCredential(exclude_shared_token_cache_credential = True)
+
+    # 업스트림마다 크기와 keep-alive를 지정한 연결 풀을 만들고, 모든 클라이언트가 이 풀을 사용하도록 한다.
+    AZURE_SEARCH_ENDPOINT = f"https://{AZURE_SEARCH_SERVICE}.search.windows.net"
+    AZURE_STORAGE_ENDPOINT = f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net"
+    AZURE_OPENAI_API_ENDPOINT = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
+    openai_pool = HttpxConnectionPool("openai", AZURE_OPENAI_API_ENDPOINT, OPENAI_POOL_SIZE, POOL_KEEPALIVE_SECONDS)
+    search_pool = AioHttpConnectionPool("search", AZURE_SEARCH_ENDPOINT, SEARCH_POOL_SIZE, POOL_KEEPALIVE_SECONDS)
+    blob_pool = AioHttpConnectionPool("blob", AZURE_STORAGE_ENDPOINT, BLOB_POOL_SIZE, POOL_KEEPALIVE_SECONDS)
+    plugin_pool = AioHttpConnectionPool("plugins", PLUGIN_URLS[0], PLUGIN_POOL_SIZE, POOL_KEEPALIVE_SECONDS)
+    connection_pools = [openai_pool, search_pool, blob_pool, plugin_pool]
+
     # Set up clients for AI Search and Storage
     search_client = SearchClient(
-        endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net",
+        endpoint=AZURE_SEARCH_ENDPOINT,
         index_name=AZURE_SEARCH_INDEX,
-        credential=azure_credential)
+        credential=azure_credential,
+        transport=search_pool.transport,
+        per_retry_policies=[RetryCountingPolicy("search")])
     blob_client = BlobServiceClient(
-        account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
-        credential=azure_credential)
+        account_url=AZURE_STORAGE_ENDPOINT,
+        credential=azure_credential,
+        transport=blob_pool.transport,
+        per_retry_policies=[RetryCountingPolicy("blob")])
 
     # Set up a Cosmos DB client to store the chat history
     # endpoint = 'https://<Your-CosmosDB-Account>.documents.azure.com:443/'
     # key = '<Your-CosmosDB-Key>'
-    # cosmos_container = []
+    cosmos_container = None
     # try:
     #     cosmos_client = CosmosClient(url=endpoint, credential=key)
     #     database = cosmos_client.create_database_if_not_exists(id="ChatGPT")
-    #     partitionKeyPath = PartitionKey(path="/id")
+    #     # 같은 대화의 기록을 하나의 트랜잭션 배치로 쓸 수 있도록 chat_session_id를 파티션 키로 사용한다.
+    #     partitionKeyPath = PartitionKey(path="/chat_session_id")
     #     cosmos_container = database.create_container_if_not_exists(
     #         id="ChatLogs", partition_key=partitionKeyPath
     #     )
     # except Exception as e:
     #     logging.exception(e)
     #     pass
+    # 대화 기록의 저장소는 여기서만 정한다. 쓰기 큐는 close_clients에서 남은 기록을 모두 쓴 뒤 닫는다.
+    if CHAT_LOG_SQLITE_PATH:
+        chat_log_sink = SqliteChatLogSink(CHAT_LOG_SQLITE_PATH)
+    elif cosmos_container is not None:
+        chat_log_sink = CosmosChatLogSink(cosmos_container)
+    else:
+        chat_log_sink = None
+    chat_log = ChatLogWriter(
+        chat_log_sink,
+        max_queue=CHAT_LOG_MAX_QUEUE,
+        batch_size=CHAT_LOG_BATCH_SIZE,
+        flush_interval=CHAT_LOG_FLUSH_SECONDS
+    ) if chat_log_sink else None
 
     # Used by the OpenAI SDK
     AZURE_OPENAI_API_VERSION = "2024-02-01"
-    AZURE_OPENAI_API_ENDPOINT = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
     token_provider = get_bearer_token_provider(azure_credential, "https://cognitiveservices.azure.com/.default")
 
     # Store on app.config for later use inside requests
@@ -204,13 +522,90 @@ async def setup_clients():
         api_version=AZURE_OPENAI_API_VERSION,
         azure_endpoint = AZURE_OPENAI_API_ENDPOINT,
         azure_ad_token_provider = token_provider,
+        http_client = openai_pool.http_client,
     )
+    # 업스트림별 재시도 횟수를 /metrics에 기록한다.
+    count_openai_retries(openai_client, "openai")
+    token_count_cache.max_entries = TOKEN_COUNT_CACHE_MAX_ENTRIES
+    embedding_batcher = EmbeddingBatcher(
+        openai_client,
+        AZURE_OPENAI_EMB_DEPLOYMENT,
+        window_ms=EMBEDDING_BATCH_WINDOW_MS,
+        max_batch_size=EMBEDDING_BATCH_MAX_SIZE,
+        max_batch_tokens=EMBEDDING_BATCH_MAX_TOKENS
+    ) if EMBEDDING_BATCH_WINDOW_MS > 0 else None
+    embedding_cache = EmbeddingCache(
+        openai_client,
+        AZURE_OPENAI_EMB_DEPLOYMENT,
+        max_bytes=EMBEDDING_CACHE_MAX_MB * 1024 * 1024,
+        disk_path=EMBEDDING_CACHE_PATH,
+        batcher=embedding_batcher
+    )
+    # 컨테이너 클라이언트는 요청마다 만들지 않고 한 번만 만들어서 재사용한다.
+    blob_container_client = blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
+    async def read_index_version() -> Optional[str]:
+        try:
+            properties = await blob_container_client.get_blob_client(INDEX_VERSION_BLOB).get_blob_properties()
+        except ResourceNotFoundError:
+            return None
+        return properties.metadata.get(INDEX_VERSION_METADATA_KEY)
+    answer_cache = AnswerCache(
+        threshold=ANSWER_CACHE_THRESHOLD,
+        ttl=ANSWER_CACHE_TTL,
+        max_entries=ANSWER_CACHE_MAX_ENTRIES
+    ) if ANSWER_CACHE_ENABLED else None
+    # 인덱스가 바뀌면 이전 검색 결과로 만든 응답도 함께 버린다.
+    search_cache = SearchCache(
+        search_client,
+        KB_FIELDS_SOURCEPAGE,
+        KB_FIELDS_CONTENT,
+        ttl=SEARCH_CACHE_TTL,
+        max_entries=SEARCH_CACHE_MAX_ENTRIES,
+        index_version=read_index_version,
+        version_check_interval=SEARCH_CACHE_VERSION_CHECK_INTERVAL,
+        on_invalidate=answer_cache.clear if answer_cache else None
+    )
+    search_cache.start()
     # Store on app.config for later use inside requests
     current_app.config[CONFIG_OPENAI_TOKEN] = ""#openai_token
     current_app.config[CONFIG_CREDENTIAL] = azure_credential
     current_app.config[CONFIG_BLOB_CLIENT] = blob_client
+    current_app.config[CONFIG_BLOB_CONTAINER_CLIENT] = blob_container_client
+    current_app.config[CONFIG_BLOB_CACHE] = BlobCache(
+        CONTENT_CACHE_PATH,
+        max_bytes=CONTENT_CACHE_MAX_MB * 1024 * 1024,
+        max_file_bytes=CONTENT_CACHE_MAX_FILE_MB * 1024 * 1024,
+        ttl=CONTENT_CACHE_TTL
+    ) if CONTENT_CACHE_MAX_MB > 0 else None
     current_app.config[CONFIG_OPENAI_CLIENT] = openai_client
     current_app.config[CONFIG_SEARCH_CLIENT] = search_client
+    current_app.config[CONFIG_EMBEDDING_CACHE] = embedding_cache
+    current_app.config[CONFIG_SEARCH_CACHE] = search_cache
+    current_app.config[CONFIG_CONNECTION_POOLS] = connection_pools
+    current_app.config[CONFIG_CHAT_LOG] = chat_log
+    # 세션을 공유할 Cosmos DB 컨테이너가 있으면 모든 워커가 같은 세션을 사용한다.
+    if CHAT_SESSION_COSMOS_ENDPOINT:
+        session_cosmos_client = AsyncCosmosClient(CHAT_SESSION_COSMOS_ENDPOINT, credential=azure_credential)
+        session_container = session_cosmos_client.get_database_client(CHAT_SESSION_COSMOS_DATABASE).get_container_client(CHAT_SESSION_COSMOS_CONTAINER)
+        session_backend = CosmosSessionBackend(session_container, ttl=CHAT_SESSION_TTL)
+    else:
+        session_cosmos_client = None
+        session_backend = InMemorySessionBackend(max_sessions=CHAT_SESSION_MAX_SESSIONS, ttl=CHAT_SESSION_TTL)
+    current_app.config[CONFIG_SESSION_COSMOS_CLIENT] = session_cosmos_client
+    current_app.config[CONFIG_SESSION_STORE] = SessionStore(
+        session_backend,
+        lambda messages: num_tokens_from_messages_batch(messages, AZURE_OPENAI_CHATGPT_MODEL, token_count_cache),
+        max_turns=CHAT_SESSION_MAX_TURNS
+    )
+    current_app.config[CONFIG_ANSWER_CACHE] = answer_cache
+    context_packer = ContextPacker(
+        lambda texts: num_tokens_from_texts(texts, AZURE_OPENAI_CHATGPT_MODEL),
+        max_tokens=CONTEXT_MAX_TOKENS,
+        reserve_tokens=CONTEXT_RESERVE_TOKENS
+    )
+    current_app.config[CONFIG_CONTEXT_PACKER] = context_packer
+    plugin_registry = PluginRegistry(PLUGIN_URLS, ttl=PLUGIN_CACHE_TTL, timeout=PLUGIN_FETCH_TIMEOUT)
+    current_app.config[CONFIG_PLUGIN_REGISTRY] = plugin_registry
     # GPT와 외부 지식을 결합할 수 있는 여러 방법이 있다. 대부분의 애플리케이션은 이 패턴들 중 하나 또는 여기서 파생된 접근법을 사용한다.
     # 이 예제에서 ReadDecomposeAsk 기능은 ChatGPT의 플러그인 기능으로 대체됐다.
     current_app.config[CONFIG_ASK_APPROACHES] = {
@@ -221,7 +616,10 @@ async def setup_clients():
             AZURE_OPENAI_CHATGPT_MODEL,
             AZURE_OPENAI_EMB_DEPLOYMENT,
             KB_FIELDS_SOURCEPAGE,
-            KB_FIELDS_CONTENT
+            KB_FIELDS_CONTENT,
+            embedding_cache=embedding_cache,
+            search_cache=search_cache,
+            context_packer=context_packer
         ),
         "rrr": ReadRetrieveReadApproach(
             search_client,
@@ -232,13 +630,18 @@ async def setup_clients():
             AZURE_OPENAI_CHATGPT_DEPLOYMENT,
             AZURE_OPENAI_EMB_DEPLOYMENT,
             KB_FIELDS_SOURCEPAGE,
-            KB_FIELDS_CONTENT
+            KB_FIELDS_CONTENT,
+            embedding_cache=embedding_cache,
+            search_cache=search_cache,
+            context_packer=context_packer
         ),
         "rpr": ReadPluginsRetrieve(
             AZURE_OPENAI_CHATGPT_DEPLOYMENT,
             AZURE_OPENAI_API_VERSION,
             AZURE_OPENAI_API_ENDPOINT,
-            token_provider
+            token_provider,
+            plugin_registry=plugin_registry,
+            http_client=AsyncHttpClient(plugin_pool.session, timeout=PLUGIN_REQUEST_TIMEOUT)
         )
     }
     current_app.config[CONFIG_CHAT_APPROACHES] = {
@@ -250,23 +653,62 @@ async def setup_clients():
             AZURE_OPENAI_EMB_DEPLOYMENT,
             KB_FIELDS_SOURCEPAGE,
             KB_FIELDS_CONTENT,
+            speculative_retrieval=USE_SPECULATIVE_RETRIEVAL,
+            embedding_cache=embedding_cache,
+            search_cache=search_cache,
+            context_packer=context_packer,
         )
         # "rrr": ChatReadRetrieveReadApproachCosmosDB (
         #     search_client,
         #     openai_client,
-        #     cosmos_container,
+        #     chat_log,
         #     AZURE_OPENAI_CHATGPT_DEPLOYMENT,
         #     AZURE_OPENAI_CHATGPT_MODEL,
         #     AZURE_OPENAI_EMB_DEPLOYMENT,
         #     KB_FIELDS_SOURCEPAGE,
         #     KB_FIELDS_CONTENT,
+        #     embedding_cache=embedding_cache,
+        #     search_cache=search_cache,
+        #     context_packer=context_packer,
         # )
     }
+    singleflight = SingleFlight() if SINGLEFLIGHT_ENABLED else None
+    current_app.config[CONFIG_SINGLEFLIGHT] = singleflight
+    if singleflight:
+        current_app.config[CONFIG_ASK_APPROACHES] = {
+            name: CoalescingAskApproach(impl, name, singleflight) for name, impl in current_app.config[CONFIG_ASK_APPROACHES].items()
+        }
+        current_app.config[CONFIG_CHAT_APPROACHES] = {
+            name: CoalescingChatApproach(impl, name, singleflight, SINGLEFLIGHT_HISTORY_TURNS) for name, impl in current_app.config[CONFIG_CHAT_APPROACHES].items()
+        }
+
+    # 응답하지 않는 플러그인은 로그만 남기고 나중에 다시 가져온다.
+    await plugin_registry.prefetch()
+    if POOL_WARMUP_CONNECTIONS > 0:
+        await warm_up_connections(connection_pools)
+
+async def warm_up_connections(connection_pools: list) -> None:
+    # 워커가 요청을 받기 전에 업스트림 연결을 미리 열어 둔다. 실패해도 서비스 시작은 막지 않는다.
+    try:
+        await asyncio.wait_for(asyncio.gather(*(pool.warm_up(POOL_WARMUP_CONNECTIONS) for pool in connection_pools)), POOL_WARMUP_TIMEOUT)
+    except asyncio.TimeoutError:
+        logging.warning("Connection warm-up timed out after %s seconds", POOL_WARMUP_TIMEOUT)
 
 @bp.after_app_serving
 async def close_clients():
     await current_app.config[CONFIG_SEARCH_CLIENT].close()
+    await current_app.config[CONFIG_BLOB_CLIENT].close()
     await current_app.config[CONFIG_OPENAI_CLIENT].close()
+    for pool in current_app.config[CONFIG_CONNECTION_POOLS]:
+        await pool.close()
+    await current_app.config[CONFIG_PLUGIN_REGISTRY].close()
+    # 큐에 남은 대화 기록을 모두 쓴 뒤에 종료한다.
+    if current_app.config[CONFIG_CHAT_LOG]:
+        await current_app.config[CONFIG_CHAT_LOG].close()
+    await current_app.config[CONFIG_EMBEDDING_CACHE].close()
+    await current_app.config[CONFIG_SEARCH_CACHE].close()
+    if current_app.config[CONFIG_SESSION_COSMOS_CLIENT]:
+        await current_app.config[CONFIG_SESSION_COSMOS_CLIENT].close()
     await current_app.config[CONFIG_CREDENTIAL].close()
 
 def create_app():
@@ -1,5 +1,9 @@
+import asyncio
 import logging
-from typing import Any, AsyncGenerator, Coroutine
+import re
+import time
+from functools import cached_property
+from typing import Any, AsyncGenerator, Coroutine, Optional
 
 from openai import AsyncOpenAI, AsyncStream
 from openai.types.chat import (
@@ -8,15 +12,23 @@ from openai.types.chat import (
 )
 
 from azure.search.documents.aio import SearchClient
-from azure.search.documents.models import (
-    QueryType,
-    VectorizedQuery
-)
 
-from core.messagebuilder import MessageBuilder
-from core.modelhelper import get_token_limit
+from core.contextpacker import ContextPacker
+from core.embeddingcache import EmbeddingCache
+from core.messagebuilder import MessageBuilder, trim_history
+from core.metrics import metrics
+from core.modelhelper import count_static_tokens, get_token_limit, num_tokens_from_texts
+from core.searchcache import SearchCache
 from text import nonewlines
 
+def normalize_query(query: str) -> str:
+    return re.sub(r"\s+", " ", query).strip().casefold()
+
+def discard_task_result(task: asyncio.Task) -> None:
+    # 취소되거나 사용되지 않은 추측 검색의 예외가 "Task exception was never retrieved" 경고로 남지 않도록 한다.
+    if not task.cancelled():
+        task.exception()
+
 class ChatReadRetrieveReadApproach:
     """
     Azure AI Search(구 Azure Cognitive Search)와 OpenAI의 Python SDK를 사용한 retrieve-then-read 구현 예시다.
@@ -28,6 +40,13 @@ class ChatReadRetrieveReadApproach:
     USER = "user"
     ASSISTANT = "assistant"
 
+    # /metrics에서 이 접근법의 단계별 지표를 구분하는 이름
+    metrics_label = "chat_rrr"
+
+    # 응답 생성에 사용할 토큰 수. 프롬프트의 토큰 예산은 모델의 토큰 한도에서 이 값을 뺀 만큼이다.
+    query_response_tokens = 100
+    answer_response_tokens = 1024
+
     # System prompt
     system_message_chat_conversation = """
 너는 한국의 무신정권 역사에 관한 문제를 답변해주는 역사 교수야.
@@ -76,24 +95,89 @@ A:한산도 대첩은 1592년에 일어난 임진왜란 중에 조선 수군이
         {'role' : ASSISTANT, 'content' : '이순신 인물 공적' }
     ]
 
-    def __init__(self, search_client: SearchClient, openai_client: AsyncOpenAI, chatgpt_deployment: str, chatgpt_model: str, embedding_deployment: str, sourcepage_field: str, content_field: str):
+    def __init__(self, search_client: SearchClient, openai_client: AsyncOpenAI, chatgpt_deployment: str, chatgpt_model: str, embedding_deployment: str, sourcepage_field: str, content_field: str, speculative_retrieval: bool = False, embedding_cache: Optional[EmbeddingCache] = None, search_cache: Optional[SearchCache] = None, context_packer: Optional[ContextPacker] = None):
         self.search_client = search_client
         self.openai_client = openai_client
         self.chatgpt_deployment = chatgpt_deployment
         self.chatgpt_model = chatgpt_model
         self.embedding_deployment = embedding_deployment
+        self.embedding_cache = embedding_cache or EmbeddingCache(openai_client, embedding_deployment)
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.search_cache = search_cache or SearchCache(search_client, sourcepage_field, content_field)
         self.chatgpt_token_limit = get_token_limit(chatgpt_model)
+        self.speculative_retrieval = speculative_retrieval
+        self.context_packer = context_packer or ContextPacker(lambda texts: num_tokens_from_texts(texts, chatgpt_model))
 
-    async def run_until_final_call(self, history: list[dict[str, str]], overrides: dict[str, Any], should_stream: bool = False) -> tuple[dict[str, Any], Coroutine[Any, Any, AsyncStream[ChatCompletionChunk]]]:
+    @cached_property
+    def static_token_counts(self) -> dict[tuple[str, str], int]:
+        # 고정된 시스템 프롬프트와 few-shot의 토큰 수는 처음 사용할 때 한 번만 계산하고 이후 요청에서 재사용한다.
+        return count_static_tokens([
+            {'role': self.SYSTEM, 'content': self.query_prompt_template},
+            {'role': self.SYSTEM, 'content': self.system_message_chat_conversation.format(injected_prompt="", follow_up_questions_prompt="")},
+            {'role': self.SYSTEM, 'content': self.system_message_chat_conversation.format(injected_prompt="", follow_up_questions_prompt=self.follow_up_questions_prompt_content)},
+            *self.query_prompt_few_shots
+        ], self.chatgpt_model)
+
+    async def retrieve(self, query_text: str, overrides: dict[str, Any], prompt_tokens: Optional[int] = None) -> list[str]:
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
         use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
         top = overrides.get("top") or 3
         exclude_category = overrides.get("exclude_category") or None
         filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
-        
+
+        # 검색 모드에 벡터가 포함되어 있으면 쿼리를 임베딩한다.
+        if has_vector:
+            with metrics.stage(self.metrics_label, "embedding"):
+                query_vector = (await self.embedding_cache.embed(query_text)).tolist()
+        else:
+            query_vector = None
+
+        # 검색 모드로 텍스트를 사용하면 텍스트 쿼리만 남기고 나머지는 삭제한다.
+        if not has_text:
+            query_text = None
+
+        # 검색 모드로 텍스트나 하이브리드(벡터 + 텍스트)를 사용하면 요청에 따라 의미 체계 검색을 사용한다.
+        with metrics.stage(self.metrics_label, "search"):
+            hits = await self.search_cache.search(query_text,
+                                                  query_vector,
+                                                  filter,
+                                                  top,
+                                                  use_semantic_ranker=overrides.get("semantic_ranker") and has_text,
+                                                  use_semantic_captions=use_semantic_captions)
+        # 겹치는 이웃 청크를 합치고, 응답과 시스템 프롬프트, 대화 이력에 쓸 토큰을 남긴 예산 안에서만 출처를 넣는다.
+        hits = self.context_packer.pack(hits, self.chatgpt_token_limit - self.answer_response_tokens, use_captions=use_semantic_captions, prompt_tokens=prompt_tokens)
+        if use_semantic_captions:
+            results =[" SOURCE:" + hit.sourcepage + ": " + nonewlines(" . ".join(hit.captions)) for hit in hits]
+        else:
+            results =[" SOURCE:" + hit.sourcepage + ": " + nonewlines(hit.content) for hit in hits]
+        return results
+
+    async def run_until_final_call(self, history: list[dict[str, str]], overrides: dict[str, Any], should_stream: bool = False) -> tuple[dict[str, Any], Coroutine[Any, Any, AsyncStream[ChatCompletionChunk]]]:
+        has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
+
+        follow_up_questions_prompt = self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else ""
+        # 프롬프트 템플릿 덮어쓰기
+        # 클라이언트가 프롬프트 전체를 변경하거나, 접두사 '>>>'를 사용해서 기존 프롬프트에 주입할 수 있도록 한다.
+        prompt_override = overrides.get("prompt_template")
+        if prompt_override is None:
+            system_message = self.system_message_chat_conversation.format(injected_prompt="", follow_up_questions_prompt=follow_up_questions_prompt)
+        elif prompt_override.startswith(">>>"):
+            system_message = self.system_message_chat_conversation.format(injected_prompt=prompt_override[3:] + "\n", follow_up_questions_prompt=follow_up_questions_prompt)
+        else:
+            system_message = prompt_override.format(follow_up_questions_prompt=follow_up_questions_prompt)
+
+        # 출처의 토큰 예산은 출처를 뺀 응답 프롬프트(시스템 프롬프트, 대화 이력, 질문)를 실제로 센 토큰 수를 빼고 정한다.
+        prompt_tokens = self.count_prompt_tokens(system_message, history, self.chatgpt_token_limit - self.answer_response_tokens)
+
+        # 추측 검색 모드에서는 STEP 1의 쿼리 생성과 동시에 사용자의 원래 질문으로 임베딩과 검색을 먼저 수행한다.
+        speculative_retrieval = overrides.get("speculative_retrieval", self.speculative_retrieval)
+        speculative_task = None
+        if speculative_retrieval:
+            speculative_task = asyncio.create_task(self.retrieve(history[-1]["user"], overrides, prompt_tokens))
+            speculative_task.add_done_callback(discard_task_result)
+
         # ===================================================================================
         # STEP 1: 최근 질문 및 채팅 이력을 기반으로 GPT에 최적화된 키워드 검색 쿼리를 생성한다.
         # ===================================================================================
@@ -104,16 +188,23 @@ A:한산도 대첩은 1592년에 일어난 임진왜란 중에 조선 수군이
             history,
             user_q,
             self.query_prompt_few_shots,
-            self.chatgpt_token_limit - len(user_q)
+            self.chatgpt_token_limit - self.query_response_tokens,
+            stage="query_rewrite"
             )
-        
+
         # ChatCompletion API로 검색 쿼리를 생성한다.
-        chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
-            messages=messages,
-            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-            temperature=0.0,
-            max_tokens=100,
-            n=1)
+        try:
+            with metrics.stage(self.metrics_label, "query_rewrite"):
+                chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
+                    messages=messages,
+                    model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+                    temperature=0.0,
+                    max_tokens=self.query_response_tokens,
+                    n=1)
+        except BaseException:
+            if speculative_task:
+                speculative_task.cancel()
+            raise
 
         query_text = chat_completion.choices[0].message.content
         if query_text.strip() == "0":
@@ -122,56 +213,28 @@ A:한산도 대첩은 1592년에 일어난 임진왜란 중에 조선 수군이
         # ================================================================================
         # STEP 2: GPT로 생성한 쿼리를 사용해서 검색 인덱스로부터 관련 문서를 취득한다.
         # ================================================================================
-        # 검색 모드에 벡터가 포함되어 있으면 쿼리를 임베딩한다.
-        if has_vector:
-            embedding = await self.openai_client.embeddings.create(
-                model=self.embedding_deployment,
-                input=query_text
-            )
-            query_vector = embedding.data[0].embedding
+        # 생성된 쿼리가 원래 질문과 같으면 추측 검색 결과를 그대로 사용하고, 다르면 추측 검색을 취소하고 다시 검색한다.
+        if speculative_task and normalize_query(query_text) == normalize_query(history[-1]["user"]):
+            retrieval_path = "speculative"
+            results = await speculative_task
         else:
-            query_vector = None
+            if speculative_task:
+                retrieval_path = "speculative_cancelled"
+                speculative_task.cancel()
+            else:
+                retrieval_path = "sequential"
+            results = await self.retrieve(query_text, overrides, prompt_tokens)
+        logging.info("retrieval_path: " + retrieval_path)
 
         # 검색 모드로 텍스트를 사용하면 텍스트 쿼리만 남기고 나머지는 삭제한다.
         if not has_text:
             query_text = None
-
-        # 검색 모드로 텍스트나 하이브리드(벡터 + 텍스트)를 사용하면 요청에 따라 의미 체계 검색을 사용한다.
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(search_text=query_text,
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC,
-                                          semantic_configuration_name="default",
-                                          top=top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                                          vector_queries=[VectorizedQuery(vector=query_vector, k_nearest_neighbors=top, fields="embedding")] if query_vector else None)
-        else:
-            r = await self.search_client.search(search_text=query_text,
-                                          filter=filter,
-                                          top=top,
-                                          vector_queries=[VectorizedQuery(vector=query_vector, k_nearest_neighbors=top, fields="embedding")] if query_vector else None)
-        
-        if use_semantic_captions:
-            results =[" SOURCE:" + doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) async for doc in r]
-        else:
-            results =[" SOURCE:" + doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) async for doc in r]
         content = "\n".join(results) # 검색 결과
 
         # =============================================================================
         # STEP 3: 검색 결과와 채팅 이력을 사용해서 문맥이나 내용에 맞는 응답을 생성한다.
         # =============================================================================
         
-        follow_up_questions_prompt = self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else ""
-        # 프롬프트 템플릿 덮어쓰기
-        # 클라이언트가 프롬프트 전체를 변경하거나, 접두사 '>>>'를 사용해서 기존 프롬프트에 주입할 수 있도록 한다.
-        prompt_override = overrides.get("prompt_template")
-        if prompt_override is None:
-            system_message = self.system_message_chat_conversation.format(injected_prompt="", follow_up_questions_prompt=follow_up_questions_prompt)
-        elif prompt_override.startswith(">>>"):
-            system_message = self.system_message_chat_conversation.format(injected_prompt=prompt_override[3:] + "\n", follow_up_questions_prompt=follow_up_questions_prompt)
-        else:
-            system_message = prompt_override.format(follow_up_questions_prompt=follow_up_questions_prompt)
-
         print(system_message) # 합성된 시스템 프롬프트 확인
         
         messages = self.get_messages_from_history(
@@ -179,30 +242,36 @@ A:한산도 대첩은 1592년에 일어난 임진왜란 중에 조선 수군이
             self.chatgpt_model,
             history,
             history[-1]["user"]+ "\n\n " + content, # 모델은 시스템 메시지가 너무 길어지면 프롬프트를 제대로 처리하지 못한다. 후속 질문 프롬프트의 처리를 위해 사용자의 최근 대화로 소스를 이동한다.
-            max_tokens=self.chatgpt_token_limit)
+            max_tokens=self.chatgpt_token_limit - self.answer_response_tokens)
         msg_to_display = '\n\n'.join([str(message) for message in messages])
 
-        extra_info = {"data_points": results, "thoughts": f"Searched for:<br>{query_text}<br><br>Conversations:<br>" + msg_to_display.replace('\n', '<br>')}
-        
+        extra_info = {"data_points": results, "retrieval_path": retrieval_path, "thoughts": f"Searched for:<br>{query_text}<br><br>Conversations:<br>" + msg_to_display.replace('\n', '<br>')}
+
         # ChatCompletion 방식으로 응답을 생성한다.
         chat_coroutine = self.openai_client.chat.completions.create(
             model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
             messages=messages,
             temperature=overrides.get("temperature") or 0.0,
-            max_tokens=1024,
+            max_tokens=self.answer_response_tokens,
             n=1,
             stream=should_stream
         )
         return (extra_info, chat_coroutine)
 
     async def run_without_streaming(self, history: list[dict[str, str]], overrides: dict[str, Any]) -> dict[str, Any]:
+        start = time.perf_counter()
         extra_info, chat_coroutine = await self.run_until_final_call(history, overrides, should_stream=False)
-        chat_content = (await chat_coroutine).choices[0].message.content
+        with metrics.stage(self.metrics_label, "answer"):
+            chat_content = (await chat_coroutine).choices[0].message.content
         extra_info["answer"] = chat_content
+        metrics.observe_stage(self.metrics_label, "total", time.perf_counter() - start)
         return extra_info
 
     async def run_with_streaming(self, history: list[dict[str, str]], overrides: dict[str, Any]) -> AsyncGenerator[dict, None]:
+        start = time.perf_counter()
         extra_info, chat_coroutine = await self.run_until_final_call(history, overrides, should_stream=True)
+        answer_start = time.perf_counter()
+        first_token = True
         yield {
             "choices": [
                 {
@@ -220,27 +289,61 @@ A:한산도 대첩은 1592년에 일어난 임진왜란 중에 조선 수군이
             if event["choices"]:
                 content = event["choices"][0]["delta"].get("content")
                 content = content or ""  # content may either not exist in delta, or explicitly be None
+                if content and first_token:
+                    metrics.observe_stage(self.metrics_label, "first_token", time.perf_counter() - start)
+                    first_token = False
                 yield event
+        metrics.observe_stage(self.metrics_label, "answer", time.perf_counter() - answer_start)
+        metrics.observe_stage(self.metrics_label, "total", time.perf_counter() - start)
+
+    async def run_with_lean_streaming(self, history: list[dict[str, str]], overrides: dict[str, Any]) -> AsyncGenerator[dict, None]:
+        # 프론트엔드가 읽는 값만 보낸다. 청크를 dict로 변환(model_dump)하지 않고 delta의 content만 꺼낸다.
+        start = time.perf_counter()
+        extra_info, chat_coroutine = await self.run_until_final_call(history, overrides, should_stream=True)
+        answer_start = time.perf_counter()
+        first_token = True
+        yield extra_info
+        finish_reason = None
+        async for event_chunk in await chat_coroutine:
+            if event_chunk.choices:
+                choice = event_chunk.choices[0]
+                if choice.delta is not None and choice.delta.content:
+                    if first_token:
+                        metrics.observe_stage(self.metrics_label, "first_token", time.perf_counter() - start)
+                        first_token = False
+                    yield {"delta": choice.delta.content}
+                finish_reason = choice.finish_reason or finish_reason
+        metrics.observe_stage(self.metrics_label, "answer", time.perf_counter() - answer_start)
+        metrics.observe_stage(self.metrics_label, "total", time.perf_counter() - start)
+        yield {"done": True, "finish_reason": finish_reason}
 
-    def get_messages_from_history(self, system_prompt: str, model_id: str, history: list[dict[str, str]], user_conv: str, few_shots = [], max_tokens: int = 4096) -> list:
-        message_builder = MessageBuilder(system_prompt, model_id)
+    def count_prompt_tokens(self, system_prompt: str, history: list[dict[str, str]], max_tokens: int) -> int:
+        """
+        Token count of the answer prompt without the sources: the system prompt, the chat history kept by get_messages_from_history and the question.
+        The history is trimmed to what is left after the context packer's source reserve, so a long chat doesn't leave no room for the sources.
+        """
+        message_builder = MessageBuilder(system_prompt, self.chatgpt_model, self.static_token_counts)
+        user_token_count = message_builder.count_tokens({'role': self.USER, 'content': history[-1]["user"] + "\n\n "})
+        history_budget = max_tokens - self.context_packer.source_reserve(max_tokens) - message_builder.token_length - user_token_count
+        _, history_token_count = trim_history(history[:-1], self.chatgpt_model, history_budget)
+        return message_builder.token_length + user_token_count + history_token_count
 
-        # 채팅으로 어떤 응답을 원하는지 예시를 추가한다. 채팅은 시스템 메시지의 규칙과 일치하는지 확인하며 어떤 응답이든 모방을 시도한다.
-        for shot in few_shots:
-            message_builder.append_message(shot.get('role'), shot.get('content'))
+    def get_messages_from_history(self, system_prompt: str, model_id: str, history: list[dict[str, str]], user_conv: str, few_shots = [], max_tokens: int = 4096, stage: str = "answer") -> list:
+        start = time.perf_counter()
+        message_builder = MessageBuilder(system_prompt, model_id, self.static_token_counts)
 
-        user_content = user_conv
-        append_index = len(few_shots) + 1
+        # 채팅으로 어떤 응답을 원하는지 예시를 추가한다. 채팅은 시스템 메시지의 규칙과 일치하는지 확인하며 어떤 응답이든 모방을 시도한다.
+        message_builder.append_messages(few_shots)
 
-        message_builder.append_message(self.USER, user_content, index=append_index)
+        user_message = {'role': self.USER, 'content': user_conv}
+        user_token_count = message_builder.count_tokens(user_message)
 
-        for h in reversed(history[:-1]):
-            if bot_msg := h.get("bot"):
-                message_builder.append_message(self.ASSISTANT, bot_msg, index=append_index)
-            if user_msg := h.get("user"):
-                message_builder.append_message(self.USER, user_msg, index=append_index)
-            if message_builder.token_length > max_tokens:
-                break
+        # 시스템 프롬프트, 예시, 마지막 질문을 제외한 토큰 예산 안에 들어가는 최근 대화 이력만 턴 단위로 포함한다.
+        history_messages, history_token_count = trim_history(history[:-1], model_id, max_tokens - message_builder.token_length - user_token_count)
+        message_builder.append_messages(history_messages, history_token_count)
+        message_builder.append_messages([user_message], user_token_count)
 
         messages = message_builder.messages
+        metrics.observe_stage(self.metrics_label, "prompt_build", time.perf_counter() - start)
+        metrics.observe_prompt_tokens(self.metrics_label, stage, message_builder.token_length)
         return messages
@@ -1,7 +1,10 @@
+import hashlib
 import logging
+import time
 import uuid
 from datetime import datetime
-from typing import Any, AsyncGenerator, Coroutine
+from functools import cached_property
+from typing import Any, AsyncGenerator, Coroutine, Optional
 
 from openai import AsyncOpenAI, AsyncStream
 from openai.types.chat import (
@@ -9,13 +12,14 @@ from openai.types.chat import (
     ChatCompletionChunk,
 )
 from azure.search.documents.aio import SearchClient
-from azure.search.documents.models import (
-    QueryType,
-    VectorizedQuery
-)
 
-from core.messagebuilder import MessageBuilder
-from core.modelhelper import get_token_limit
+from core.chatlog import ChatLogWriter
+from core.contextpacker import ContextPacker
+from core.embeddingcache import EmbeddingCache
+from core.messagebuilder import MessageBuilder, trim_history
+from core.metrics import metrics
+from core.modelhelper import count_static_tokens, get_token_limit, num_tokens_from_texts
+from core.searchcache import SearchCache
 from text import nonewlines
 
 
@@ -25,11 +29,18 @@ class ChatReadRetrieveReadApproachCosmosDB:
     이 예시는 우선 GPT로 검색 쿼리를 생성하여 검색 엔진에서 문서를 추출한다. 그리고 추출된 결과를 활용해 프롬프트를 구성하여 GPT로 보완된 응답을 생성한다.
     """
 
+    # /metrics에서 이 접근법의 단계별 지표를 구분하는 이름
+    metrics_label = "chat_rrr_cosmosdb"
+
     # Chat roles
     SYSTEM = "system"
     USER = "user"
     ASSISTANT = "assistant"
 
+    # 응답 생성에 사용할 토큰 수. 프롬프트의 토큰 예산은 모델의 토큰 한도에서 이 값을 뺀 만큼이다.
+    query_response_tokens = 100
+    answer_response_tokens = 1024
+
     # System prompt
     system_message_chat_conversation = """
 너는 한국의 무신정권 역사에 관한 문제를 답변해주는 역사 교수야.
@@ -78,19 +89,32 @@ A:한산도 대첩은 1592년에 일어난 임진왜란 중에 조선 수군이
         {'role' : ASSISTANT, 'content' : '이순신 인물 공적' }
     ]
 
-    def __init__(self, search_client: SearchClient, openai_client: AsyncOpenAI, cosmos_container, chatgpt_deployment: str, chatgpt_model: str, embedding_deployment: str, sourcepage_field: str, content_field: str):
+    def __init__(self, search_client: SearchClient, openai_client: AsyncOpenAI, chat_log: Optional[ChatLogWriter], chatgpt_deployment: str, chatgpt_model: str, embedding_deployment: str, sourcepage_field: str, content_field: str, embedding_cache: Optional[EmbeddingCache] = None, search_cache: Optional[SearchCache] = None, context_packer: Optional[ContextPacker] = None):
         self.search_client = search_client
         self.openai_client = openai_client
         self.chatgpt_deployment = chatgpt_deployment
         self.chatgpt_model = chatgpt_model
         self.embedding_deployment = embedding_deployment
+        self.embedding_cache = embedding_cache or EmbeddingCache(openai_client, embedding_deployment)
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.search_cache = search_cache or SearchCache(search_client, sourcepage_field, content_field)
         self.chatgpt_token_limit = get_token_limit(chatgpt_model)
-        self.cosmos_container = cosmos_container
-        self.chat_session_id = str(uuid.uuid4())
+        self.context_packer = context_packer or ContextPacker(lambda texts: num_tokens_from_texts(texts, chatgpt_model))
+        # 쓰기 큐는 app.py가 만들고 종료할 때 닫는다(setup_clients, close_clients). 기록할 저장소가 없으면 None이다.
+        self.chat_log = chat_log
         logging.info(self.chatgpt_token_limit, chatgpt_model)
 
+    @cached_property
+    def static_token_counts(self) -> dict[tuple[str, str], int]:
+        # 고정된 시스템 프롬프트와 few-shot의 토큰 수는 처음 사용할 때 한 번만 계산하고 이후 요청에서 재사용한다.
+        return count_static_tokens([
+            {'role': self.SYSTEM, 'content': self.query_prompt_template},
+            {'role': self.SYSTEM, 'content': self.system_message_chat_conversation.format(injected_prompt="", follow_up_questions_prompt="")},
+            {'role': self.SYSTEM, 'content': self.system_message_chat_conversation.format(injected_prompt="", follow_up_questions_prompt=self.follow_up_questions_prompt_content)},
+            *self.query_prompt_few_shots
+        ], self.chatgpt_model)
+
     async def run_until_final_call(self, history: list[dict[str, str]], overrides: dict[str, Any], should_stream: bool = False) -> tuple[dict[str, Any], Coroutine[Any, Any, AsyncStream[ChatCompletionChunk]]]:
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
@@ -109,16 +133,18 @@ A:한산도 대첩은 1592년에 일어난 임진왜란 중에 조선 수군이
             history,
             user_q,
             self.query_prompt_few_shots,
-            self.chatgpt_token_limit - len(user_q)
+            self.chatgpt_token_limit - self.query_response_tokens,
+            stage="query_rewrite"
             )
 
         # ChatCompletion API로 검색 쿼리를 생성한다.
-        chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
-            messages=messages,
-            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-            temperature=0.0,
-            max_tokens=100,
-            n=1)
+        with metrics.stage(self.metrics_label, "query_rewrite"):
+            chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
+                messages=messages,
+                model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+                temperature=0.0,
+                max_tokens=self.query_response_tokens,
+                n=1)
 
         query_text = chat_completion.choices[0].message.content
         logging.info(query_text)
@@ -130,11 +156,8 @@ A:한산도 대첩은 1592년에 일어난 임진왜란 중에 조선 수군이
         # ================================================================================
         # 검색 모드에 벡터가 포함되어 있으면 쿼리를 임베딩한다.
         if has_vector:
-            embedding = await self.openai_client.embeddings.create(
-                model=self.embedding_deployment,
-                input=query_text
-            )
-            query_vector = embedding.data[0].embedding
+            with metrics.stage(self.metrics_label, "embedding"):
+                query_vector = (await self.embedding_cache.embed(query_text)).tolist()
         else:
             query_vector = None
 
@@ -143,30 +166,14 @@ A:한산도 대첩은 1592년에 일어난 임진왜란 중에 조선 수군이
             query_text = None
 
         # 검색 모드로 텍스트나 하이브리드(벡터 + 텍스트)를 사용하면 요청에 따라 의미 체계 검색을 사용한다.
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(search_text=query_text,
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC,
-                                          semantic_configuration_name="default",
-                                          top=top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                                          vector_queries=[VectorizedQuery(vector=query_vector, k_nearest_neighbors=top, fields="embedding")] if query_vector else None)
-        else:
-            r = await self.search_client.search(search_text=query_text,
-                                          filter=filter,
-                                          top=top,
-                                          vector_queries=[VectorizedQuery(vector=query_vector, k_nearest_neighbors=top, fields="embedding")] if query_vector else None)
-        
-        if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) async for doc in r]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) async for doc in r]
-        content = "\n".join(results)
+        with metrics.stage(self.metrics_label, "search"):
+            hits = await self.search_cache.search(query_text,
+                                                  query_vector,
+                                                  filter,
+                                                  top,
+                                                  use_semantic_ranker=overrides.get("semantic_ranker") and has_text,
+                                                  use_semantic_captions=use_semantic_captions)
 
-        # =============================================================================
-        # STEP 3: 검색 결과와 채팅 이력을 사용해서 문맥이나 내용에 맞는 응답을 생성한다.
-        # =============================================================================
-        
         follow_up_questions_prompt = self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else ""
         # 프롬프트 템플릿 덮어쓰기
         # 클라이언트가 프롬프트 전체를 변경하거나, 접두사 '>>>'를 사용해서 기존 프롬프트에 주입할 수 있도록 한다.
@@ -178,12 +185,26 @@ A:한산도 대첩은 1592년에 일어난 임진왜란 중에 조선 수군이
         else:
             system_message = prompt_override.format(follow_up_questions_prompt=follow_up_questions_prompt)
 
+        # 겹치는 이웃 청크를 합치고, 응답과 시스템 프롬프트, 대화 이력에 쓸 토큰을 남긴 예산 안에서만 출처를 넣는다.
+        # 출처의 토큰 예산은 출처를 뺀 응답 프롬프트(시스템 프롬프트, 대화 이력, 질문)를 실제로 센 토큰 수를 빼고 정한다.
+        prompt_tokens = self.count_prompt_tokens(system_message, history, self.chatgpt_token_limit - self.answer_response_tokens)
+        hits = self.context_packer.pack(hits, self.chatgpt_token_limit - self.answer_response_tokens, use_captions=use_semantic_captions, prompt_tokens=prompt_tokens)
+        if use_semantic_captions:
+            results = [hit.sourcepage + ": " + nonewlines(" . ".join(hit.captions)) for hit in hits]
+        else:
+            results = [hit.sourcepage + ": " + nonewlines(hit.content) for hit in hits]
+        content = "\n".join(results)
+
+        # =============================================================================
+        # STEP 3: 검색 결과와 채팅 이력을 사용해서 문맥이나 내용에 맞는 응답을 생성한다.
+        # =============================================================================
+        
         messages = self.get_messages_from_history(
             system_message,
             self.chatgpt_model,
             history,
             history[-1]["user"]+ "\n\nSources:\n" + content, # 모델은 시스템 메시지가 너무 길어지면 프롬프트를 제대로 처리하지 못한다. 후속 질문 프롬프트의 처리를 위해 사용자의 최근 대화로 소스를 이동한다.
-            max_tokens=self.chatgpt_token_limit)
+            max_tokens=self.chatgpt_token_limit - self.answer_response_tokens)
         msg_to_display = '\n\n'.join([str(message) for message in messages])
         
         extra_info = {"data_points": results, "thoughts": f"Searched for:<br>{query_text}<br><br>Conversations:<br>" + msg_to_display.replace('\n', '<br>')}
@@ -192,7 +213,7 @@ A:한산도 대첩은 1592년에 일어난 임진왜란 중에 조선 수군이
             model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
             messages=messages,
             temperature=overrides.get("temperature") or 0.0,
-            max_tokens=1024,
+            max_tokens=self.answer_response_tokens,
             n=1,
             stream=should_stream
         )
@@ -200,31 +221,43 @@ A:한산도 대첩은 1592년에 일어난 임진왜란 중에 조선 수군이
         return (extra_info, chat_coroutine)
 
     async def run_without_streaming(self, history: list[dict[str, str]], overrides: dict[str, Any]) -> dict[str, Any]:
+        start = time.perf_counter()
         extra_info, chat_coroutine = await self.run_until_final_call(history, overrides, should_stream=False)
-        chat_content = (await chat_coroutine).choices[0].message.content
-        
+        with metrics.stage(self.metrics_label, "answer"):
+            chat_content = (await chat_coroutine).choices[0].message.content
+        self.log_conversation(history, chat_content, overrides)
+        extra_info["answer"] = chat_content
+        metrics.observe_stage(self.metrics_label, "total", time.perf_counter() - start)
+        return extra_info
+
+    def chat_session_id(self, history: list[dict[str, str]], overrides: dict[str, Any]) -> str:
+        # 대화마다 다른 파티션 키를 사용한다. 요청의 session_id가 없으면 대화의 첫 질문으로 정한다.
+        if session_id := overrides.get("session_id"):
+            return session_id
+        return hashlib.sha1(history[0]["user"].encode("utf-8")).hexdigest()
+
+    def log_conversation(self, history: list[dict[str, str]], answer: str, overrides: dict[str, Any]) -> None:
+        if self.chat_log is None:
+            return
+        # Cosmos DB 쓰기를 기다리지 않도록 대화 기록은 write-behind 큐에 넣고 바로 돌아간다.
+        question = history[-1]["user"]
         new_item = {
             "id": str(uuid.uuid4()),
-            "chat_session_id": self.chat_session_id,
+            "chat_session_id": self.chat_session_id(history, overrides),
             "user_id": "A00000001",
             "timestamp": datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
             "conversation": [
-                {"role": "user", "content": history[-1]["user"]},
-                {"role": "assistant", "content": chat_content}
+                {"role": "user", "content": question},
+                {"role": "assistant", "content": answer}
             ],
             "feedback": 1
         }
-        try:
-            self.cosmos_container.create_item(new_item)
-        except Exception as e:
-            logging.exception(e)
-            pass
-        
-        extra_info["answer"] = chat_content
-        return extra_info
+        self.chat_log.submit(new_item)
 
     async def run_with_streaming(self, history: list[dict[str, str]], overrides: dict[str, Any]) -> AsyncGenerator[dict, None]:
+        start = time.perf_counter()
         extra_info, chat_coroutine = await self.run_until_final_call(history, overrides, should_stream=True)
+        answer_start = time.perf_counter()
         yield {
             "choices": [
                 {
@@ -236,34 +269,73 @@ A:한산도 대첩은 1592년에 일어난 임진왜란 중에 조선 수군이
             ],
             "object": "chat.completion.chunk",
         }
+        answer = []
         async for event_chunk in await chat_coroutine:
             # "2023-07-01-preview" API version has a bug where first response has empty choices
             event = event_chunk.model_dump()  # Convert pydantic model to dict
             if event["choices"]:
                 content = event["choices"][0]["delta"].get("content")
                 content = content or ""  # content may either not exist in delta, or explicitly be None
+                if content and not answer:
+                    metrics.observe_stage(self.metrics_label, "first_token", time.perf_counter() - start)
+                if content:
+                    answer.append(content)
                 yield event
+        metrics.observe_stage(self.metrics_label, "answer", time.perf_counter() - answer_start)
+        metrics.observe_stage(self.metrics_label, "total", time.perf_counter() - start)
+        # 스트리밍이 끝까지 완료된 대화만 기록한다.
+        self.log_conversation(history, "".join(answer), overrides)
 
-    def get_messages_from_history(self, system_prompt: str, model_id: str, history: list[dict[str, str]], user_conv: str, few_shots = [], max_tokens: int = 4096) -> list:
-        message_builder = MessageBuilder(system_prompt, model_id)
+    async def run_with_lean_streaming(self, history: list[dict[str, str]], overrides: dict[str, Any]) -> AsyncGenerator[dict, None]:
+        # 프론트엔드가 읽는 값만 보낸다. 청크를 dict로 변환(model_dump)하지 않고 delta의 content만 꺼낸다.
+        start = time.perf_counter()
+        extra_info, chat_coroutine = await self.run_until_final_call(history, overrides, should_stream=True)
+        answer_start = time.perf_counter()
+        yield extra_info
+        finish_reason = None
+        answer = []
+        async for event_chunk in await chat_coroutine:
+            if event_chunk.choices:
+                choice = event_chunk.choices[0]
+                if choice.delta is not None and choice.delta.content:
+                    if not answer:
+                        metrics.observe_stage(self.metrics_label, "first_token", time.perf_counter() - start)
+                    answer.append(choice.delta.content)
+                    yield {"delta": choice.delta.content}
+                finish_reason = choice.finish_reason or finish_reason
+        metrics.observe_stage(self.metrics_label, "answer", time.perf_counter() - answer_start)
+        metrics.observe_stage(self.metrics_label, "total", time.perf_counter() - start)
+        self.log_conversation(history, "".join(answer), overrides)
+        yield {"done": True, "finish_reason": finish_reason}
+
+    def count_prompt_tokens(self, system_prompt: str, history: list[dict[str, str]], max_tokens: int) -> int:
+        """
+        Token count of the answer prompt without the sources: the system prompt, the chat history kept by get_messages_from_history and the question.
+        The history is trimmed to what is left after the context packer's source reserve, so a long chat doesn't leave no room for the sources.
+        """
+        message_builder = MessageBuilder(system_prompt, self.chatgpt_model, self.static_token_counts)
+        user_token_count = message_builder.count_tokens({'role': self.USER, 'content': history[-1]["user"] + "\n\nSources:\n"})
+        history_budget = max_tokens - self.context_packer.source_reserve(max_tokens) - message_builder.token_length - user_token_count
+        _, history_token_count = trim_history(history[:-1], self.chatgpt_model, history_budget)
+        return message_builder.token_length + user_token_count + history_token_count
+
+    def get_messages_from_history(self, system_prompt: str, model_id: str, history: list[dict[str, str]], user_conv: str, few_shots = [], max_tokens: int = 4096, stage: str = "answer") -> list:
+        start = time.perf_counter()
+        message_builder = MessageBuilder(system_prompt, model_id, self.static_token_counts)
 
         # Add examples to show the chat what responses we want. It will try to mimic any responses and make sure they match the rules laid out in the system message.
         # 채팅으로 어떤 응답을 원하는지 예시를 추가한다. 채팅은 시스템 메시지의 규칙과 일치하는지 확인하며 어떤 응답이든 모방을 시도한다.
-        for shot in few_shots:
-            message_builder.append_message(shot.get('role'), shot.get('content'))
-
-        user_content = user_conv
-        append_index = len(few_shots) + 1
+        message_builder.append_messages(few_shots)
 
-        message_builder.append_message(self.USER, user_content, index=append_index)
+        user_message = {'role': self.USER, 'content': user_conv}
+        user_token_count = message_builder.count_tokens(user_message)
 
-        for h in reversed(history[:-1]):
-            if bot_msg := h.get("bot"):
-                message_builder.append_message(self.ASSISTANT, bot_msg, index=append_index)
-            if user_msg := h.get("user"):
-                message_builder.append_message(self.USER, user_msg, index=append_index)
-            if message_builder.token_length > max_tokens:
-                break
+        # 시스템 프롬프트, 예시, 마지막 질문을 제외한 토큰 예산 안에 들어가는 최근 대화 이력만 턴 단위로 포함한다.
+        history_messages, history_token_count = trim_history(history[:-1], model_id, max_tokens - message_builder.token_length - user_token_count)
+        message_builder.append_messages(history_messages, history_token_count)
+        message_builder.append_messages([user_message], user_token_count)
 
         messages = message_builder.messages
+        metrics.observe_stage(self.metrics_label, "prompt_build", time.perf_counter() - start)
+        metrics.observe_prompt_tokens(self.metrics_label, stage, message_builder.token_length)
         return messages
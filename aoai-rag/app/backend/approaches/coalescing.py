@@ -0,0 +1,67 @@
+import hashlib
+import json
+from typing import Any, AsyncGenerator
+
+from approaches.approach import AskApproach
+from core.singleflight import SingleFlight
+
+
+def normalize_question(q: str) -> str:
+    return " ".join(q.split()).casefold()
+
+
+def request_key(method: str, approach: str, q: str, overrides: dict[str, Any], history: list[dict[str, str]]) -> str:
+    key = {
+        "method": method,
+        "approach": approach,
+        "q": normalize_question(q),
+        # 대화 기록의 파티션 키로만 쓰는 session_id가 달라도 같은 요청으로 본다.
+        "overrides": {name: value for name, value in overrides.items() if name != "session_id"},
+        "history": history,
+    }
+    return hashlib.sha1(json.dumps(key, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class CoalescingAskApproach(AskApproach):
+    """
+    Runs identical concurrent /ask requests (same approach, normalized question and overrides) only once.
+    """
+
+    def __init__(self, approach: AskApproach, name: str, singleflight: SingleFlight):
+        self.approach = approach
+        self.name = name
+        self.singleflight = singleflight
+
+    async def run(self, q: str, overrides: dict[str, Any]) -> dict[str, Any]:
+        key = request_key("run", self.name, q, overrides, [])
+        return await self.singleflight.run(key, lambda: self.approach.run(q, overrides))
+
+
+class CoalescingChatApproach:
+    """
+    Runs identical concurrent /chat and /chat_stream requests only once.
+    Requests are identical when the approach, the overrides, the normalized last question and the last `history_turns`
+    previous turns are the same. A streaming request that joins late gets the events streamed so far and then the rest.
+    """
+
+    def __init__(self, approach: Any, name: str, singleflight: SingleFlight, history_turns: int = 2):
+        self.approach = approach
+        self.name = name
+        self.singleflight = singleflight
+        self.history_turns = history_turns
+
+    def key(self, method: str, history: list[dict[str, str]], overrides: dict[str, Any]) -> str:
+        tail = history[max(len(history) - 1 - self.history_turns, 0):-1]
+        return request_key(method, self.name, history[-1]["user"], overrides, tail)
+
+    async def run_without_streaming(self, history: list[dict[str, str]], overrides: dict[str, Any]) -> dict[str, Any]:
+        key = self.key("run_without_streaming", history, overrides)
+        return await self.singleflight.run(key, lambda: self.approach.run_without_streaming(history, overrides))
+
+    def run_with_streaming(self, history: list[dict[str, str]], overrides: dict[str, Any]) -> AsyncGenerator[dict, None]:
+        key = self.key("run_with_streaming", history, overrides)
+        return self.singleflight.stream(key, lambda: self.approach.run_with_streaming(history, overrides))
+
+    def run_with_lean_streaming(self, history: list[dict[str, str]], overrides: dict[str, Any]) -> AsyncGenerator[dict, None]:
+        key = self.key("run_with_lean_streaming", history, overrides)
+        return self.singleflight.stream(key, lambda: self.approach.run_with_lean_streaming(history, overrides))
@@ -1,26 +1,39 @@
 import logging
-from typing import Any, Callable
+from typing import Any, Optional
 
-from langchain.agents import AgentType, initialize_agent, load_tools
+from langchain.agents import AgentType, initialize_agent
 from langchain.agents.mrkl import prompt
 from langchain.callbacks.manager import CallbackManager
 from langchain.chat_models import AzureChatOpenAI
-from langchain.tools import AIPluginTool
 
 from approaches.approach import AskApproach
-from langchainadapters import HtmlCallbackHandler
-from requests.exceptions import ConnectionError
+from core.metrics import metrics
+from core.pluginregistry import PluginRegistry
+from httptools import AsyncHttpClient, load_async_requests_tools
+from langchainadapters import HtmlCallbackHandler, MetricsCallbackHandler
+
+DEFAULT_PLUGIN_URLS = ["http://localhost:5005/.well-known/ai-plugin.json", "http://localhost:5006/.well-known/ai-plugin.json"]
 
 class ReadPluginsRetrieve(AskApproach):
-    def __init__(self, openai_deployment: str, openai_api_version: str, openai_endpoint: str, openai_ad_token: str):
+    # /metrics에서 이 접근법의 단계별 지표를 구분하는 이름
+    metrics_label = "ask_rpr"
+
+    def __init__(self, openai_deployment: str, openai_api_version: str, openai_endpoint: str, openai_ad_token: str, plugin_registry: Optional[PluginRegistry] = None, http_client: Optional[AsyncHttpClient] = None):
         self.openai_deployment = openai_deployment
         self.openai_api_version = openai_api_version
         self.openai_endpoint = openai_endpoint
         self.openai_ad_token = openai_ad_token
+        # 플러그인 매니페스트와 OpenAPI 스펙은 요청마다 가져오지 않고 레지스트리의 메모리에서 읽는다.
+        self.plugin_registry = plugin_registry or PluginRegistry(DEFAULT_PLUGIN_URLS)
+        # requests 라이브러리를 쓰는 requests_all 툴 대신 이벤트 루프를 막지 않는 비동기 툴을 사용한다.
+        self.http_client = http_client or AsyncHttpClient()
+        self.requests_tools = load_async_requests_tools(self.http_client)
+        self.metrics_handler = MetricsCallbackHandler(self.metrics_label)
     async def run(self, q: str, overrides: dict[str, Any]) -> Any:
+        # 클라이언트가 include_thoughts=false를 보내면 사고 과정을 기록하지 않는다.
+        cb_handler = HtmlCallbackHandler() if overrides.get("include_thoughts", True) else None
         try:
-            cb_handler = HtmlCallbackHandler()
-            cb_manager = CallbackManager(handlers=[cb_handler])
+            cb_manager = CallbackManager(handlers=[self.metrics_handler, cb_handler] if cb_handler else [self.metrics_handler])
 
             #llm = ChatOpenAI(model_name="gpt-4-0613", temperature=0)
             llm = AzureChatOpenAI(azure_deployment=self.openai_deployment,
@@ -30,10 +43,8 @@ class ReadPluginsRetrieve(AskApproach):
                         temperature=overrides.get("temperature") or 0.0,
                         )
 
-            tools = load_tools(["requests_all"])
-            plugin_urls = ["http://localhost:5005/.well-known/ai-plugin.json", "http://localhost:5006/.well-known/ai-plugin.json"]
-
-            tools += [AIPluginTool.from_plugin_url(url) for url in plugin_urls]
+            # 응답하지 않는 플러그인은 빠진 채로 에이전트를 실행한다.
+            tools = self.requests_tools + self.plugin_registry.tools()
 
             SUFFIX = """
             Answer should be in Korean. Use http instead of https for endpoint.
@@ -55,13 +66,11 @@ class ReadPluginsRetrieve(AskApproach):
                                         early_stopping_method="generate")
 
             #result = agent_chain.run(q)
-            result = await agent_chain.arun(q)
+            with metrics.stage(self.metrics_label, "total"):
+                result = await agent_chain.arun(q)
 
-        except ConnectionError as e:
-            logging.exception(e)
-            result = "죄송합니다. 잘 모르겠습니다(ConnectionError)."
         except Exception as e:
             logging.exception(e)
             result = "죄송합니다. 잘 모르겠습니다(Error)."
 
-        return {"data_points":  [], "answer": result, "thoughts": cb_handler.get_and_reset_log()}
+        return {"data_points":  [], "answer": result, "thoughts": cb_handler.render() if cb_handler else None}
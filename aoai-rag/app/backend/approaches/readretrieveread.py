@@ -1,26 +1,54 @@
-import csv
+import asyncio
 import logging
-from typing import Any, Callable
+from contextvars import ContextVar
+from typing import Any, Callable, Optional
 from azure.search.documents.aio import SearchClient
-from azure.search.documents.models import (
-    QueryType,
-    VectorizedQuery
-)
 from openai import AsyncOpenAI
 from langchain.agents import (
+    AgentExecutor,
     AgentType,
     Tool,
     initialize_agent,
 )
 from langchain.agents.mrkl import prompt
-from langchain.callbacks.manager import CallbackManager
+from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun
 from langchain.chat_models import AzureChatOpenAI
+from langchain.schema import BaseMessage, ChatResult
 from langchain.tools import BaseTool
 
 from approaches.approach import AskApproach
-from langchainadapters import HtmlCallbackHandler
+from core.contextpacker import ContextPacker
+from core.embeddingbatcher import estimate_tokens
+from core.embeddingcache import EmbeddingCache
+from core.lookupengine import get_lookup_engine
+from core.metrics import metrics
+from core.searchcache import SearchCache
+from langchainadapters import HtmlCallbackHandler, MetricsCallbackHandler
 from text import nonewlines
 
+class AgentRequest:
+    """
+    Per-request state of the shared agent: the overrides used by the search tool, its last results and the temperature.
+    """
+
+    def __init__(self, overrides: dict[str, Any], temperature: float):
+        self.overrides = overrides
+        self.temperature = temperature
+        self.retrieve_results: Optional[list[str]] = None
+
+current_agent_request: ContextVar[AgentRequest] = ContextVar("current_agent_request")
+
+class RequestScopedAzureChatOpenAI(AzureChatOpenAI):
+    """
+    AzureChatOpenAI that applies the temperature of the current request, so one client can serve every request.
+    """
+
+    async def _agenerate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None, run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        request = current_agent_request.get(None)
+        if request is not None:
+            kwargs.setdefault("temperature", request.temperature)
+        return await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
 class ReadRetrieveReadApproach(AskApproach):
     """
     질문에 어떤 정보가 누락됐는지 확인하기 위해 질문을 반복 평가하고, 모든 정보가 구비되면 응답을 생성한다.
@@ -32,7 +60,10 @@ class ReadRetrieveReadApproach(AskApproach):
     [1] E. Karpas, et al. arXiv:2205.00445
     """
 
-    def __init__(self, search_client: SearchClient, openai_client: AsyncOpenAI, openai_api_version: str, openai_endpoint: str, openai_ad_token: Callable[[], str], openai_deployment: str, embedding_deployment: str, sourcepage_field: str, content_field: str):
+    # /metrics에서 이 접근법의 단계별 지표를 구분하는 이름
+    metrics_label = "ask_rrr"
+
+    def __init__(self, search_client: SearchClient, openai_client: AsyncOpenAI, openai_api_version: str, openai_endpoint: str, openai_ad_token: Callable[[], str], openai_deployment: str, embedding_deployment: str, sourcepage_field: str, content_field: str, embedding_cache: Optional[EmbeddingCache] = None, search_cache: Optional[SearchCache] = None, context_packer: Optional[ContextPacker] = None):
         self.search_client = search_client
         self.openai_client = openai_client
         self.openai_api_version = openai_api_version
@@ -40,8 +71,14 @@ class ReadRetrieveReadApproach(AskApproach):
         self.openai_ad_token = openai_ad_token
         self.openai_deployment = openai_deployment
         self.embedding_deployment = embedding_deployment
+        self.embedding_cache = embedding_cache or EmbeddingCache(openai_client, embedding_deployment)
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.search_cache = search_cache or SearchCache(search_client, sourcepage_field, content_field)
+        # 에이전트는 모델 이름을 모르므로 기본값에서는 토큰 수를 추정한다.
+        self.context_packer = context_packer or ContextPacker(lambda texts: [estimate_tokens(text) for text in texts])
+        self.metrics_handler = MetricsCallbackHandler(self.metrics_label)
+        self.agent_chain = self.build_agent()
 
     async def retrieve(self, query_text: str, overrides: dict[str, Any]) -> Any:
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
@@ -52,11 +89,8 @@ class ReadRetrieveReadApproach(AskApproach):
         filter = "category ne '{}'".format(exclude_category.replace("'", "''")) if exclude_category else None
         # If retrieval mode includes vectors, compute an embedding for the query
         if has_vector:
-            embedding = await self.openai_client.embeddings.create(
-                model=self.embedding_deployment,
-                input=query_text
-            )
-            query_vector = embedding.data[0].embedding
+            with metrics.stage(self.metrics_label, "embedding"):
+                query_vector = (await self.embedding_cache.embed(query_text)).tolist()
         else:
             query_vector = None
 
@@ -65,65 +99,50 @@ class ReadRetrieveReadApproach(AskApproach):
             query_text = ""
 
         # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(search_text=query_text,
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC,
-                                          semantic_configuration_name="default",
-                                          top = top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                                          vector_queries=[VectorizedQuery(vector=query_vector, k_nearest_neighbors=top, fields="embedding")] if query_vector else None)
-        else:
-            r = await self.search_client.search(search_text=query_text,
-                                          filter=filter,
-                                          top=top,
-                                          vector_queries=[VectorizedQuery(vector=query_vector, k_nearest_neighbors=top, fields="embedding")] if query_vector else None)
+        with metrics.stage(self.metrics_label, "search"):
+            hits = await self.search_cache.search(query_text,
+                                                  query_vector,
+                                                  filter,
+                                                  top,
+                                                  use_semantic_ranker=overrides.get("semantic_ranker") and has_text,
+                                                  use_semantic_captions=use_semantic_captions)
+        # 겹치는 이웃 청크를 합치고 출처의 토큰 예산을 넘지 않게 한다.
+        hits = self.context_packer.pack(hits, use_captions=use_semantic_captions)
         if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ":" + nonewlines(" -.- ".join([c.text for c in doc['@search.captions']])) for doc in r]
+            results = [hit.sourcepage + ":" + nonewlines(" -.- ".join(hit.captions)) for hit in hits]
         else:
-            results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field]) async for doc in r]
+            results = [hit.sourcepage + ":" + nonewlines(hit.content) for hit in hits]
         content = "\n".join(results)
         return results, content
 
-    async def run(self, q: str, overrides: dict[str, Any]) -> dict[str, Any]:
-
-        retrieve_results = None
-        async def retrieve_and_store(q: str) -> Any:
-            nonlocal retrieve_results
-            retrieve_results, content = await self.retrieve(q, overrides)
-            return content
-
-        # Use to capture thought process during iterations
-        cb_handler = HtmlCallbackHandler()
-        cb_manager = CallbackManager(handlers=[cb_handler])
-
+    def build_agent(self) -> AgentExecutor:
+        # LLM 클라이언트, 툴, 에이전트 프롬프트는 워커마다 한 번만 만든다. 요청마다 달라지는 값은 AgentRequest로 전달한다.
         # Tool dataclass 방식과 Subclassing the BaseTool class 방식의 문법 차이를 보여준다.
         tools = [
             Tool(name="PeopleSearchTool",
-                func=retrieve_and_store,
-                coroutine=retrieve_and_store,
+                func=self.retrieve_and_store,
+                coroutine=self.retrieve_and_store,
                 description="한국사 인물 정보를 편리하게 검색할 수 있습니다. 사용자의 질문으로부터 검색 쿼리를 생성해서 검색을 수행합니다. 쿼리는 문자열만 받습니다."
                 ),
             CafeSearchTool()
         ]
 
        #llm = ChatOpenAI(model_name="gpt-4-0613", temperature=0)
-        llm = AzureChatOpenAI(azure_deployment=self.openai_deployment,
+        llm = RequestScopedAzureChatOpenAI(azure_deployment=self.openai_deployment,
                               api_version=self.openai_api_version,
                               azure_endpoint=self.openai_endpoint,
                               azure_ad_token_provider=self.openai_ad_token,
-                              temperature=overrides.get("temperature") or 0.3,
+                              temperature=0.3,
                               )
         SUFFIX = """
         Answer should be in Korean.
         """
-        agent_chain = initialize_agent(tools,
+        return initialize_agent(tools,
                                     llm,
                                     agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION,
                                     # agent=AgentType.OPENAI_FUNCTIONS,
                                     verbose=True,
                                     agent_kwargs=dict(suffix=SUFFIX + prompt.SUFFIX),
-                                    callback_manager = cb_manager,
                                     handle_parsing_errors=True,
                                     max_iterations=5,
                                     early_stopping_method="generate")
@@ -132,35 +151,47 @@ class ReadRetrieveReadApproach(AskApproach):
         #파싱 에러 처리 handle_parsing_errors
         #https://python.langchain.com/docs/modules/agents/how_to/handle_parsing_errors
 
-        result = await agent_chain.arun(q)
+    async def retrieve_and_store(self, q: str) -> Any:
+        request = current_agent_request.get()
+        request.retrieve_results, content = await self.retrieve(q, request.overrides)
+        return content
+
+    async def run(self, q: str, overrides: dict[str, Any]) -> dict[str, Any]:
+        request = AgentRequest(overrides, overrides.get("temperature") or 0.3)
+        # Use to capture thought process during iterations
+        # 클라이언트가 include_thoughts=false를 보내면 사고 과정을 기록하지 않는다.
+        cb_handler = HtmlCallbackHandler() if overrides.get("include_thoughts", True) else None
+        token = current_agent_request.set(request)
+        try:
+            # 실행 시에 넘긴 콜백은 에이전트 안의 LLM, 툴 호출에도 전달된다.
+            with metrics.stage(self.metrics_label, "total"):
+                result = await self.agent_chain.arun(q, callbacks=[self.metrics_handler, cb_handler] if cb_handler else [self.metrics_handler])
+        finally:
+            current_agent_request.reset(token)
         # Remove references to tool names that might be confused with a citation
         #result = result.replace("[CognitiveSearch]", "").replace("[Employee]", "")
-        return {"data_points": retrieve_results or [], "answer": result, "thoughts": cb_handler.get_and_reset_log()}
+        return {"data_points": request.retrieve_results or [], "answer": result, "thoughts": cb_handler.render() if cb_handler else None}
 
 # 검색을 수행하는 커스텀 툴을 정의한다. CSV에서 내용을 가져오는 예시다.
 # Subclassing the BaseTool class
 # https://python.langchain.com/docs/modules/agents/tools/custom_tools
 class CafeSearchTool(BaseTool):
-    data: dict[str, str] = {}
     name = "CafeSearchTool"
     description = "무신과 연고가 있는 카페를 검색할 때 유용합니다. 카페 검색 쿼리에는 무신의 **이름**만 입력해주세요."
+    filename: str = "data/restaurantinfo.csv"
+    key_field: str = "name"
 
     # Use the tool synchronously.
     def _run(self, query: str) -> str:
         """Use the tool."""
-        return query
-
-    # Use the tool asynchronously.
-    async def _arun(self, query: str) -> str:
-        filename = "data/restaurantinfo.csv"
-        key_field = "name"
         try:
-            with open(filename, newline='', encoding='utf-8') as csvfile:
-                reader = csv.DictReader(csvfile)
-                for row in reader:
-                    self.data[row[key_field]] =  "\n".join([f"{i}:{row[i]}" for i in row])
-
+            # CSV는 워커마다 한 번만 읽고, 파일이 바뀌면 백그라운드에서 다시 읽는다.
+            return get_lookup_engine(self.filename, self.key_field).lookup(query)
         except Exception as e:
-            logging.exception("File read error:", e)
+            logging.exception("File read error: %s", e)
+            return ""
 
-        return self.data.get(query, "")
\ No newline at end of file
+    # Use the tool asynchronously.
+    async def _arun(self, query: str) -> str:
+        # 처음 조회할 때는 CSV를 읽어야 하므로 이벤트 루프를 막지 않도록 스레드에서 실행한다.
+        return await asyncio.to_thread(self._run, query)
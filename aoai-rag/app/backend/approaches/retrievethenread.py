@@ -1,13 +1,16 @@
-from typing import Any
+import time
+from functools import cached_property
+from typing import Any, Optional
 
 from openai import AsyncOpenAI
 from azure.search.documents.aio import SearchClient
-from azure.search.documents.models import (
-    QueryType,
-    VectorizedQuery
-)
 from approaches.approach import AskApproach
+from core.contextpacker import ContextPacker
+from core.embeddingcache import EmbeddingCache
 from core.messagebuilder import MessageBuilder
+from core.metrics import metrics
+from core.modelhelper import count_static_tokens, get_token_limit, num_tokens_from_texts
+from core.searchcache import SearchCache
 from text import nonewlines
 
 class RetrieveThenReadApproach(AskApproach):
@@ -19,6 +22,9 @@ class RetrieveThenReadApproach(AskApproach):
     우선 검색에서 상위를 차지한 문서들을 활용해서 프롬프트를 작성하고, OpenAI로 보완된 응답을 생성한다.
     """
 
+    # /metrics에서 이 접근법의 단계별 지표를 구분하는 이름
+    metrics_label = "ask_rtr"
+
     system_chat_template = \
 "너는 한국사 질문을 답변해주는 역사 교수야." + \
 "질문자가 '나'로 질문해도 '당신'으로 질문자를 지칭해야해" + \
@@ -38,16 +44,30 @@ info4.pdf: 1219년 9월에 개성부 안흥리(安興里) 집에서 사망했는
 """
     answer = "최충헌(崔忠獻, 1149년 ~ 1219년 10월 29일)은 고려 시대 중기에서 후기에 활동한 무신이자 정치가로, 최씨 무신 정권의 첫 지도자입니다.[info1.pdf] 그는 1196년부터 1219년까지 23년 동안 고려 왕조의 실권을 잡고, 국왕 명종과 희종을 폐위시키기도 했습니다. 또한 무신 세습 정권을 구축하고, 주요 경쟁자들을 제거하여 독재 체제를 확립했습니다.[info2.pdf][info3.pdf] 1219년에 사망하였고, 그의 장례식은 고려의 임금의 장례식과 다를 바 없었다고 전해집니다.[info4.pdf]"
 
-    def __init__(self, search_client: SearchClient, openai_client: AsyncOpenAI, openai_deployment: str, chatgpt_model: str, embedding_deployment: str, sourcepage_field: str, content_field: str):
+    def __init__(self, search_client: SearchClient, openai_client: AsyncOpenAI, openai_deployment: str, chatgpt_model: str, embedding_deployment: str, sourcepage_field: str, content_field: str, embedding_cache: Optional[EmbeddingCache] = None, search_cache: Optional[SearchCache] = None, context_packer: Optional[ContextPacker] = None):
         self.search_client = search_client
         self.openai_client = openai_client
         self.openai_deployment = openai_deployment
         self.chatgpt_model = chatgpt_model
         self.embedding_deployment = embedding_deployment
+        self.embedding_cache = embedding_cache or EmbeddingCache(openai_client, embedding_deployment)
         self.sourcepage_field = sourcepage_field
         self.content_field = content_field
+        self.search_cache = search_cache or SearchCache(search_client, sourcepage_field, content_field)
+        self.chatgpt_token_limit = get_token_limit(chatgpt_model)
+        self.context_packer = context_packer or ContextPacker(lambda texts: num_tokens_from_texts(texts, chatgpt_model))
+
+    @cached_property
+    def static_token_counts(self) -> dict[tuple[str, str], int]:
+        # 시스템 프롬프트와 샘플 대화의 토큰 수는 처음 사용할 때 한 번만 계산한다.
+        return count_static_tokens([
+            {'role': 'system', 'content': self.system_chat_template},
+            {'role': 'assistant', 'content': self.answer},
+            {'role': 'user', 'content': self.question}
+        ], self.chatgpt_model)
 
     async def run(self, q: str, overrides: dict[str, Any]) -> dict[str, Any]:
+        start = time.perf_counter()
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
         use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
@@ -57,11 +77,8 @@ info4.pdf: 1219년 9월에 개성부 안흥리(安興里) 집에서 사망했는
 
         # If retrieval mode includes vectors, compute an embedding for the query
         if has_vector:
-            embedding = await self.openai_client.embeddings.create(
-                model=self.embedding_deployment,
-                input=q
-            )
-            query_vector = embedding.data[0].embedding
+            with metrics.stage(self.metrics_label, "embedding"):
+                query_vector = (await self.embedding_cache.embed(q)).tolist()
         else:
             query_vector = None
 
@@ -69,26 +86,31 @@ info4.pdf: 1219년 9월에 개성부 안흥리(安興里) 집에서 사망했는
         query_text = q if has_text else ""
 
         # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(search_text=query_text,
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC,
-                                          semantic_configuration_name="default",
-                                          top=top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                                          vector_queries=[VectorizedQuery(vector=query_vector, k_nearest_neighbors=top, fields="embedding")] if query_vector else None)
-        else:
-            r = await self.search_client.search(search_text=query_text,
-                                          filter=filter,
-                                          top=top,
-                                          vector_queries=[VectorizedQuery(vector=query_vector, k_nearest_neighbors=top, fields="embedding")] if query_vector else None)
+        with metrics.stage(self.metrics_label, "search"):
+            hits = await self.search_cache.search(query_text,
+                                                  query_vector,
+                                                  filter,
+                                                  top,
+                                                  use_semantic_ranker=overrides.get("semantic_ranker") and has_text,
+                                                  use_semantic_captions=use_semantic_captions)
+        # 겹치는 이웃 청크를 합치고, 응답과 시스템 프롬프트에 쓸 토큰을 남긴 예산 안에서만 출처를 넣는다.
+        # 출처의 토큰 예산은 출처를 뺀 프롬프트(시스템 프롬프트, 질문, 예시)를 실제로 센 토큰 수를 빼고 정한다.
+        system_prompt = overrides.get("prompt_template") or self.system_chat_template
+        prompt_without_sources = MessageBuilder(system_prompt, self.chatgpt_model, self.static_token_counts)
+        prompt_without_sources.append_messages([
+            {'role': 'user', 'content': q + "\n" + "Sources:\n "},
+            {'role': 'assistant', 'content': self.answer},
+            {'role': 'user', 'content': self.question}
+        ])
+        hits = self.context_packer.pack(hits, self.chatgpt_token_limit - 1024, use_captions=use_semantic_captions, prompt_tokens=prompt_without_sources.token_length)
         if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) async for doc in r]
+            results = [hit.sourcepage + ": " + nonewlines(" . ".join(hit.captions)) for hit in hits]
         else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) async for doc in r]
+            results = [hit.sourcepage + ": " + nonewlines(hit.content) for hit in hits]
         content = "\n".join(results)
 
-        message_builder = MessageBuilder(overrides.get("prompt_template") or self.system_chat_template, self.chatgpt_model)
+        prompt_start = time.perf_counter()
+        message_builder = MessageBuilder(system_prompt, self.chatgpt_model, self.static_token_counts)
 
         # add user question
         user_content = q + "\n" + f"Sources:\n {content}"
@@ -99,6 +121,8 @@ info4.pdf: 1219년 9월에 개성부 안흥리(安興里) 집에서 사망했는
         message_builder.append_message('user', self.question)
 
         messages = message_builder.messages
+        metrics.observe_stage(self.metrics_label, "prompt_build", time.perf_counter() - prompt_start)
+        metrics.observe_prompt_tokens(self.metrics_label, "answer", message_builder.token_length)
         chat_coroutine = self.openai_client.chat.completions.create(
             model=self.openai_deployment if self.openai_deployment else self.chatgpt_model,
             messages=messages,
@@ -106,4 +130,7 @@ info4.pdf: 1219년 9월에 개성부 안흥리(安興里) 집에서 사망했는
             max_tokens=1024,
             n=1
         )
-        return {"data_points": results, "answer": (await chat_coroutine).choices[0].message.content, "thoughts": f"Question:<br>{query_text}<br><br>Prompt:<br>" + '\n\n'.join([str(message) for message in messages])}
+        with metrics.stage(self.metrics_label, "answer"):
+            answer = (await chat_coroutine).choices[0].message.content
+        metrics.observe_stage(self.metrics_label, "total", time.perf_counter() - start)
+        return {"data_points": results, "answer": answer, "thoughts": f"Question:<br>{query_text}<br><br>Prompt:<br>" + '\n\n'.join([str(message) for message in messages])}
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+import numpy as np
+
+# 같은 질문이라도 이 값들이 다르면 다른 응답이 생성되므로 캐시 범위(scope)를 분리한다.
+SCOPED_OVERRIDES = ("retrieval_mode", "top", "exclude_category", "prompt_template", "semantic_ranker", "semantic_captions", "suggest_followup_questions", "include_thoughts")
+
+
+def answer_cache_scope(kind: str, approach: str, overrides: dict[str, Any], history: Optional[list[dict[str, str]]] = None) -> str:
+    """
+    Build the cache scope for a request. Requests only share answers when the endpoint kind, the approach,
+    the result-changing overrides and the previous chat turns are all the same.
+    """
+    scope = {
+        "kind": kind,
+        "approach": approach,
+        "overrides": {key: overrides.get(key) for key in SCOPED_OVERRIDES},
+        # 세션 저장소의 턴에 붙은 토큰 수는 응답과 관계가 없으므로 제외한다.
+        "history": [{"user": h.get("user"), "bot": h.get("bot")} for h in history or []],
+    }
+    return hashlib.sha1(json.dumps(scope, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class AnswerCacheEntry:
+    def __init__(self, scope: str, vector: np.ndarray, answer: dict[str, Any], created: float):
+        self.scope = scope
+        self.vector = vector
+        self.answer = answer
+        self.created = created
+
+
+class AnswerCache:
+    """
+      A semantic cache of answers keyed by the query embedding.
+      Attributes:
+          threshold (float): The minimum cosine similarity for a cached question to count as the same question.
+          ttl (float): Seconds an answer stays valid.
+          max_entries (int): The maximum number of answers kept. The least recently used answer is evicted first.
+              Expired answers of every scope are dropped on each lookup and store, so scopes that are never looked up again
+              don't keep their answers until they are evicted.
+          hits (int), misses (int): Lookup counters.
+      Methods:
+          lookup(self, scope: str, vector): Returns the cached answer of the most similar question in the scope, or None.
+          store(self, scope: str, vector, answer: dict): Stores an answer.
+      """
+
+    def __init__(self, threshold: float = 0.97, ttl: float = 3600, max_entries: int = 1000):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._next_id = 0
+        self._entries: OrderedDict[int, AnswerCacheEntry] = OrderedDict()
+        # scope -> (entry ids, matrix of normalized vectors). 항목이 바뀐 scope의 행렬은 다음 조회 시에 다시 만든다.
+        self._scope_ids: dict[str, list[int]] = {}
+        self._scope_matrix: dict[str, np.ndarray] = {}
+        # 모든 scope의 entry id를 저장한 순서대로 보관한다. 만료된 항목은 항상 앞쪽에 모여 있다.
+        self._created: OrderedDict[int, None] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict[str, Any]:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+    def lookup(self, scope: str, vector) -> Optional[dict[str, Any]]:
+        self._remove_expired()
+        ids = self._scope_ids.get(scope)
+        if not ids:
+            self.misses += 1
+            return None
+        matrix = self._scope_matrix.get(scope)
+        if matrix is None:
+            matrix = np.stack([self._entries[i].vector for i in ids])
+            self._scope_matrix[scope] = matrix
+        similarities = matrix @ normalize(vector)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            self.misses += 1
+            return None
+        entry_id = ids[best]
+        entry = self._entries[entry_id]
+        self._entries.move_to_end(entry_id)
+        self.hits += 1
+        return entry.answer
+
+    def store(self, scope: str, vector, answer: dict[str, Any]) -> None:
+        self._remove_expired()
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = AnswerCacheEntry(scope, normalize(vector), answer, time.monotonic())
+        self._created[entry_id] = None
+        self._scope_ids.setdefault(scope, []).append(entry_id)
+        self._scope_matrix.pop(scope, None)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._scope_ids.clear()
+        self._scope_matrix.clear()
+        self._created.clear()
+
+    def _remove_expired(self) -> None:
+        now = time.monotonic()
+        while self._created:
+            entry_id = next(iter(self._created))
+            if now - self._entries[entry_id].created <= self.ttl:
+                break
+            self._remove(entry_id)
+
+    def _remove(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id)
+        del self._created[entry_id]
+        ids = self._scope_ids[entry.scope]
+        ids.remove(entry_id)
+        if not ids:
+            del self._scope_ids[entry.scope]
+        self._scope_matrix.pop(entry.scope, None)
+
+
+def normalize(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
@@ -0,0 +1,315 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, NamedTuple, Optional
+
+from aiofiles import open as async_open
+from azure.storage.blob.aio import BlobClient
+from quart import Request, Response
+from quart.wrappers.response import FileBody, ResponseBody
+from werkzeug.datastructures import ContentRange
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+
+
+def resolve_range(begin: int, end: Optional[int], size: int) -> tuple[int, int]:
+    # "bytes=-500"처럼 끝에서부터 지정한 범위는 begin이 음수로 들어온다.
+    if begin < 0:
+        begin = max(size + begin, 0)
+    end = size if end is None else min(end, size)
+    if begin >= end:
+        raise RequestedRangeNotSatisfiable(length=size)
+    return begin, end
+
+
+async def make_conditional(response: Response, request: Request, size: int) -> Response:
+    """
+    Apply the Range and If-None-Match/If-Modified-Since headers of `request` to `response` (206, 304 or 416).
+    """
+    response = await response.make_conditional(request, accept_ranges=True, complete_length=size)
+    if response.status_code == 206:
+        # Quart 0.19는 포함 범위의 끝 값을 ContentRange에 넘겨서 헤더가 1바이트 짧게 나온다.
+        response.content_range = ContentRange("bytes", response.response.begin, response.response.end, size)
+    return response
+
+
+class BlobStreamBody(ResponseBody):
+    """
+      A response body that streams a blob (or a byte range of it) chunk by chunk instead of buffering it in memory.
+      The download starts only when the response is sent, so 304 and 416 responses never read the blob.
+      """
+
+    def __init__(self, blob_client: BlobClient, size: int):
+        self.blob_client = blob_client
+        self.size = size
+        self.begin = 0
+        self.end = size
+        self._chunks = None
+
+    async def make_conditional(self, begin: int, end: Optional[int]) -> int:
+        self.begin, self.end = resolve_range(begin, end, self.size)
+        return self.size
+
+    async def __aenter__(self) -> "BlobStreamBody":
+        downloader = await self.blob_client.download_blob(offset=self.begin, length=self.end - self.begin)
+        self._chunks = downloader.chunks()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb) -> None:
+        self._chunks = None
+
+    def __aiter__(self) -> "BlobStreamBody":
+        return self
+
+    async def __anext__(self) -> bytes:
+        return await self._chunks.__anext__()
+
+
+class CachedFileBody(FileBody):
+    async def make_conditional(self, begin: int, end: Optional[int]) -> int:
+        self.begin, self.end = resolve_range(begin, end, self.size)
+        return self.size
+
+
+class CachingBlobBody(BlobStreamBody):
+    """
+      Streams a whole blob to the response and writes the same chunks to the cache, so the first byte is sent
+      without waiting for the download to finish. The file is added to the cache only when the download completes;
+      if another request of this worker is already caching the blob, the blob is only streamed.
+      """
+
+    def __init__(self, cache: "BlobCache", name: str, blob_client: BlobClient, etag: str, last_modified: datetime, content_type: str, size: int):
+        super().__init__(blob_client, size)
+        self.cache = cache
+        self.name = name
+        self.metadata = (etag, last_modified, content_type, size)
+        self._temp_path: Optional[str] = None
+        self._file = None
+
+    async def __aenter__(self) -> "CachingBlobBody":
+        await super().__aenter__()
+        # Range 요청으로 일부만 받는 경우에는 캐시하지 않는다.
+        if (self.begin, self.end) == (0, self.size):
+            self._temp_path = self.cache.begin_fill(self.name)
+            if self._temp_path:
+                self._file = await async_open(self._temp_path, "wb")
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb) -> None:
+        if self._file is not None:
+            # 다운로드가 끝나기 전에 끊긴 경우
+            await self._file.close()
+            self._file = None
+            self.cache.abort_fill(self.name, self._temp_path)
+        await super().__aexit__(exc_type, exc_value, tb)
+
+    async def __anext__(self) -> bytes:
+        try:
+            chunk = await super().__anext__()
+        except StopAsyncIteration:
+            if self._file is not None:
+                await self._file.close()
+                self._file = None
+                self.cache.commit_fill(self.name, self._temp_path, *self.metadata)
+            raise
+        if self._file is not None:
+            await self._file.write(chunk)
+        return chunk
+
+
+class CachedBlob(NamedTuple):
+    file_path: str
+    etag: str
+    last_modified: datetime
+    content_type: str
+    size: int
+    validated: float
+
+
+class BlobCache:
+    """
+      A size-bounded on-disk LRU of blobs served by /content (the page PDFs cited in answers).
+      Each blob is stored as `<sha256 of name>.blob` with a `.json` sidecar holding its ETag, Last-Modified and content type,
+      so the cache survives worker restarts and is shared by the gunicorn workers of one instance.
+      The directory is the source of truth: a blob cached by one worker is found by the others, every hit touches the file,
+      and eviction scans the whole directory, so the total size stays under `max_bytes` across workers.
+      Attributes:
+          directory (str): The cache directory.
+          max_bytes (int): The maximum total size of cached blobs. The least recently used blob is evicted first.
+          max_file_bytes (int): Larger blobs are not cached but streamed from storage.
+          ttl (float): Seconds a cached blob is served without asking storage whether its ETag changed.
+          eviction_grace (float): Blobs used this recently are not evicted, so a file is never removed between a hit and
+              the response opening it.
+          hits (int), misses (int): Lookup counters.
+      """
+
+    def __init__(self, directory: str, max_bytes: int = 256 * 1024 * 1024, max_file_bytes: int = 16 * 1024 * 1024, ttl: float = 3600, eviction_grace: float = 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.ttl = ttl
+        self.eviction_grace = eviction_grace
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        self._files = 0
+        # 이 워커에서 캐시에 쓰는 중인 블롭
+        self._filling: set[str] = set()
+        self._tasks: set[asyncio.Task] = set()
+        os.makedirs(directory, exist_ok=True)
+        self._evict()
+
+    def stats(self) -> dict[str, Any]:
+        return {"hits": self.hits, "misses": self.misses, "entries": self._files, "bytes": self._size}
+
+    def accepts(self, size: int) -> bool:
+        return size <= self.max_file_bytes and size <= self.max_bytes
+
+    def get(self, name: str) -> Optional[CachedBlob]:
+        # 다른 워커가 같은 블롭을 새 버전으로 바꿨을 수 있으므로 메타데이터는 매번 디스크에서 읽는다.
+        entry = self._read_metadata(name)
+        if entry is not None:
+            try:
+                # LRU 순서는 워커 사이에서도 공유되도록 파일의 수정 시각으로 기록한다.
+                os.utime(entry.file_path)
+            except FileNotFoundError:
+                # 다른 워커가 지운 파일
+                entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def is_fresh(self, entry: CachedBlob) -> bool:
+        return time.time() - entry.validated <= self.ttl
+
+    def revalidate(self, name: str) -> Optional[CachedBlob]:
+        entry = self._read_metadata(name)
+        if entry is None:
+            return None
+        entry = entry._replace(validated=time.time())
+        self._write_metadata(name, entry)
+        return entry
+
+    def begin_fill(self, name: str) -> Optional[str]:
+        """
+        Returns a new temporary file to download `name` into, or None if this worker is already downloading it.
+        """
+        if name in self._filling:
+            return None
+        self._filling.add(name)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        return temp_path
+
+    def commit_fill(self, name: str, temp_path: str, etag: str, last_modified: datetime, content_type: str, size: int) -> CachedBlob:
+        self._filling.discard(name)
+        file_path = self._file_path(name)
+        os.replace(temp_path, file_path)
+        entry = CachedBlob(file_path, etag, last_modified, content_type, size, time.time())
+        self._write_metadata(name, entry)
+        self._evict()
+        return entry
+
+    def abort_fill(self, name: str, temp_path: str) -> None:
+        self._filling.discard(name)
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+
+    async def put(self, name: str, blob_client: BlobClient, etag: str, last_modified: datetime, content_type: str, size: int) -> Optional[CachedBlob]:
+        """
+        Downloads a blob into the cache. Returns None if this worker is already downloading it.
+        """
+        temp_path = self.begin_fill(name)
+        if temp_path is None:
+            return None
+        try:
+            downloader = await blob_client.download_blob()
+            async with async_open(temp_path, "wb") as f:
+                async for chunk in downloader.chunks():
+                    await f.write(chunk)
+        except BaseException:
+            self.abort_fill(name, temp_path)
+            raise
+        return self.commit_fill(name, temp_path, etag, last_modified, content_type, size)
+
+    def put_in_background(self, name: str, blob_client: BlobClient, etag: str, last_modified: datetime, content_type: str, size: int) -> None:
+        # Range 요청처럼 응답과 함께 받을 수 없는 경우에 사용한다.
+        if name in self._filling:
+            return
+        task = asyncio.create_task(self.put(name, blob_client, etag, last_modified, content_type, size))
+        self._tasks.add(task)
+        task.add_done_callback(self._on_put_done)
+
+    def _on_put_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning("Failed to cache content: %s", task.exception())
+
+    def _file_path(self, name: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(name.encode()).hexdigest() + ".blob")
+
+    def _metadata_path(self, file_path: str) -> str:
+        return file_path[:-len(".blob")] + ".json"
+
+    def _write_metadata(self, name: str, entry: CachedBlob) -> None:
+        metadata = {"name": name, "etag": entry.etag, "last_modified": entry.last_modified.isoformat(), "content_type": entry.content_type, "size": entry.size, "validated": entry.validated}
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(metadata, f, ensure_ascii=False)
+        os.replace(temp_path, self._metadata_path(entry.file_path))
+
+    def _read_metadata(self, name: str) -> Optional[CachedBlob]:
+        file_path = self._file_path(name)
+        try:
+            with open(self._metadata_path(file_path), encoding="utf-8") as f:
+                metadata = json.load(f)
+            return CachedBlob(file_path, metadata["etag"], datetime.fromisoformat(metadata["last_modified"]), metadata["content_type"], metadata["size"], metadata["validated"])
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning("Ignoring content cache entry %s: %s", name, e)
+            return None
+
+    def _evict(self) -> None:
+        # 모든 워커가 캐시한 파일을 합쳐서 크기를 계산하고, 가장 오래 사용하지 않은 파일부터 지운다.
+        now = time.time()
+        files = []
+        for file_name in os.listdir(self.directory):
+            path = os.path.join(self.directory, file_name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if file_name.endswith(".blob"):
+                files.append((stat.st_mtime, stat.st_size, path))
+            elif file_name.endswith(".tmp") and now - stat.st_mtime > self.ttl:
+                # 다운로드 중에 종료된 워커가 남긴 임시 파일
+                self._remove_files(path)
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        count = len(files)
+        for mtime, size, path in files:
+            if total <= self.max_bytes:
+                break
+            if now - mtime <= self.eviction_grace:
+                continue
+            self._remove_files(path, self._metadata_path(path))
+            total -= size
+            count -= 1
+        self._size = total
+        self._files = count
+
+    def _remove_files(self, *paths: str) -> None:
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,176 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from collections import defaultdict
+from typing import Any, Optional
+
+
+class CosmosChatLogSink:
+    """
+      Writes chat log items to a Cosmos DB container, one transactional batch per partition key.
+      Works with the sync (azure.cosmos) and the async (azure.cosmos.aio) container; sync calls run in a thread.
+      Items are upserted, so a batch retried after a partial success (see ChatLogWriter) doesn't fail on the items already written.
+      SDK versions without transactional batch support (azure-cosmos < 4.6) fall back to one upsert_item per item.
+      """
+
+    def __init__(self, container: Any, partition_key_field: str = "chat_session_id"):
+        self.container = container
+        self.partition_key_field = partition_key_field
+
+    async def write(self, items: list[dict[str, Any]]) -> None:
+        partitions = defaultdict(list)
+        for item in items:
+            partitions[item[self.partition_key_field]].append(item)
+        if asyncio.iscoroutinefunction(self.container.upsert_item):
+            for partition_key, partition_items in partitions.items():
+                await self._write_async(partition_key, partition_items)
+        else:
+            await asyncio.to_thread(self._write_sync, partitions)
+
+    async def _write_async(self, partition_key: str, items: list[dict[str, Any]]) -> None:
+        if hasattr(self.container, "execute_item_batch"):
+            await self.container.execute_item_batch([("upsert", (item,)) for item in items], partition_key=partition_key)
+        else:
+            await asyncio.gather(*(self.container.upsert_item(item) for item in items))
+
+    def _write_sync(self, partitions: dict[str, list[dict[str, Any]]]) -> None:
+        for partition_key, items in partitions.items():
+            if hasattr(self.container, "execute_item_batch"):
+                self.container.execute_item_batch([("upsert", (item,)) for item in items], partition_key=partition_key)
+            else:
+                for item in items:
+                    self.container.upsert_item(item)
+
+
+class SqliteChatLogSink:
+    """
+      Writes chat log items to a local SQLite file. A stand-in for Cosmos DB in development and tests.
+      """
+
+    def __init__(self, path: str):
+        self.path = path
+        with sqlite3.connect(path) as db:
+            db.execute("CREATE TABLE IF NOT EXISTS chat_logs (id TEXT PRIMARY KEY, chat_session_id TEXT, timestamp TEXT, item TEXT)")
+
+    async def write(self, items: list[dict[str, Any]]) -> None:
+        await asyncio.to_thread(self._write_sync, items)
+
+    def _write_sync(self, items: list[dict[str, Any]]) -> None:
+        with sqlite3.connect(self.path) as db:
+            db.executemany(
+                "INSERT OR REPLACE INTO chat_logs (id, chat_session_id, timestamp, item) VALUES (?, ?, ?, ?)",
+                [(item["id"], item.get("chat_session_id"), item.get("timestamp"), json.dumps(item, ensure_ascii=False)) for item in items]
+            )
+
+    def read_all(self) -> list[dict[str, Any]]:
+        with sqlite3.connect(self.path) as db:
+            return [json.loads(row[0]) for row in db.execute("SELECT item FROM chat_logs ORDER BY timestamp")]
+
+
+class ChatLogWriter:
+    """
+      A write-behind queue for chat log items, so a chat turn never waits for the log store.
+      Items are written in batches of up to `batch_size` items, at the latest `flush_interval` seconds after the first
+      item of the batch was queued. A failed batch is retried up to `max_retries` times with exponential backoff.
+      Backpressure:
+          The queue holds at most `max_queue` items. `submit` drops the item when the queue is full; `put` waits up to
+          `put_timeout` seconds for space first. Drops and failed items are counted in `stats()`.
+      Methods:
+          submit(self, item: dict): Queues an item without waiting. Returns False if it was dropped.
+          put(self, item: dict): Queues an item, waiting for space up to `put_timeout` seconds.
+          close(self): Writes the queued items and stops the writer. Called from close_clients.
+      """
+
+    def __init__(self, sink: Any, max_queue: int = 10000, batch_size: int = 100, flush_interval: float = 1.0, put_timeout: float = 0.1, max_retries: int = 3, retry_backoff: float = 0.5):
+        self.sink = sink
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+    def submit(self, item: dict[str, Any]) -> bool:
+        queue = self._start()
+        try:
+            queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logging.warning("Chat log queue is full, dropping item %s", item.get("id"))
+            return False
+
+    async def put(self, item: dict[str, Any]) -> bool:
+        queue = self._start()
+        try:
+            await asyncio.wait_for(queue.put(item), self.put_timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.dropped += 1
+            logging.warning("Chat log queue is full, dropping item %s", item.get("id"))
+            return False
+
+    async def close(self, timeout: float = 10) -> None:
+        if self._task is None:
+            return
+        # 남은 항목을 모두 쓴 뒤 작업을 멈춘다.
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Chat log flush timed out, %d items not written", self._queue.qsize())
+        self._task.cancel()
+        self._task = None
+
+    def _start(self) -> asyncio.Queue:
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.max_queue)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return self._queue
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._write(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    async def _write(self, batch: list[dict[str, Any]]) -> None:
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.sink.write(batch)
+                self.written += len(batch)
+                self.batches += 1
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    self.failed += len(batch)
+                    logging.exception("Writing %d chat log items failed: %s", len(batch), e)
+                    return
+                await asyncio.sleep(self.retry_backoff * 2 ** attempt)
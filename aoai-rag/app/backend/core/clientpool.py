@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import time
+from abc import ABC, abstractmethod
+from types import SimpleNamespace
+from typing import Any
+
+import aiohttp
+import httpx
+from azure.core.pipeline.transport import AioHttpTransport
+
+
+class ConnectionPool(ABC):
+    """
+      A connection pool to one upstream service with utilization and wait time gauges.
+      The wait time of a request is measured from the moment it is handed to the pool until its headers are written
+      to a connection, so it includes both waiting for a free connection and opening a new one (DNS, TCP, TLS).
+      Attributes:
+          name (str): The upstream name shown in the stats.
+          url (str): The upstream endpoint. Used for warm-up.
+          size (int): The maximum number of connections.
+          keepalive (float): Seconds an idle connection is kept open.
+      Methods:
+          warm_up(self, connections: int): Opens connections before the first request.
+          stats(self): Returns the gauges.
+          close(self): Closes every connection.
+      """
+
+    def __init__(self, name: str, url: str, size: int, keepalive: float):
+        self.name = name
+        self.url = url
+        self.size = size
+        self.keepalive = keepalive
+        self.requests = 0
+        self.waiting = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @abstractmethod
+    def in_use(self) -> int:
+        ...
+
+    def request_started(self) -> float:
+        self.waiting += 1
+        return time.monotonic()
+
+    def connection_acquired(self, started: float) -> None:
+        wait = time.monotonic() - started
+        self.waiting -= 1
+        self.requests += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    def stats(self) -> dict[str, Any]:
+        in_use = self.in_use()
+        return {
+            "size": self.size,
+            "in_use": in_use,
+            "utilization": in_use / self.size if self.size else 0,
+            "waiting": self.waiting,
+            "requests": self.requests,
+            "wait_avg_ms": self.wait_total / self.requests * 1000 if self.requests else 0,
+            "wait_max_ms": self.wait_max * 1000,
+        }
+
+    async def warm_up(self, connections: int) -> None:
+        # 응답 상태는 상관없다. 연결(DNS, TCP, TLS)을 미리 열어서 keep-alive로 유지하는 것이 목적이다.
+        results = await asyncio.gather(*(self._get(self.url) for _ in range(min(connections, self.size))), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logging.warning("Connection warm-up of %s failed: %r", self.name, result)
+
+    @abstractmethod
+    async def _get(self, url: str) -> None:
+        ...
+
+    @abstractmethod
+    async def close(self) -> None:
+        ...
+
+
+class HttpxConnectionPool(ConnectionPool):
+    """
+      A pool for the OpenAI SDK. Pass `http_client` to AsyncAzureOpenAI.
+      """
+
+    def __init__(self, name: str, url: str, size: int, keepalive: float, timeout: float = 600):
+        super().__init__(name, url, size, keepalive)
+        self.transport = httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=size, max_keepalive_connections=size, keepalive_expiry=keepalive))
+        self.http_client = httpx.AsyncClient(transport=self.transport, timeout=timeout, event_hooks={"request": [self._trace_request]})
+
+    async def _trace_request(self, request: httpx.Request) -> None:
+        started = self.request_started()
+        acquired = False
+
+        async def trace(event_name: str, info: dict) -> None:
+            nonlocal acquired
+            if not acquired and event_name.endswith("send_request_headers.started"):
+                acquired = True
+                self.connection_acquired(started)
+            elif not acquired and event_name.endswith(".failed"):
+                acquired = True
+                self.waiting -= 1
+
+        request.extensions["trace"] = trace
+
+    def in_use(self) -> int:
+        # httpcore의 연결 목록(transport._pool)은 공개 API가 아니므로 없거나 형태가 바뀌었으면 0으로 본다.
+        pool = getattr(self.transport, "_pool", None)
+        connections = getattr(pool, "connections", None) or []
+        return sum(1 for connection in connections if hasattr(connection, "is_idle") and not connection.is_idle())
+
+    async def _get(self, url: str) -> None:
+        response = await self.http_client.get(url)
+        await response.aclose()
+
+    async def close(self) -> None:
+        await self.http_client.aclose()
+
+
+class AioHttpConnectionPool(ConnectionPool):
+    """
+      A pool for the Azure SDK clients (AI Search, Blob Storage). Pass `transport` to the client.
+      """
+
+    def __init__(self, name: str, url: str, size: int, keepalive: float, dns_cache_ttl: int = 300):
+        super().__init__(name, url, size, keepalive)
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_request_headers_sent.append(self._on_request_headers_sent)
+        trace_config.on_request_exception.append(self._on_request_exception)
+        self.connector = aiohttp.TCPConnector(limit=size, keepalive_timeout=keepalive, ttl_dns_cache=dns_cache_ttl)
+        self.session = aiohttp.ClientSession(connector=self.connector, trace_configs=[trace_config])
+        self.transport = AioHttpTransport(session=self.session, session_owner=False)
+
+    async def _on_request_start(self, session: aiohttp.ClientSession, context: SimpleNamespace, params: Any) -> None:
+        context.started = self.request_started()
+
+    async def _on_request_headers_sent(self, session: aiohttp.ClientSession, context: SimpleNamespace, params: Any) -> None:
+        if getattr(context, "started", None) is not None:
+            self.connection_acquired(context.started)
+            context.started = None
+
+    async def _on_request_exception(self, session: aiohttp.ClientSession, context: SimpleNamespace, params: Any) -> None:
+        if getattr(context, "started", None) is not None:
+            self.waiting -= 1
+            context.started = None
+
+    def in_use(self) -> int:
+        # aiohttp 커넥터는 사용 중인 연결 수를 공개하지 않으므로 내부 집합(_acquired)을 읽고, 없거나 형태가 바뀌었으면 0으로 본다.
+        acquired = getattr(self.connector, "_acquired", None)
+        try:
+            return len(acquired) if acquired is not None else 0
+        except TypeError:
+            return 0
+
+    async def _get(self, url: str) -> None:
+        async with self.session.get(url) as response:
+            await response.read()
+
+    async def close(self) -> None:
+        await self.session.close()
@@ -0,0 +1,148 @@
+import re
+from typing import Any, Callable, Optional
+
+from .searchcache import SearchHit
+
+# scripts/prepdocs.py의 create_sections가 만드는 문서 ID("{file_id}-page-{섹션 번호}")
+SECTION_ID = re.compile(r"-page-(\d+)$")
+
+
+def section_number(hit: SearchHit) -> Optional[int]:
+    match = SECTION_ID.search(hit.id) if hit.sourcefile else None
+    return int(match.group(1)) if match else None
+
+
+def overlap_length(left: str, right: str, max_chars: int, min_chars: int) -> int:
+    """
+    Return the length of the longest suffix of `left` that is also a prefix of `right`, or 0 if it is shorter than `min_chars`.
+    """
+    for length in range(min(max_chars, len(left), len(right)), min_chars - 1, -1):
+        if left.endswith(right[:length]):
+            return length
+    return 0
+
+
+class ContextPacker:
+    """
+      Packs search hits into the prompt's source budget.
+      1. Hits of consecutive sections of the same source file (see scripts/prepdocs.py split_text) share up to SECTION_OVERLAP
+         characters. The shared text is removed, and neighbors on the same source page are merged into one source.
+      2. Hits are added in rank order while their token count fits in the budget; hits that don't fit are left out.
+         A merged source that doesn't fit is split back into its hits, which are then added the same way, highest rank first.
+      The budget is the token limit minus the tokens of the rest of the prompt, measured by the caller when it can.
+      Callers trim the chat history to the token limit minus source_reserve(), so a long history can't take the room of the sources.
+      Attributes:
+          count_tokens (Callable): Returns the token count of each text in a list.
+          max_tokens (int): The maximum number of tokens used for sources.
+          reserve_tokens (int): Tokens left for the system prompt, the question and the chat history; the rest of the token limit,
+              up to max_tokens, is kept for the sources.
+          max_overlap_chars (int), min_overlap_chars (int): The range of overlap lengths searched between neighbors.
+      Methods:
+          source_reserve(self, token_limit: int): Returns the tokens kept for the sources before the chat history is trimmed.
+          pack(self, hits: list, token_limit: int, use_captions: bool, prompt_tokens: int): Returns the hits to put in the prompt, in rank order.
+      """
+
+    def __init__(self, count_tokens: Callable[[list[str]], list[int]], max_tokens: int = 4000, reserve_tokens: int = 2048, max_overlap_chars: int = 500, min_overlap_chars: int = 20):
+        self.count_tokens = count_tokens
+        self.max_tokens = max_tokens
+        self.reserve_tokens = reserve_tokens
+        self.max_overlap_chars = max_overlap_chars
+        self.min_overlap_chars = min_overlap_chars
+        self.merged = 0
+        self.deduplicated_chars = 0
+        self.dropped = 0
+        self.unmerged = 0
+
+    def stats(self) -> dict[str, Any]:
+        return {"merged": self.merged, "deduplicated_chars": self.deduplicated_chars, "dropped": self.dropped, "unmerged": self.unmerged}
+
+    def source_reserve(self, token_limit: int) -> int:
+        return max(0, min(self.max_tokens, token_limit - self.reserve_tokens))
+
+    def budget(self, token_limit: Optional[int], prompt_tokens: Optional[int] = None) -> int:
+        if token_limit is None:
+            return self.max_tokens
+        if prompt_tokens is None:
+            return self.source_reserve(token_limit)
+        return min(self.max_tokens, token_limit - prompt_tokens)
+
+    def pack(self, hits: list[SearchHit], token_limit: Optional[int] = None, use_captions: bool = False, prompt_tokens: Optional[int] = None) -> list[SearchHit]:
+        # 캡션은 문서의 일부만 발췌한 것이므로 겹친 부분을 합치지 않고 같은 문서만 한 번씩 남긴다.
+        sources = [(hit, None) for hit in self.dedupe(hits)] if use_captions else self._merge_neighbors(hits)
+        texts = [" . ".join(hit.captions) if use_captions else hit.content for hit, _ in sources]
+        budget = self.budget(token_limit, prompt_tokens)
+        packed = []
+        used = 0
+        for (hit, parts), count in zip(sources, self.count_tokens(texts)):
+            if used + count <= budget:
+                packed.append(hit)
+                used += count
+            elif parts:
+                # 합친 출처가 예산을 넘으면 합치기 전의 히트로 나눠서 높은 순위부터 들어가는 만큼 넣는다.
+                for part, part_count in zip(parts, self.count_tokens([part.content for part in parts])):
+                    if used + part_count <= budget:
+                        packed.append(part)
+                        used += part_count
+                        self.unmerged += 1
+                    else:
+                        self.dropped += 1
+            else:
+                self.dropped += 1
+        return packed
+
+    def dedupe(self, hits: list[SearchHit]) -> list[SearchHit]:
+        seen = set()
+        unique = []
+        for hit in hits:
+            key = hit.id or (hit.sourcepage, hit.content)
+            if key not in seen:
+                seen.add(key)
+                unique.append(hit)
+        return unique
+
+    def merge_neighbors(self, hits: list[SearchHit]) -> list[SearchHit]:
+        return [hit for hit, _ in self._merge_neighbors(hits)]
+
+    def _merge_neighbors(self, hits: list[SearchHit]) -> list[tuple[SearchHit, Optional[list[SearchHit]]]]:
+        """
+        Return the sources in rank order, each with the hits merged into it in rank order (None if nothing was merged).
+        """
+        hits = self.dedupe(hits)
+        # 각 출처는 그 출처에 합쳐진 히트 중 가장 높은 순위의 위치에 놓는다.
+        ranked: list[tuple[int, SearchHit, Optional[list[SearchHit]]]] = []
+        by_file: dict[str, list[tuple[int, int, SearchHit]]] = {}
+        for rank, hit in enumerate(hits):
+            number = section_number(hit)
+            if number is None:
+                ranked.append((rank, hit, None))
+            else:
+                by_file.setdefault(hit.sourcefile, []).append((number, rank, hit))
+
+        for sections in by_file.values():
+            sections.sort(key=lambda section: section[0])
+            previous_number, rank, current = sections[0]
+            parts = [(rank, current)]
+            for number, next_rank, hit in sections[1:]:
+                if number == previous_number + 1:
+                    overlap = overlap_length(current.content, hit.content, self.max_overlap_chars, self.min_overlap_chars)
+                    self.deduplicated_chars += overlap
+                    if hit.sourcepage == current.sourcepage:
+                        separator = "" if overlap else " "
+                        current = current._replace(content=current.content + separator + hit.content[overlap:], captions=current.captions + hit.captions)
+                        parts.append((next_rank, hit))
+                        rank = min(rank, next_rank)
+                        self.merged += 1
+                        previous_number = number
+                        continue
+                    hit = hit._replace(content=hit.content[overlap:])
+                ranked.append((rank, current, self._ranked_parts(parts)))
+                previous_number, rank, current = number, next_rank, hit
+                parts = [(rank, current)]
+            ranked.append((rank, current, self._ranked_parts(parts)))
+
+        ranked.sort(key=lambda item: item[0])
+        return [(hit, parts) for _, hit, parts in ranked]
+
+    @staticmethod
+    def _ranked_parts(parts: list[tuple[int, SearchHit]]) -> Optional[list[SearchHit]]:
+        return [hit for _, hit in sorted(parts, key=lambda part: part[0])] if len(parts) > 1 else None
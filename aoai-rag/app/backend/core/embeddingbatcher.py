@@ -0,0 +1,118 @@
+import asyncio
+import time
+from typing import Any, NamedTuple, Optional
+
+import numpy as np
+from openai import AsyncOpenAI
+
+
+def estimate_tokens(text: str) -> int:
+    # 배치 크기 제한에만 쓰므로 토크나이저 대신 보수적으로 추정한다(한글은 글자당 3바이트, 대략 1~2토큰).
+    return len(text.encode("utf-8")) // 2 + 1
+
+
+class PendingEmbedding(NamedTuple):
+    text: str
+    future: asyncio.Future
+    enqueued: float
+
+
+class EmbeddingBatcher:
+    """
+      Collects embedding requests from concurrent requests and sends them as one `embeddings.create` call.
+      A text is sent right away when no batch is in flight, so a lone request waits for nothing. Texts that arrive
+      while a batch is in flight are collected and sent when it returns, `window_ms` after the first of them arrived,
+      or as soon as they hold `max_batch_size` texts or `max_batch_tokens` estimated tokens. Identical texts in a batch
+      are sent once.
+      Attributes:
+          openai_client (AsyncOpenAI): The client used to compute embeddings.
+          deployment (str): The embedding model deployment.
+          batches (int), inputs (int): Counters of sent batches and the texts they held.
+      Methods:
+          embed(self, text: str): Returns the embedding of `text` as a float32 array.
+          stats(self): Returns the average batch fill and the queueing delay added by the window.
+      """
+
+    def __init__(self, openai_client: AsyncOpenAI, deployment: str, window_ms: float = 5, max_batch_size: int = 16, max_batch_tokens: int = 8000):
+        self.openai_client = openai_client
+        self.deployment = deployment
+        self.window_ms = window_ms
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.batches = 0
+        self.inputs = 0
+        self.delay_total = 0.0
+        self.delay_max = 0.0
+        self._pending: list[PendingEmbedding] = []
+        self._pending_tokens = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "inputs": self.inputs,
+            "batch_fill": self.inputs / self.batches / self.max_batch_size if self.batches else 0,
+            "queue_delay_avg_ms": self.delay_total / self.inputs * 1000 if self.inputs else 0,
+            "queue_delay_max_ms": self.delay_max * 1000,
+        }
+
+    async def embed(self, text: str) -> np.ndarray:
+        tokens = estimate_tokens(text)
+        if self._pending and self._pending_tokens + tokens > self.max_batch_tokens:
+            self.flush()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(PendingEmbedding(text, future, time.monotonic()))
+        self._pending_tokens += tokens
+        if not self._tasks or len(self._pending) >= self.max_batch_size or self._pending_tokens >= self.max_batch_tokens:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window_ms / 1000, self.flush)
+        return await future
+
+    def flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending, self._pending_tokens = self._pending, [], 0
+        task = asyncio.create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(lambda task: self._on_sent(task, batch))
+
+    def _on_sent(self, task: asyncio.Task, batch: list[PendingEmbedding]) -> None:
+        self._tasks.discard(task)
+        # 배치가 시작되기 전이나 도중에 취소되어도 대기자가 멈춰 있지 않게 한다.
+        for pending in batch:
+            if not pending.future.done():
+                pending.future.cancel()
+        # 앞의 배치를 기다리는 동안 모인 텍스트는 창이 끝나기를 기다리지 않고 보낸다.
+        if not self._tasks and self._pending:
+            self.flush()
+
+    async def _send(self, batch: list[PendingEmbedding]) -> None:
+        sent = time.monotonic()
+        self.batches += 1
+        self.inputs += len(batch)
+        for pending in batch:
+            delay = sent - pending.enqueued
+            self.delay_total += delay
+            self.delay_max = max(self.delay_max, delay)
+
+        texts = list(dict.fromkeys(pending.text for pending in batch))
+        vectors: dict[str, np.ndarray] = {}
+        error: Exception = LookupError("the embeddings response has no vector for the input")
+        try:
+            embedding = await self.openai_client.embeddings.create(model=self.deployment, input=texts)
+            # 응답의 data는 index 순서가 보장되지 않으므로 index로 입력과 맞춘다.
+            vectors = {texts[item.index]: np.asarray(item.embedding, dtype=np.float32) for item in embedding.data}
+        except Exception as e:
+            error = e
+        for pending in batch:
+            if pending.future.done():
+                continue
+            if pending.text in vectors:
+                pending.future.set_result(vectors[pending.text])
+            else:
+                pending.future.set_exception(error)
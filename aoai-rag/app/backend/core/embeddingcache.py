@@ -0,0 +1,140 @@
+import asyncio
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+
+import numpy as np
+from openai import AsyncOpenAI
+
+from core.embeddingbatcher import EmbeddingBatcher
+
+
+def normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class EmbeddingCache:
+    """
+      A query embedding cache shared by all approaches.
+      Vectors are kept as float32 arrays in an LRU bounded by `max_bytes`. If `disk_path` is set, vectors are
+      also written to a SQLite file so that a new worker (e.g. after gunicorn's max_requests recycling) starts warm.
+      The file is shared by the workers, so it is read in a thread and written behind the response, never on the event loop.
+      Concurrent misses for the same text wait for one computation.
+      Attributes:
+          openai_client (AsyncOpenAI): The client used on a cache miss.
+          deployment (str): The embedding model deployment. Part of the cache key.
+          batcher (EmbeddingBatcher): If set, misses are sent through it so concurrent misses share one API call.
+          hits (int), disk_hits (int), misses (int): Lookup counters.
+      Methods:
+          embed(self, text: str): Returns the embedding of `text` as a float32 array.
+      """
+
+    def __init__(self, openai_client: AsyncOpenAI, deployment: str, max_bytes: int = 64 * 1024 * 1024, disk_path: Optional[str] = None, batcher: Optional[EmbeddingBatcher] = None):
+        self.openai_client = openai_client
+        self.deployment = deployment
+        self.batcher = batcher
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._size = 0
+        self._vectors: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._writes: set[asyncio.Task] = set()
+        # 스레드 사이에서 연결 하나를 같이 쓰므로 한 번에 하나의 스레드만 사용한다.
+        self._db_lock = threading.Lock()
+        self._db = None
+        if disk_path:
+            try:
+                self._db = sqlite3.connect(disk_path, timeout=5, check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+                self._db.commit()
+            except sqlite3.Error as e:
+                logging.exception(e)
+                self._db = None
+
+    def stats(self) -> dict[str, Any]:
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses, "entries": len(self._vectors), "bytes": self._size}
+
+    def key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.deployment}\n{normalize_text(text)}".encode()).hexdigest()
+
+    async def embed(self, text: str) -> np.ndarray:
+        key = self.key(text)
+        vector = self._vectors.get(key)
+        if vector is not None:
+            self._vectors.move_to_end(key)
+            self.hits += 1
+            return vector
+
+        # 같은 텍스트를 기다리는 요청들이 한 번의 계산을 공유한다. 먼저 온 요청이 취소되어도 계산은 계속된다.
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key, text))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, key: str, text: str) -> np.ndarray:
+        vector = await asyncio.to_thread(self._read_disk, key) if self._db is not None else None
+        if vector is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            vector = await self.compute(text)
+            if self._db is not None:
+                task = asyncio.create_task(asyncio.to_thread(self._write_disk, key, vector))
+                self._writes.add(task)
+                task.add_done_callback(self._writes.discard)
+        self._put(key, vector)
+        return vector
+
+    async def compute(self, text: str) -> np.ndarray:
+        if self.batcher is not None:
+            return await self.batcher.embed(text)
+        embedding = await self.openai_client.embeddings.create(
+            model=self.deployment,
+            input=text
+        )
+        return np.asarray(embedding.data[0].embedding, dtype=np.float32)
+
+    def _put(self, key: str, vector: np.ndarray) -> None:
+        self._vectors[key] = vector
+        self._size += vector.nbytes
+        while self._size > self.max_bytes and self._vectors:
+            _, evicted = self._vectors.popitem(last=False)
+            self._size -= evicted.nbytes
+
+    def _read_disk(self, key: str) -> Optional[np.ndarray]:
+        if self._db is None:
+            return None
+        try:
+            with self._db_lock:
+                row = self._db.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            logging.exception(e)
+            return None
+        return np.frombuffer(row[0], dtype=np.float32) if row else None
+
+    def _write_disk(self, key: str, vector: np.ndarray) -> None:
+        if self._db is None:
+            return
+        try:
+            with self._db_lock:
+                self._db.execute("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", (key, vector.tobytes()))
+                self._db.commit()
+        except sqlite3.Error as e:
+            logging.exception(e)
+
+    async def close(self) -> None:
+        # 아직 쓰지 않은 벡터를 모두 쓴 뒤에 닫는다.
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -0,0 +1,201 @@
+import csv
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional, Union
+
+# 공백과 문장 부호를 지우고 대소문자를 무시한 키로 "최충헌 " → "최충헌", "Cafe-Moderate" → "cafemoderate"처럼 찾는다.
+NORMALIZE_PATTERN = re.compile(r"[\W_]+")
+MIN_PREFIX_LENGTH = 2
+INSERT_BATCH_SIZE = 10000
+
+
+def normalize_key(key: str) -> str:
+    return NORMALIZE_PATTERN.sub("", key).casefold()
+
+
+def format_row(row: dict[str, str]) -> str:
+    return "\n".join([f"{i}:{row[i]}" for i in row])
+
+
+class CsvLookupEngine:
+    """
+      A key lookup over a CSV file, shared by the lookup tools (CafeSearchTool, CsvLookupTool).
+      Rows are loaded once into a SQLite file keyed by `key_field`, so even a CSV with millions of rows only costs the
+      SQLite page cache in the worker. The file is reused by later workers while the CSV's mtime and size are unchanged.
+      Matching:
+          1. the exact key
+          2. the normalized key (punctuation and whitespace removed, casefolded)
+          3. the longest key that is a prefix of the normalized query ("최충헌의 카페" → "최충헌")
+          4. the shortest key that starts with the normalized query ("최충" → "최충헌")
+      Reload:
+          The CSV's mtime is checked at most every `check_interval` seconds. When it changed, the new file is loaded into
+          a new SQLite file in a background thread and swapped in; lookups keep using the old rows meanwhile.
+      """
+
+    def __init__(self, filename: Union[str, Path], key_field: str, db_path: Optional[str] = None, check_interval: float = 30, fuzzy: bool = True):
+        self.filename = str(filename)
+        self.key_field = key_field
+        self.check_interval = check_interval
+        self.fuzzy = fuzzy
+        if db_path is None:
+            digest = hashlib.sha256(f"{os.path.abspath(self.filename)}\n{key_field}\n{fuzzy}".encode()).hexdigest()[:16]
+            directory = os.path.join(tempfile.gettempdir(), "aoai-rag-lookup")
+            os.makedirs(directory, exist_ok=True)
+            db_path = os.path.join(directory, f"{digest}.sqlite")
+        self.db_path = db_path
+        self.reloads = 0
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._source: Optional[tuple[float, int]] = None
+        self._checked = 0.0
+        self._reloading = False
+
+    def stats(self) -> dict[str, Any]:
+        return {"filename": self.filename, "rows": self._count(), "reloads": self.reloads}
+
+    def lookup(self, key: str) -> str:
+        if self._db is None:
+            with self._load_lock:
+                if self._db is None:
+                    self._load()
+        else:
+            self._check_for_changes()
+        with self._lock:
+            value = self._query("SELECT value FROM rows WHERE key = ?", (key,))
+            if value is not None or not self.fuzzy:
+                return value or ""
+            normalized = normalize_key(key)
+            if not normalized:
+                return ""
+            for end in range(len(normalized), MIN_PREFIX_LENGTH - 1, -1):
+                value = self._query("SELECT value FROM rows WHERE norm = ? ORDER BY key LIMIT 1", (normalized[:end],))
+                if value is not None:
+                    return value
+            if len(normalized) >= MIN_PREFIX_LENGTH:
+                value = self._query("SELECT value FROM rows WHERE norm > ? AND norm < ? ORDER BY length(norm), key LIMIT 1", (normalized, normalized + "\U0010ffff"))
+            return value or ""
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _query(self, sql: str, parameters: tuple) -> Optional[str]:
+        row = self._db.execute(sql, parameters).fetchone()
+        return row[0] if row else None
+
+    def _count(self) -> int:
+        if self._db is None:
+            return 0
+        with self._lock:
+            return self._db.execute("SELECT count(*) FROM rows").fetchone()[0]
+
+    def _source_version(self) -> tuple[float, int]:
+        stat = os.stat(self.filename)
+        return stat.st_mtime, stat.st_size
+
+    def _check_for_changes(self) -> None:
+        now = time.monotonic()
+        if self._reloading or now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            source = self._source_version()
+        except OSError as e:
+            logging.warning("Lookup source %s is not readable: %s", self.filename, e)
+            return
+        if source != self._source:
+            self._reloading = True
+            threading.Thread(target=self._reload, daemon=True).start()
+
+    def _reload(self) -> None:
+        try:
+            with self._load_lock:
+                self._load()
+            self.reloads += 1
+        except Exception:
+            logging.exception("Reloading %s failed", self.filename)
+        finally:
+            self._reloading = False
+
+    def _load(self) -> None:
+        source = self._source_version()
+        db = self._open_existing(source)
+        if db is None:
+            temp_path = f"{self.db_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                self._build(temp_path, source)
+                os.replace(temp_path, self.db_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            db = sqlite3.connect(self.db_path, check_same_thread=False)
+        with self._lock:
+            old, self._db = self._db, db
+            self._source = source
+            self._checked = time.monotonic()
+        if old is not None:
+            old.close()
+
+    def _open_existing(self, source: tuple[float, int]) -> Optional[sqlite3.Connection]:
+        if not os.path.exists(self.db_path):
+            return None
+        try:
+            db = sqlite3.connect(self.db_path, check_same_thread=False)
+            row = db.execute("SELECT value FROM meta WHERE name = 'source'").fetchone()
+        except sqlite3.Error:
+            return None
+        if row and row[0] == repr(source):
+            return db
+        db.close()
+        return None
+
+    def _build(self, path: str, source: tuple[float, int]) -> None:
+        db = sqlite3.connect(path)
+        try:
+            db.execute("PRAGMA journal_mode = OFF")
+            db.execute("PRAGMA synchronous = OFF")
+            db.execute("CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)")
+            # 읽기 시작하기 전의 mtime과 크기를 기록한다. 읽는 동안 CSV가 바뀌었으면 다음 확인에서 다시 읽는다.
+            db.execute("INSERT INTO meta (name, value) VALUES ('source', ?)", (repr(source),))
+            db.execute("CREATE TABLE rows (key TEXT PRIMARY KEY, norm TEXT, value TEXT) WITHOUT ROWID")
+            with open(self.filename, newline='', encoding='utf-8') as csvfile:
+                reader = csv.DictReader(csvfile)
+                batch = []
+                for row in reader:
+                    key = row[self.key_field]
+                    batch.append((key, normalize_key(key), format_row(row)))
+                    if len(batch) >= INSERT_BATCH_SIZE:
+                        db.executemany("INSERT OR REPLACE INTO rows (key, norm, value) VALUES (?, ?, ?)", batch)
+                        batch = []
+                db.executemany("INSERT OR REPLACE INTO rows (key, norm, value) VALUES (?, ?, ?)", batch)
+            if self.fuzzy:
+                db.execute("CREATE INDEX rows_norm ON rows (norm)")
+            db.commit()
+        finally:
+            db.close()
+
+
+_engines: dict[tuple[str, str], CsvLookupEngine] = {}
+_engines_lock = threading.Lock()
+
+
+def get_lookup_engine(filename: Union[str, Path], key_field: str) -> CsvLookupEngine:
+    """
+    Return the engine of `filename` keyed by `key_field`, shared by every tool in the worker.
+    """
+    key = (os.path.abspath(filename), key_field)
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = _engines[key] = CsvLookupEngine(filename, key_field)
+        return engine
@@ -1,4 +1,11 @@
-from .modelhelper import num_tokens_from_messages
+from bisect import bisect_right
+from itertools import accumulate
+from typing import Optional
+
+from .modelhelper import num_tokens_from_messages_batch, token_count_cache
+
+# trim_history가 처음에 세는 턴 수. 이후 배치마다 두 배로 늘린다.
+TRIM_HISTORY_FIRST_BATCH = 8
 
 
 class MessageBuilder:
@@ -8,18 +15,80 @@ class MessageBuilder:
           message (list): A list of dictionaries representing chat messages.
           model (str): The name of the ChatGPT model.
           token_count (int): The total number of tokens in the conversation.
+          static_token_counts (dict): Precomputed token counts keyed by (role, content), see modelhelper.count_static_tokens.
       Methods:
-          __init__(self, system_content: str, chatgpt_model: str): Initializes the MessageBuilder instance.
-          append_message(self, role: str, content: str, index: int = 1): Appends a new message to the conversation.
+          __init__(self, system_content: str, chatgpt_model: str, static_token_counts: dict = None): Initializes the MessageBuilder instance.
+          append_message(self, role: str, content: str, index: int = 1, token_count: int = None): Appends a new message to the conversation.
+          append_messages(self, messages: list, token_count: int = None): Appends messages to the end of the conversation, in order.
       """
 
-    def __init__(self, system_content: str, chatgpt_model: str):
+    def __init__(self, system_content: str, chatgpt_model: str, static_token_counts: Optional[dict[tuple[str, str], int]] = None):
         self.messages = [{'role': 'system', 'content': system_content}]
         self.model = chatgpt_model
-        self.token_length = num_tokens_from_messages(
-            self.messages[-1], self.model)
+        self.static_token_counts = static_token_counts or {}
+        self.token_length = self.count_tokens(self.messages[-1])
 
-    def append_message(self, role: str, content: str, index: int = 1):
+    def append_message(self, role: str, content: str, index: int = 1, token_count: Optional[int] = None):
         self.messages.insert(index, {'role': role, 'content': content})
-        self.token_length += num_tokens_from_messages(
-            self.messages[index], self.model)
+        self.token_length += token_count if token_count is not None else self.count_tokens(self.messages[index])
+
+    def append_messages(self, messages: list[dict[str, str]], token_count: Optional[int] = None):
+        self.messages.extend(messages)
+        self.token_length += token_count if token_count is not None else sum(self.count_tokens(message) for message in messages)
+
+    def count_tokens(self, message: dict[str, str]) -> int:
+        token_count = self.static_token_counts.get((message['role'], message['content']))
+        if token_count is None:
+            token_count = num_tokens_from_messages_batch([message], self.model, token_count_cache)[0]
+        return token_count
+
+
+def trim_history(history: list[dict[str, str]], model: str, max_tokens: int) -> tuple[list[dict[str, str]], int]:
+    """
+    Select the most recent chat turns that fit in `max_tokens`.
+    Turns are counted newest first in batches of doubling size (TRIM_HISTORY_FIRST_BATCH turns first) until the budget is exceeded,
+    so a long history is not tokenized beyond about twice what is kept. Every message is counted once (or read from the worker's
+    token count cache) and the cut point is found with a binary search over the cumulative token counts of the turns.
+    A turn is either kept whole or dropped, so the result never exceeds the budget.
+    Args:
+        history (list): Chat turns ({"user": ..., "bot": ...}), oldest first. A turn may carry the token counts of its messages
+            for `model` as "user_tokens" and "bot_tokens" (see core.sessionstore); those messages are not counted again.
+        model (str): The name of the model to use for encoding.
+        max_tokens (int): The token budget of the history.
+    Returns:
+        tuple: The kept messages, oldest first, and their token count.
+    """
+    turns = []
+    message_counts = []
+    turn_counts = []
+    total = 0
+    batch_size = TRIM_HISTORY_FIRST_BATCH
+    while len(turns) < len(history) and total <= max_tokens:
+        batch = range(len(turns), min(len(turns) + batch_size, len(history)))
+        for i in batch:
+            h = history[-1 - i]
+            turn = []
+            counts = []
+            if user_msg := h.get("user"):
+                turn.append({'role': 'user', 'content': user_msg})
+                counts.append(h.get("user_tokens"))
+            if bot_msg := h.get("bot"):
+                turn.append({'role': 'assistant', 'content': bot_msg})
+                counts.append(h.get("bot_tokens"))
+            turns.append(turn)
+            message_counts.append(counts)
+        # 세션 저장소의 턴처럼 토큰 수가 이미 있는 메시지는 다시 세지 않는다.
+        missing = [(i, j) for i in batch for j, count in enumerate(message_counts[i]) if count is None]
+        if missing:
+            counted = num_tokens_from_messages_batch([turns[i][j] for i, j in missing], model, token_count_cache)
+            for (i, j), count in zip(missing, counted):
+                message_counts[i][j] = count
+        for i in batch:
+            turn_counts.append(sum(message_counts[i]))
+            total += turn_counts[-1]
+        batch_size *= 2
+
+    cumulative_counts = list(accumulate(turn_counts))
+    kept = bisect_right(cumulative_counts, max_tokens)
+    messages = [message for turn in reversed(turns[:kept]) for message in turn]
+    return messages, cumulative_counts[kept - 1] if kept else 0
@@ -0,0 +1,154 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Iterator
+
+from azure.core.pipeline import PipelineRequest
+from azure.core.pipeline.policies import SansIOHTTPPolicy
+from openai import AsyncOpenAI
+from opentelemetry import metrics as otel_metrics
+from opentelemetry import trace
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+
+def format_labels(label_names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(label_names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...]):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, labels: tuple[str, ...], amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{format_labels(self.label_names, labels)} {value}" for labels, value in self.values.items())
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, label_names: tuple[str, ...], buckets: tuple[float, ...]):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        # labels -> (bucket counts, +Inf 포함), sum
+        self.values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, labels: tuple[str, ...], value: float) -> None:
+        if labels not in self.values:
+            self.values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = self.values[labels]
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {total[0]}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+
+class Metrics:
+    """
+      Latency of each pipeline stage, prompt token counts and upstream retries of the worker.
+      Values are recorded with the OpenTelemetry API, so they are exported to Azure Monitor when configure_azure_monitor()
+      has set up the providers; that export is where the values of all workers add up.
+      The in-process copy behind /metrics only covers the worker that serves the request, for debugging that worker.
+      Methods:
+          stage(self, approach: str, stage: str): Context manager that times a stage in a span and the stage histogram.
+          observe_stage(self, approach: str, stage: str, seconds: float): Records a stage timed by the caller (e.g. time to first token).
+          observe_prompt_tokens(self, approach: str, stage: str, tokens: int): Records the tokens sent to the chat model.
+          count_retry(self, upstream: str): Counts a retried upstream request.
+          render(self): Returns all values in the Prometheus text exposition format.
+      """
+
+    def __init__(self):
+        self.stage_seconds = Histogram("rag_stage_duration_seconds", "Duration of each pipeline stage.", ("approach", "stage"), DURATION_BUCKETS)
+        self.prompt_tokens = Histogram("rag_prompt_tokens", "Prompt tokens sent to the chat model per call.", ("approach", "stage"), TOKEN_BUCKETS)
+        self.upstream_retries = Counter("rag_upstream_retries_total", "Retried requests to upstream services.", ("upstream",))
+        # 프로바이더가 설정되기 전에 만든 계측기도 configure_azure_monitor() 이후에는 실제 프로바이더로 기록된다.
+        meter = otel_metrics.get_meter(__name__)
+        self._tracer = trace.get_tracer(__name__)
+        self._otel_stage_seconds = meter.create_histogram("rag.stage.duration", unit="s", description=self.stage_seconds.help)
+        self._otel_prompt_tokens = meter.create_histogram("rag.prompt.tokens", unit="{token}", description=self.prompt_tokens.help)
+        self._otel_upstream_retries = meter.create_counter("rag.upstream.retries", description=self.upstream_retries.help)
+
+    @contextmanager
+    def stage(self, approach: str, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        with self._tracer.start_as_current_span(f"{approach}.{stage}"):
+            try:
+                yield
+            finally:
+                self.observe_stage(approach, stage, time.perf_counter() - start)
+
+    def observe_stage(self, approach: str, stage: str, seconds: float) -> None:
+        self.stage_seconds.observe((approach, stage), seconds)
+        self._otel_stage_seconds.record(seconds, {"approach": approach, "stage": stage})
+
+    def observe_prompt_tokens(self, approach: str, stage: str, tokens: int) -> None:
+        self.prompt_tokens.observe((approach, stage), tokens)
+        self._otel_prompt_tokens.record(tokens, {"approach": approach, "stage": stage})
+
+    def count_retry(self, upstream: str) -> None:
+        self.upstream_retries.inc((upstream,))
+        self._otel_upstream_retries.add(1, {"upstream": upstream})
+
+    def render(self) -> str:
+        lines = [*self.stage_seconds.render(), *self.prompt_tokens.render(), *self.upstream_retries.render()]
+        return "\n".join(lines) + "\n"
+
+
+# 워커 안의 모든 요청이 공유하는 지표
+metrics = Metrics()
+
+
+class RetryCountingPolicy(SansIOHTTPPolicy):
+    """
+    Counts retries of an Azure SDK client (AI Search, Blob Storage). Pass it as per_retry_policies, so it runs once per attempt.
+    """
+
+    def __init__(self, upstream: str, metrics: Metrics = metrics):
+        self.upstream = upstream
+        self.metrics = metrics
+
+    def on_request(self, request: PipelineRequest) -> None:
+        attempt = request.context.get("metrics_attempt", 0) + 1
+        request.context["metrics_attempt"] = attempt
+        if attempt > 1:
+            self.metrics.count_retry(self.upstream)
+
+
+def count_openai_retries(client: AsyncOpenAI, upstream: str, metrics: Metrics = metrics) -> None:
+    """
+    Counts the retries of an OpenAI SDK client. The SDK calls _retry_request only when it is going to send the request again,
+    so the last failed response, after the SDK gave up, is not counted.
+    """
+    retry_request = client._retry_request
+
+    def count_retry(*args, **kwargs):
+        metrics.count_retry(upstream)
+        return retry_request(*args, **kwargs)
+
+    client._retry_request = count_retry
@@ -1,5 +1,10 @@
 from __future__ import annotations
 
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any
+
 import tiktoken
 
 MODELS_2_TOKEN_LIMITS = {
@@ -37,13 +42,115 @@ def num_tokens_from_messages(message: dict[str, str], model: str) -> int:
         num_tokens_from_messages(message, model)
         output: 11
     """
-    encoding = tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+    encoding = get_encoding(model)
     num_tokens = 2  # For "role" and "content" keys
     for key, value in message.items():
         num_tokens += len(encoding.encode(value))
     return num_tokens
 
 
+def num_tokens_from_messages_batch(messages: list[dict[str, str]], model: str, cache: TokenCountCache | None = None) -> list[int]:
+    """
+    Calculate the number of tokens required to encode each message, encoding all of them in one batch.
+    Args:
+        messages (list): The messages to encode.
+        model (str): The name of the model to use for encoding.
+        cache (TokenCountCache): If set, only the messages missing from the cache are encoded.
+    Returns:
+        list: The number of tokens of each message, in the same order as `messages`.
+    """
+    counts: list[int | None] = [None] * len(messages)
+    keys = []
+    if cache is not None:
+        keys = [cache.key(message, model) for message in messages]
+        counts = [cache.get(key) for key in keys]
+    missing = [i for i, count in enumerate(counts) if count is None]
+
+    values = [value for i in missing for value in messages[i].values()]
+    encoded = get_encoding(model).encode_batch(values) if values else []
+    position = 0
+    for i in missing:
+        counts[i] = 2 + sum(len(tokens) for tokens in encoded[position:position + len(messages[i])])
+        position += len(messages[i])
+        if cache is not None:
+            cache.put(keys[i], counts[i])
+    return counts
+
+
+def num_tokens_from_texts(texts: list[str], model: str) -> list[int]:
+    """
+    Calculate the number of tokens of each text (without the message overhead), encoding all of them in one batch.
+    """
+    return [len(tokens) for tokens in get_encoding(model).encode_batch(texts)] if texts else []
+
+
+def count_static_tokens(messages: list[dict[str, str]], model: str) -> dict[tuple[str, str], int]:
+    """
+    Count the tokens of prompt fragments that never change (system prompts, few-shots) once,
+    so that MessageBuilder doesn't tokenize them again on every request.
+    Returns:
+        dict: The token count of each message keyed by (role, content).
+    """
+    return {(message["role"], message["content"]): count for message, count in zip(messages, num_tokens_from_messages_batch(messages, model))}
+
+
+class TokenCountCache:
+    """
+      A bounded LRU of message token counts keyed by a blake2b hash of the model and the message.
+      The frontend sends the whole history on every /chat turn, so with one cache per worker each old message
+      is tokenized once instead of on every turn (twice per turn: query rewrite and answer prompts).
+      Attributes:
+          max_entries (int): The maximum number of counts kept. The least recently used count is evicted first.
+          hits (int), misses (int): Lookup counters.
+      """
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._counts: OrderedDict[bytes, int] = OrderedDict()
+
+    def stats(self) -> dict[str, Any]:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._counts)}
+
+    @staticmethod
+    def key(message: dict[str, str], model: str) -> bytes:
+        digest = hashlib.blake2b(model.encode(), digest_size=16)
+        for key, value in message.items():
+            digest.update(b"\0" + key.encode() + b"\0" + value.encode())
+        return digest.digest()
+
+    def get(self, key: bytes) -> int | None:
+        count = self._counts.get(key)
+        if count is None:
+            self.misses += 1
+            return None
+        self._counts.move_to_end(key)
+        self.hits += 1
+        return count
+
+    def put(self, key: bytes, count: int) -> None:
+        self._counts[key] = count
+        self._counts.move_to_end(key)
+        while len(self._counts) > self.max_entries:
+            self._counts.popitem(last=False)
+
+    def clear(self) -> None:
+        self._counts.clear()
+
+
+# 워커 안의 모든 요청이 공유하는 토큰 수 캐시
+token_count_cache = TokenCountCache()
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """
+    Return the tiktoken encoding of a model. Encodings are created once per process and shared.
+    """
+    return tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+
+
 def get_oai_chatmodel_tiktok(aoaimodel: str) -> str:
     message = "Expected Azure OpenAI ChatGPT model name"
     if aoaimodel == "" or aoaimodel is None:
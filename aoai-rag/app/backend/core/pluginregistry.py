@@ -0,0 +1,129 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, NamedTuple, Optional
+
+import aiohttp
+from langchain.tools import AIPluginTool
+from langchain_community.tools.plugin import AIPlugin, marshal_spec
+
+
+class CachedDocument(NamedTuple):
+    text: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+
+def build_plugin_tool(manifest: str, spec: str) -> AIPluginTool:
+    # AIPluginTool.from_plugin_url과 같은 툴을 만들지만 HTTP 요청은 하지 않는다.
+    plugin = AIPlugin(**json.loads(manifest))
+    description = (
+        f"Call this tool to get the OpenAPI spec (and usage guide) "
+        f"for interacting with the {plugin.name_for_human} API. "
+        f"You should only call this ONCE! What is the "
+        f"{plugin.name_for_human} API useful for? "
+    ) + plugin.description_for_human
+    api_spec = (
+        f"Usage Guide: {plugin.description_for_model}\n\n"
+        f"OpenAPI Spec: {marshal_spec(spec)}"
+    )
+    return AIPluginTool(name=plugin.name_for_model, description=description, plugin=plugin, api_spec=api_spec)
+
+
+class PluginEntry:
+    def __init__(self, url: str):
+        self.url = url
+        self.tool: Optional[AIPluginTool] = None
+        self.manifest: Optional[CachedDocument] = None
+        self.spec: Optional[CachedDocument] = None
+        self.spec_url: Optional[str] = None
+        self.expires = 0.0
+        self.error: Optional[str] = None
+        self.refreshing: Optional[asyncio.Task] = None
+
+
+class PluginRegistry:
+    """
+      Keeps the AI plugin tools (manifest + OpenAPI spec) in memory so requests don't fetch them over HTTP.
+      All plugins are fetched concurrently by `prefetch` at startup. After `ttl` seconds an entry is revalidated in the
+      background with If-None-Match/If-Modified-Since while requests keep using the cached tool.
+      A plugin that is down is left out of `tools()` (or served from its last good copy) and retried after
+      `retry_interval` seconds, so the agent runs with the plugins that are up instead of failing the request.
+      Attributes:
+          plugin_urls (list[str]): The URLs of the plugin manifests (/.well-known/ai-plugin.json).
+          fetches (int), not_modified (int), failures (int): HTTP counters.
+      """
+
+    def __init__(self, plugin_urls: list[str], ttl: float = 300, retry_interval: float = 30, timeout: float = 5):
+        self.plugin_urls = plugin_urls
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+        self.fetches = 0
+        self.not_modified = 0
+        self.failures = 0
+        self._entries = {url: PluginEntry(url) for url in plugin_urls}
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "fetches": self.fetches,
+            "not_modified": self.not_modified,
+            "failures": self.failures,
+            "plugins": {entry.url: {"available": entry.tool is not None, "error": entry.error} for entry in self._entries.values()},
+        }
+
+    async def prefetch(self) -> None:
+        await asyncio.gather(*(self.refresh(entry) for entry in self._entries.values()))
+
+    def tools(self) -> list[AIPluginTool]:
+        now = time.monotonic()
+        for entry in self._entries.values():
+            if now >= entry.expires and entry.refreshing is None:
+                entry.refreshing = asyncio.create_task(self.refresh(entry))
+        return [entry.tool for entry in self._entries.values() if entry.tool is not None]
+
+    async def refresh(self, entry: PluginEntry) -> None:
+        try:
+            manifest = await self._get(entry.url, entry.manifest)
+            spec_url = json.loads(manifest.text)["api"]["url"]
+            spec = await self._get(spec_url, entry.spec if spec_url == entry.spec_url else None)
+            # 두 문서 모두 304(Not Modified)면 만들어 둔 툴을 그대로 쓴다.
+            if entry.tool is None or manifest is not entry.manifest or spec is not entry.spec:
+                entry.tool = build_plugin_tool(manifest.text, spec.text)
+            entry.manifest, entry.spec, entry.spec_url = manifest, spec, spec_url
+            entry.error = None
+            entry.expires = time.monotonic() + self.ttl
+        except Exception as e:
+            self.failures += 1
+            entry.error = repr(e)
+            entry.expires = time.monotonic() + self.retry_interval
+            logging.warning("Plugin %s is unavailable: %r", entry.url, e)
+        finally:
+            entry.refreshing = None
+
+    async def _get(self, url: str, cached: Optional[CachedDocument]) -> CachedDocument:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        headers = {}
+        if cached is not None:
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+        async with self._session.get(url, headers=headers) as response:
+            if response.status == 304 and cached is not None:
+                self.not_modified += 1
+                return cached
+            response.raise_for_status()
+            self.fetches += 1
+            return CachedDocument(await response.text(), response.headers.get("ETag"), response.headers.get("Last-Modified"))
+
+    async def close(self) -> None:
+        for entry in self._entries.values():
+            if entry.refreshing is not None:
+                entry.refreshing.cancel()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
@@ -0,0 +1,152 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, NamedTuple, Optional
+
+import numpy as np
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import QueryType, VectorizedQuery
+
+
+class SearchHit(NamedTuple):
+    sourcepage: str
+    content: str
+    captions: tuple[str, ...]
+    # 같은 파일의 이웃 섹션을 찾는 데 사용한다(core.contextpacker).
+    sourcefile: str = ""
+    id: str = ""
+
+
+class SearchCache:
+    """
+      A result cache in front of `SearchClient.search`.
+      Results are projected to (sourcepage, content, captions, sourcefile, id) tuples and keyed by the query text, a hash of the
+      query vector, the filter, top and the semantic ranker/captions flags.
+      Attributes:
+          ttl (float): Seconds a result stays valid.
+          max_entries (int): The maximum number of cached results. The least recently used result is evicted first.
+          hits (int), misses (int): Lookup counters.
+      Methods:
+          search(self, ...): Returns the cached hits or runs the search.
+          invalidate(self): Drops every cached result and calls `on_invalidate`. Called when the index content changes.
+          start(self), close(self): Start and stop polling the index version.
+      Index version:
+          If `index_version` is set, it is polled every `version_check_interval` seconds after start(), and the cache is
+          invalidated when the returned value changes. A cached result is only served when the version was checked within
+          the interval; otherwise the version is checked first. scripts/prepdocs.py bumps this version after indexing.
+          `on_invalidate` drops what was derived from the old results, e.g. AnswerCache.clear.
+      """
+
+    def __init__(self, search_client: SearchClient, sourcepage_field: str, content_field: str, ttl: float = 300, max_entries: int = 1000,
+                 index_version: Optional[Callable[[], Awaitable[Optional[str]]]] = None, version_check_interval: float = 30,
+                 on_invalidate: Optional[Callable[[], None]] = None):
+        self.search_client = search_client
+        self.sourcepage_field = sourcepage_field
+        self.content_field = content_field
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.index_version = index_version
+        self.version_check_interval = version_check_interval
+        self.on_invalidate = on_invalidate
+        self.hits = 0
+        self.misses = 0
+        self._results: OrderedDict[tuple, tuple[float, list[SearchHit]]] = OrderedDict()
+        # invalidate()가 호출될 때마다 증가한다. 그 전에 시작한 검색의 결과는 저장하지 않는다.
+        self._generation = 0
+        self._current_version: Optional[str] = None
+        self._version_checked = float("-inf")
+        self._version_task: Optional[asyncio.Task] = None
+        self._poll_task: Optional[asyncio.Task] = None
+
+    def stats(self) -> dict[str, Any]:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._results)}
+
+    def invalidate(self) -> None:
+        self._generation += 1
+        self._results.clear()
+        if self.on_invalidate:
+            self.on_invalidate()
+
+    def start(self) -> None:
+        if self.index_version is not None and self._poll_task is None:
+            self._poll_task = asyncio.create_task(self.poll_index_version())
+
+    async def close(self) -> None:
+        if self._poll_task:
+            self._poll_task.cancel()
+            self._poll_task = None
+
+    async def poll_index_version(self) -> None:
+        # 검색 요청이 없어도 간격의 절반마다 인덱스 버전을 확인해서, 요청이 확인을 기다리는 일이 없도록 한다.
+        while True:
+            await self.check_index_version(self.version_check_interval / 2)
+            await asyncio.sleep(self.version_check_interval / 2)
+
+    async def check_index_version(self, max_age: Optional[float] = None) -> None:
+        max_age = self.version_check_interval if max_age is None else max_age
+        if self.index_version is None or time.monotonic() - self._version_checked < max_age:
+            return
+        # 동시에 들어온 요청은 같은 확인을 함께 기다린다.
+        if self._version_task is None:
+            self._version_checked = time.monotonic()
+            self._version_task = asyncio.create_task(self.refresh_index_version())
+        await asyncio.shield(self._version_task)
+
+    async def refresh_index_version(self) -> None:
+        try:
+            version = await self.index_version()
+        except Exception as e:
+            logging.exception(e)
+            return
+        finally:
+            self._version_task = None
+        if version != self._current_version:
+            self._current_version = version
+            self.invalidate()
+
+    async def search(self, query_text: Optional[str], query_vector: Optional[list[float]], filter: Optional[str], top: int,
+                     use_semantic_ranker: bool = False, use_semantic_captions: bool = False) -> list[SearchHit]:
+        await self.check_index_version()
+        vector_hash = hashlib.sha1(np.asarray(query_vector, dtype=np.float32).tobytes()).hexdigest() if query_vector else None
+        key = (query_text, vector_hash, filter, top, bool(use_semantic_ranker), bool(use_semantic_captions))
+        cached = self._results.get(key)
+        if cached and time.monotonic() - cached[0] <= self.ttl:
+            self._results.move_to_end(key)
+            self.hits += 1
+            return cached[1]
+
+        self.misses += 1
+        generation = self._generation
+        hits = await self._search(query_text, query_vector, filter, top, use_semantic_ranker, use_semantic_captions)
+        if generation != self._generation:
+            return hits
+        self._results[key] = (time.monotonic(), hits)
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+        return hits
+
+    async def _search(self, query_text: Optional[str], query_vector: Optional[list[float]], filter: Optional[str], top: int,
+                      use_semantic_ranker: bool, use_semantic_captions: bool) -> list[SearchHit]:
+        vector_queries = [VectorizedQuery(vector=query_vector, k_nearest_neighbors=top, fields="embedding")] if query_vector else None
+        if use_semantic_ranker:
+            r = await self.search_client.search(search_text=query_text,
+                                          filter=filter,
+                                          query_type=QueryType.SEMANTIC,
+                                          semantic_configuration_name="default",
+                                          top=top,
+                                          query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                                          vector_queries=vector_queries)
+        else:
+            r = await self.search_client.search(search_text=query_text,
+                                          filter=filter,
+                                          top=top,
+                                          vector_queries=vector_queries)
+        return [SearchHit(doc[self.sourcepage_field],
+                          doc[self.content_field],
+                          tuple(c.text for c in doc.get('@search.captions') or []) if use_semantic_captions else (),
+                          doc.get("sourcefile") or "",
+                          doc.get("id") or "")
+                async for doc in r]
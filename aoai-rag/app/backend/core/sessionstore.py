@@ -0,0 +1,214 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError,
+)
+
+
+class InMemorySessionBackend:
+    """
+      Keeps the turns of each chat session in the worker's memory.
+      Attributes:
+          max_sessions (int): The maximum number of sessions kept. The least recently used session is evicted first.
+          ttl (float): Seconds a session is kept after its last turn.
+      Methods:
+          get(self, session_id: str): Returns the turns of a session, oldest first, or None if the session is unknown or expired.
+          append(self, session_id: str, turn: dict, max_turns: int): Appends a turn, keeping only the last `max_turns` turns.
+          replace(self, session_id: str, turns: list, max_turns: int): Replaces the turns of a session.
+          delete(self, session_id: str): Forgets a session.
+      Other backends (see CosmosSessionBackend) implement the same async methods and stats(), and set `shared` to True
+      when all workers see the same sessions.
+      """
+
+    # 세션은 이 워커의 메모리에만 있으므로, 다른 워커나 재시작된 워커로 간 요청은 세션을 찾지 못한다.
+    shared = False
+
+    def __init__(self, max_sessions: int = 10000, ttl: float = 3600):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.evictions = 0
+        # session id -> (last update, turns)
+        self._sessions: OrderedDict[str, tuple[float, list[dict[str, Any]]]] = OrderedDict()
+
+    def stats(self) -> dict[str, Any]:
+        return {"sessions": len(self._sessions), "turns": sum(len(turns) for _, turns in self._sessions.values()), "evictions": self.evictions}
+
+    async def get(self, session_id: str) -> Optional[list[dict[str, Any]]]:
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return None
+        updated, turns = entry
+        if time.monotonic() - updated > self.ttl:
+            del self._sessions[session_id]
+            self.evictions += 1
+            return None
+        self._sessions.move_to_end(session_id)
+        return list(turns)
+
+    async def append(self, session_id: str, turn: dict[str, Any], max_turns: int) -> None:
+        entry = self._sessions.pop(session_id, None)
+        turns = entry[1] if entry and time.monotonic() - entry[0] <= self.ttl else []
+        turns.append(turn)
+        del turns[:-max_turns]
+        self._sessions[session_id] = (time.monotonic(), turns)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+
+    async def replace(self, session_id: str, turns: list[dict[str, Any]], max_turns: int) -> None:
+        self._sessions.pop(session_id, None)
+        for turn in turns[-max_turns:]:
+            await self.append(session_id, turn, max_turns)
+
+    async def delete(self, session_id: str) -> None:
+        self._sessions.pop(session_id, None)
+
+
+class CosmosSessionBackend:
+    """
+      Keeps the turns of each chat session in a Cosmos DB container (azure.cosmos.aio), so every worker sees the same sessions
+      and the client can send only the session id and the new message.
+      One item per session: {"id": session id, "turns": [...], "ttl": seconds}. The container needs "/id" as partition key
+      and time to live turned on (default TTL -1), so Cosmos DB deletes a session `ttl` seconds after its last turn.
+      Concurrent appends to one session are resolved with the item's ETag and retried.
+      """
+
+    shared = True
+
+    def __init__(self, container: Any, ttl: float = 3600, max_attempts: int = 3):
+        self.container = container
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.reads = 0
+        self.writes = 0
+        self.conflicts = 0
+
+    def stats(self) -> dict[str, Any]:
+        return {"reads": self.reads, "writes": self.writes, "conflicts": self.conflicts}
+
+    async def _read(self, session_id: str) -> Optional[dict[str, Any]]:
+        self.reads += 1
+        try:
+            return await self.container.read_item(item=session_id, partition_key=session_id)
+        except CosmosResourceNotFoundError:
+            return None
+
+    async def get(self, session_id: str) -> Optional[list[dict[str, Any]]]:
+        item = await self._read(session_id)
+        return item["turns"] if item else None
+
+    async def append(self, session_id: str, turn: dict[str, Any], max_turns: int) -> None:
+        for attempt in range(self.max_attempts):
+            item = await self._read(session_id)
+            turns = (item["turns"] if item else []) + [turn]
+            body = {"id": session_id, "turns": turns[-max_turns:], "ttl": int(self.ttl)}
+            try:
+                if item is None:
+                    await self.container.create_item(body)
+                else:
+                    await self.container.replace_item(item=session_id, body=body, etag=item["_etag"], match_condition=MatchConditions.IfNotModified)
+                self.writes += 1
+                return
+            except (CosmosAccessConditionFailedError, CosmosResourceExistsError):
+                # 다른 요청이 같은 세션을 먼저 바꿨으므로 다시 읽어서 붙인다.
+                self.conflicts += 1
+                if attempt == self.max_attempts - 1:
+                    raise
+
+    async def replace(self, session_id: str, turns: list[dict[str, Any]], max_turns: int) -> None:
+        await self.container.upsert_item({"id": session_id, "turns": turns[-max_turns:], "ttl": int(self.ttl)})
+        self.writes += 1
+
+    async def delete(self, session_id: str) -> None:
+        try:
+            await self.container.delete_item(item=session_id, partition_key=session_id)
+        except CosmosResourceNotFoundError:
+            pass
+
+
+class UnknownSessionError(Exception):
+    # 클라이언트는 전체 대화를 history에 담아 다시 보낸다. 서버는 그 대화로 세션을 다시 만든다.
+    code = "unknown_session"
+
+
+class SessionHistoryRequiredError(UnknownSessionError):
+    # 세션 백엔드가 워커 사이에 공유되지 않으므로 클라이언트는 이후의 턴에도 항상 history를 보내야 한다.
+    code = "history_required"
+
+
+class SessionStore:
+    """
+      Server-side chat sessions. Each turn is stored with the token counts of its messages, which trim_history uses
+      instead of tokenizing the history again on every turn.
+      With a shared backend the client sends only the session id and the new message, so the cost of a turn doesn't grow
+      with the conversation. Otherwise (or when the session is unknown or expired) it sends the whole history as well;
+      the stored turns are used only when they match the end of that history, and the session is stored again from it
+      when they don't.
+      Attributes:
+          backend: Where the turns are kept, see InMemorySessionBackend.
+          count_tokens (Callable): Returns the token count of each message in a list of chat messages.
+          max_turns (int): The maximum number of turns kept per session. Older turns are dropped.
+      Methods:
+          history(self, session_id: str, request_history: list, message: str): Returns the conversation in the format of the "history" request field.
+              Raises UnknownSessionError when no history is sent and the session is unknown or expired,
+              and SessionHistoryRequiredError when no history is sent and the backend isn't shared.
+          append(self, session_id: str, user: str, bot: str): Stores a finished turn.
+          delete(self, session_id: str): Forgets a session.
+      """
+
+    def __init__(self, backend: Any, count_tokens: Callable[[list[dict[str, str]]], list[int]], max_turns: int = 50):
+        self.backend = backend
+        self.count_tokens = count_tokens
+        self.max_turns = max_turns
+        self.reused = 0
+        self.mismatched = 0
+
+    def stats(self) -> dict[str, Any]:
+        return {**self.backend.stats(), "reused": self.reused, "mismatched": self.mismatched}
+
+    async def history(self, session_id: str, request_history: Optional[list[dict[str, Any]]] = None, message: Optional[str] = None) -> list[dict[str, Any]]:
+        turns = await self.backend.get(session_id)
+        if request_history is None:
+            if not self.backend.shared:
+                raise SessionHistoryRequiredError("history is required: sessions are not shared between workers")
+            if turns is None:
+                raise UnknownSessionError(f"unknown session: {session_id}")
+            return turns + [{"user": message}]
+        previous = request_history[:-1]
+        tail = previous[len(previous) - len(turns):] if turns else []
+        if turns and len(turns) == min(len(previous), self.max_turns) and all(
+            turn["user"] == sent.get("user") and turn["bot"] == sent.get("bot") for turn, sent in zip(turns, tail)
+        ):
+            self.reused += 1
+            return previous[:len(previous) - len(turns)] + turns + request_history[-1:]
+        if turns is not None:
+            self.mismatched += 1
+        # 없거나 다른 워커에서 처리된 턴이 빠진 세션은 보낸 대화로 다시 저장한다.
+        if previous:
+            await self.backend.replace(session_id, self.counted_turns(previous[-self.max_turns:]), self.max_turns)
+        elif turns is not None:
+            await self.backend.delete(session_id)
+        return request_history
+
+    def counted_turns(self, history: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        messages = []
+        for turn in history:
+            messages.append({"role": "user", "content": turn.get("user") or ""})
+            messages.append({"role": "assistant", "content": turn.get("bot") or ""})
+        counts = self.count_tokens(messages)
+        return [
+            {"user": turn.get("user") or "", "bot": turn.get("bot") or "", "user_tokens": counts[2 * i], "bot_tokens": counts[2 * i + 1]}
+            for i, turn in enumerate(history)
+        ]
+
+    async def append(self, session_id: str, user: str, bot: str) -> None:
+        turn, = self.counted_turns([{"user": user, "bot": bot}])
+        await self.backend.append(session_id, turn, self.max_turns)
+
+    async def delete(self, session_id: str) -> None:
+        await self.backend.delete(session_id)
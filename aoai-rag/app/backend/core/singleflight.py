@@ -0,0 +1,117 @@
+import asyncio
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, Optional
+
+
+class Flight:
+    """
+      One in-flight execution shared by every caller with the same key.
+      Streamed events are buffered so that a caller joining late first gets the prefix and then the live events.
+      """
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.events: list[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.callers = 0
+        self.updated = asyncio.Event()
+
+    def publish(self, event: Any) -> None:
+        self.events.append(event)
+        self.notify()
+
+    def notify(self) -> None:
+        # 기다리고 있는 구독자를 모두 깨우고 다음 이벤트를 위한 새 Event로 교체한다.
+        self.updated.set()
+        self.updated = asyncio.Event()
+
+
+class SingleFlight:
+    """
+      Coalesces concurrent calls with the same key into one execution.
+      The execution runs in its own task, so it is not tied to the request that started it. It is cancelled only when
+      every caller has gone away (e.g. all clients disconnected). A finished key is forgotten immediately: this is not a
+      cache, later calls run again.
+      Attributes:
+          executions (int): Calls that started an execution.
+          coalesced (int): Calls that joined an execution already in flight.
+      Methods:
+          run(self, key: str, fn): Awaits `fn()` once for all concurrent callers and returns its result to each of them.
+          stream(self, key: str, fn): Iterates `fn()` once and replays every event to each of the concurrent callers.
+      """
+
+    def __init__(self):
+        self.executions = 0
+        self.coalesced = 0
+        self._flights: dict[str, Flight] = {}
+
+    def stats(self) -> dict[str, Any]:
+        return {"executions": self.executions, "coalesced": self.coalesced, "in_flight": len(self._flights)}
+
+    async def run(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        flight = self._join(key)
+        if flight.task is None:
+            flight.task = asyncio.create_task(self._execute(key, flight, fn))
+        try:
+            # shield: 한 호출자가 취소돼도 다른 호출자가 기다리는 실행은 계속된다.
+            return await asyncio.shield(flight.task)
+        finally:
+            self._leave(flight)
+
+    async def stream(self, key: str, fn: Callable[[], AsyncIterator[Any]]) -> AsyncGenerator[Any, None]:
+        flight = self._join(key)
+        if flight.task is None:
+            flight.task = asyncio.create_task(self._execute_stream(key, flight, fn))
+        try:
+            i = 0
+            while True:
+                if i < len(flight.events):
+                    yield flight.events[i]
+                    i += 1
+                elif flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                else:
+                    await flight.updated.wait()
+        finally:
+            self._leave(flight)
+
+    def _join(self, key: str) -> Flight:
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = Flight()
+            self.executions += 1
+        else:
+            self.coalesced += 1
+        flight.callers += 1
+        return flight
+
+    def _leave(self, flight: Flight) -> None:
+        flight.callers -= 1
+        if flight.callers == 0 and not flight.done:
+            flight.task.cancel()
+
+    def _finish(self, key: str, flight: Flight) -> None:
+        flight.done = True
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def _execute(self, key: str, flight: Flight, fn: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            return await fn()
+        finally:
+            self._finish(key, flight)
+
+    async def _execute_stream(self, key: str, flight: Flight, fn: Callable[[], AsyncIterator[Any]]) -> None:
+        try:
+            async for event in fn():
+                flight.publish(event)
+        except BaseException as e:
+            flight.error = e
+            if not isinstance(e, asyncio.CancelledError):
+                return
+            raise
+        finally:
+            self._finish(key, flight)
+            flight.notify()
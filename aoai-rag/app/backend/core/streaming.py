@@ -0,0 +1,96 @@
+import asyncio
+import json
+import time
+from typing import Any, AsyncGenerator, AsyncIterator, Optional
+
+# lean 스트리밍 형식의 이벤트
+#   {"data_points": [...], "thoughts": "...", ...}  응답 문맥. 첫 번째로 한 번만 보낸다.
+#   {"delta": "..."}                               응답 텍스트 조각
+#   {"done": true, "finish_reason": "stop"}        마지막 이벤트
+
+
+def encode_delta(text: str) -> str:
+    return '{"delta":' + json.dumps(text, ensure_ascii=False) + '}\n'
+
+
+def encode_event(event: dict[str, Any]) -> str:
+    if len(event) == 1 and "delta" in event:
+        return encode_delta(event["delta"])
+    return json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+async def format_as_lean_ndjson(r: AsyncIterator[dict[str, Any]], coalesce_ms: float = 0, coalesce_bytes: int = 0) -> AsyncGenerator[str, None]:
+    """
+    Serialize lean streaming events as NDJSON.
+    If `coalesce_ms` or `coalesce_bytes` is set, consecutive deltas are merged into one event until the first buffered
+    delta is `coalesce_ms` old or the buffer reaches `coalesce_bytes` bytes (UTF-8), whichever comes first.
+    Other events flush the buffer, so their order relative to the deltas is kept.
+    """
+    if not coalesce_ms:
+        async for line in coalesce_by_bytes(r, coalesce_bytes):
+            yield line
+        return
+
+    buffer: list[str] = []
+    buffered_bytes = 0
+    deadline = 0.0
+    events = r.__aiter__()
+    pending: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(events.__anext__())
+            timeout = max(deadline - time.monotonic(), 0) if buffer and coalesce_ms else None
+            done, _ = await asyncio.wait((pending,), timeout=timeout)
+            if not done:
+                # 다음 조각이 오기 전에 시간 창이 끝났다.
+                yield encode_delta("".join(buffer))
+                buffer, buffered_bytes = [], 0
+                continue
+            try:
+                event = pending.result()
+            except StopAsyncIteration:
+                pending = None
+                break
+            pending = None
+
+            if len(event) == 1 and "delta" in event:
+                if not buffer:
+                    deadline = time.monotonic() + coalesce_ms / 1000
+                buffer.append(event["delta"])
+                buffered_bytes += len(event["delta"].encode())
+                if coalesce_bytes and buffered_bytes >= coalesce_bytes:
+                    yield encode_delta("".join(buffer))
+                    buffer, buffered_bytes = [], 0
+                continue
+
+            if buffer:
+                yield encode_delta("".join(buffer))
+                buffer, buffered_bytes = [], 0
+            yield encode_event(event)
+
+        if buffer:
+            yield encode_delta("".join(buffer))
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+async def coalesce_by_bytes(r: AsyncIterator[dict[str, Any]], coalesce_bytes: int) -> AsyncGenerator[str, None]:
+    # 시간 창이 없으면 다음 이벤트를 기다리는 동안 버퍼를 비울 일이 없으므로 태스크 없이 순서대로 처리한다.
+    buffer: list[str] = []
+    buffered_bytes = 0
+    async for event in r:
+        if coalesce_bytes and len(event) == 1 and "delta" in event:
+            buffer.append(event["delta"])
+            buffered_bytes += len(event["delta"].encode())
+            if buffered_bytes >= coalesce_bytes:
+                yield encode_delta("".join(buffer))
+                buffer, buffered_bytes = [], 0
+            continue
+        if buffer:
+            yield encode_delta("".join(buffer))
+            buffer, buffered_bytes = [], 0
+        yield encode_event(event)
+    if buffer:
+        yield encode_delta("".join(buffer))
@@ -0,0 +1,116 @@
+import asyncio
+import json
+from typing import Any, Optional
+
+import aiohttp
+import httpx
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForToolRun,
+    CallbackManagerForToolRun,
+)
+from langchain.tools import BaseTool
+from langchain_community.tools.requests.tool import (
+    RequestsDeleteTool,
+    RequestsGetTool,
+    RequestsPatchTool,
+    RequestsPostTool,
+    RequestsPutTool,
+)
+
+
+class AsyncHttpClient:
+    """
+      The HTTP client of the agent's requests tools. Requests share one keep-alive connection pool and never block
+      the event loop. Errors and timeouts are returned as text so the agent can react to them.
+      request_sync() serves agents run synchronously (e.g. AgentExecutor.run in a worker thread) with a separate httpx client.
+      Attributes:
+          timeout (float): Seconds allowed for each call.
+          max_response_chars (int): Longer responses are truncated before they are added to the prompt.
+      """
+
+    def __init__(self, session: Optional[aiohttp.ClientSession] = None, timeout: float = 10, max_response_chars: int = 10000, limit: int = 20, keepalive: float = 30):
+        self.timeout = timeout
+        self.max_response_chars = max_response_chars
+        self.limit = limit
+        self.keepalive = keepalive
+        self._session = session
+        self._owns_session = session is None
+        self._sync_client: Optional[httpx.Client] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=self.keepalive))
+        return self._session
+
+    async def request(self, method: str, url: str, data: Optional[dict[str, Any]] = None) -> str:
+        try:
+            async with self.session.request(method, url.strip("\"'"), json=data, timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+                text = await response.text()
+        except asyncio.TimeoutError:
+            return f"Request timed out after {self.timeout} seconds"
+        except aiohttp.ClientError as e:
+            return f"Request failed: {e!r}"
+        return text[:self.max_response_chars]
+
+    @property
+    def sync_client(self) -> httpx.Client:
+        if self._sync_client is None:
+            self._sync_client = httpx.Client(limits=httpx.Limits(max_connections=self.limit, keepalive_expiry=self.keepalive))
+        return self._sync_client
+
+    def request_sync(self, method: str, url: str, data: Optional[dict[str, Any]] = None) -> str:
+        # 이벤트 루프를 멈추므로 이벤트 루프 밖의 스레드에서만 호출한다.
+        try:
+            text = self.sync_client.request(method, url.strip("\"'"), json=data, timeout=self.timeout).text
+        except httpx.TimeoutException:
+            return f"Request timed out after {self.timeout} seconds"
+        except httpx.HTTPError as e:
+            return f"Request failed: {e!r}"
+        return text[:self.max_response_chars]
+
+    async def close(self) -> None:
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._sync_client is not None:
+            self._sync_client.close()
+            self._sync_client = None
+
+
+class AsyncRequestsTool(BaseTool):
+    client: AsyncHttpClient
+    method: str = "GET"
+
+    def parse(self, text: str) -> tuple[str, Optional[dict[str, Any]]]:
+        # GET, DELETE는 URL만, 나머지는 {"url": ..., "data": ...} JSON을 입력으로 받는다(LangChain 툴과 같다).
+        if self.method in ("GET", "DELETE"):
+            return text, None
+        data = json.loads(text)
+        return data["url"], data["data"]
+
+    def _run(self, text: str, run_manager: Optional[CallbackManagerForToolRun] = None) -> str:
+        try:
+            url, data = self.parse(text)
+        except (ValueError, KeyError, TypeError) as e:
+            return repr(e)
+        return self.client.request_sync(self.method, url, data)
+
+    async def _arun(self, text: str, run_manager: Optional[AsyncCallbackManagerForToolRun] = None) -> str:
+        try:
+            url, data = self.parse(text)
+        except (ValueError, KeyError, TypeError) as e:
+            return repr(e)
+        return await self.client.request(self.method, url, data)
+
+
+def load_async_requests_tools(client: AsyncHttpClient) -> list[BaseTool]:
+    """
+    Async replacements of load_tools(["requests_all"]) with the same names and descriptions.
+    """
+    # 에이전트 프롬프트가 바뀌지 않도록 LangChain 툴의 이름과 설명을 그대로 사용한다.
+    tools = [(RequestsGetTool, "GET"), (RequestsPostTool, "POST"), (RequestsPatchTool, "PATCH"), (RequestsPutTool, "PUT"), (RequestsDeleteTool, "DELETE")]
+    return [
+        AsyncRequestsTool(name=tool.__fields__["name"].default, description=tool.__fields__["description"].default, client=client, method=method)
+        for tool, method in tools
+    ]
@@ -1,33 +1,66 @@
+import time
+from collections import deque
 from typing import Any, Dict, List, Optional, Union
+from uuid import UUID
 
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.schema import AgentAction, AgentFinish, LLMResult
 
+from core.metrics import Metrics, metrics
+
 
 def ch(text: Union[str, object]) -> str:
     s = text if isinstance(text, str) else str(text)
     return s.replace("<", "&lt;").replace(">", "&gt;").replace("\r", "").replace("\n", "<br>")
 
 class HtmlCallbackHandler (BaseCallbackHandler):
-    html: str = ""
+    """
+      Records the agent's thought process of one request. Create one handler per request.
+      Events are kept as (template, text, color) tuples in a bounded buffer and rendered to HTML only when
+      render() is called, so requests that don't ask for thoughts never build the HTML.
+      Attributes:
+          max_events (int): The maximum number of events kept. The oldest events are dropped first.
+          max_event_chars (int): Longer event texts (prompts, tool outputs) are truncated.
+          dropped (int): The number of events dropped from the buffer.
+      """
+
+    def __init__(self, max_events: int = 200, max_event_chars: int = 4000):
+        self.max_events = max_events
+        self.max_event_chars = max_event_chars
+        self.dropped = 0
+        self.events: deque[tuple[str, str, Optional[str]]] = deque(maxlen=max_events)
+
+    def add_event(self, template: str, text: Union[str, object] = "", color: Optional[str] = None) -> None:
+        s = text if isinstance(text, str) else str(text)
+        if len(s) > self.max_event_chars:
+            s = s[:self.max_event_chars] + "..."
+        if len(self.events) == self.max_events:
+            self.dropped += 1
+        self.events.append((template, s, color))
+
+    def render(self) -> str:
+        html = [f"({self.dropped} earlier events omitted)<br>"] if self.dropped else []
+        html.extend(template.format(text=ch(text), color=color) for template, text, color in self.events)
+        return "".join(html)
 
     def get_and_reset_log(self) -> str:
-        result = self.html
-        self.html = ""
+        result = self.render()
+        self.events.clear()
+        self.dropped = 0
         return result
 
     def on_llm_start(
         self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
     ) -> None:
         """Print out the prompts."""
-        self.html += "LLM prompts:<br>" + "<br>".join(ch(prompts)) + "<br>"
+        self.add_event("LLM prompts:<br>{text}<br>", "\n".join(prompts))
 
     def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
         """Do nothing."""
         pass
 
     def on_llm_error(self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any) -> None:
-        self.html += f"<span style='color:red'>LLM error: {ch(error)}</span><br>"
+        self.add_event("<span style='color:red'>LLM error: {text}</span><br>", error)
 
     def on_chain_start(
         self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any
@@ -36,14 +69,14 @@ class HtmlCallbackHandler (BaseCallbackHandler):
         class_name = "unknown"
         if "name" in serialized:
             class_name = serialized["name"]
-        self.html += f"Entering chain: {ch(class_name)}<br>"
+        self.add_event("Entering chain: {text}<br>", class_name)
 
     def on_chain_end(self, outputs: Dict[str, Any], **kwargs: Any) -> None:
         """Print out that we finished a chain."""
-        self.html += "Finished chain<br>"
+        self.add_event("Finished chain<br>")
 
     def on_chain_error(self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any) -> None:
-        self.html += f"<span style='color:red'>Chain error: {ch(error)}</span><br>"
+        self.add_event("<span style='color:red'>Chain error: {text}</span><br>", error)
 
     def on_tool_start(
         self,
@@ -64,10 +97,11 @@ class HtmlCallbackHandler (BaseCallbackHandler):
         **kwargs: Any,
     ) -> None:
         """If not the final action, print out observation."""
-        self.html += f"{ch(observation_prefix)}<br><span style='color:{color}'>{ch(output)}</span><br>{ch(llm_prefix)}<br>"
+        prefix, suffix = (ch(p).replace("{", "{{").replace("}", "}}") for p in (observation_prefix, llm_prefix))
+        self.add_event(prefix + "<br><span style='color:{color}'>{text}</span><br>" + suffix + "<br>", output, color)
 
     def on_tool_error(self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any) -> None:
-        self.html += f"<span style='color:red'>Tool error: {ch(error)}</span><br>"
+        self.add_event("<span style='color:red'>Tool error: {text}</span><br>", error)
 
     def on_text(
         self,
@@ -76,17 +110,58 @@ class HtmlCallbackHandler (BaseCallbackHandler):
         **kwargs: Optional[str],
     ) -> None:
         """Run when agent ends."""
-        self.html += f"<span style='color:{color}'>{ch(text)}</span><br>"
+        self.add_event("<span style='color:{color}'>{text}</span><br>", text, color)
 
     def on_agent_action(
         self,
         action: AgentAction,
         color: Optional[str] = None,
         **kwargs: Any) -> Any:
-        self.html += f"<span style='color:{color}'>{ch(action.log)}</span><br>"
+        self.add_event("<span style='color:{color}'>{text}</span><br>", action.log, color)
 
     def on_agent_finish(
         self, finish: AgentFinish, color: Optional[str] = None, **kwargs: Any
     ) -> None:
         """Run on agent end."""
-        self.html += f"<span style='color:{color}'>{ch(finish.log)}</span><br>"
+        self.add_event("<span style='color:{color}'>{text}</span><br>", finish.log, color)
+
+
+class MetricsCallbackHandler (BaseCallbackHandler):
+    """
+      Records the duration of the agent's LLM and tool calls, and the prompt tokens the LLM reports, as pipeline stages
+      ("llm", "tool") of an approach. Stateless apart from the start times of running calls, so one handler can be shared.
+      """
+
+    def __init__(self, approach: str, metrics: Metrics = metrics):
+        self.approach = approach
+        self.metrics = metrics
+        self._starts: dict[UUID, float] = {}
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any) -> None:
+        self._starts[run_id] = time.perf_counter()
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: UUID, **kwargs: Any) -> None:
+        self._starts[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end("llm", run_id)
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        if "prompt_tokens" in token_usage:
+            self.metrics.observe_prompt_tokens(self.approach, "llm", token_usage["prompt_tokens"])
+
+    def on_llm_error(self, error: Union[Exception, KeyboardInterrupt], *, run_id: UUID, **kwargs: Any) -> None:
+        self._end("llm", run_id)
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self._starts[run_id] = time.perf_counter()
+
+    def on_tool_end(self, output: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self._end("tool", run_id)
+
+    def on_tool_error(self, error: Union[Exception, KeyboardInterrupt], *, run_id: UUID, **kwargs: Any) -> None:
+        self._end("tool", run_id)
+
+    def _end(self, stage: str, run_id: UUID) -> None:
+        start = self._starts.pop(run_id, None)
+        if start is not None:
+            self.metrics.observe_stage(self.approach, stage, time.perf_counter() - start)
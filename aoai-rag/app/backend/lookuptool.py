@@ -1,22 +1,21 @@
-import csv
 from pathlib import Path
 from typing import Union
 
 from langchain.agents import Tool
 from langchain.callbacks.manager import Callbacks
 
+from core.lookupengine import CsvLookupEngine, get_lookup_engine
+
 
 class CsvLookupTool(Tool):
-    data: dict[str, str] = {}
+    engine: CsvLookupEngine
 
     def __init__(self, filename: Union[str, Path], key_field: str, name: str = "lookup",
                  description: str = "useful to look up details given an input key as opposite to searching data with an unstructured question",
                  callbacks: Callbacks = None):
-        super().__init__(name, self.lookup, description, callbacks=callbacks)
-        with open(filename, newline='', encoding='utf-8') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                self.data[row[key_field]] =  "\n".join([f"{i}:{row[i]}" for i in row])
+        # 같은 CSV를 쓰는 툴은 워커 안에서 하나의 조회 엔진을 공유한다.
+        engine = get_lookup_engine(filename, key_field)
+        super().__init__(name, engine.lookup, description, callbacks=callbacks, engine=engine)
 
     def lookup(self, key: str) -> str:
-        return self.data.get(key, "")
+        return self.engine.lookup(key)
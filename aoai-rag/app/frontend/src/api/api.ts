@@ -18,7 +18,8 @@ export async function askApi(options: AskRequest): Promise<AskResponse> {
                 prompt_template: options.overrides?.promptTemplate,
                 prompt_template_prefix: options.overrides?.promptTemplatePrefix,
                 prompt_template_suffix: options.overrides?.promptTemplateSuffix,
-                exclude_category: options.overrides?.excludeCategory
+                exclude_category: options.overrides?.excludeCategory,
+                include_thoughts: options.overrides?.includeThoughts
             }
         })
     });
@@ -40,6 +41,8 @@ export async function chatApi(options: ChatRequest): Promise<Response> {
         },
         body: JSON.stringify({
             history: options.history,
+            session_id: options.sessionId,
+            message: options.message,
             approach: options.approach,
             overrides: {
                 retrieval_mode: options.overrides?.retrievalMode,
@@ -51,7 +54,8 @@ export async function chatApi(options: ChatRequest): Promise<Response> {
                 prompt_template_prefix: options.overrides?.promptTemplatePrefix,
                 prompt_template_suffix: options.overrides?.promptTemplateSuffix,
                 exclude_category: options.overrides?.excludeCategory,
-                suggest_followup_questions: options.overrides?.suggestFollowupQuestions
+                suggest_followup_questions: options.overrides?.suggestFollowupQuestions,
+                stream_format: options.shouldStream ? "lean" : undefined
             }
         })
     });
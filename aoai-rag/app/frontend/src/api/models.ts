@@ -22,6 +22,7 @@ export type AskRequestOverrides = {
     promptTemplatePrefix?: string;
     promptTemplateSuffix?: string;
     suggestFollowupQuestions?: boolean;
+    includeThoughts?: boolean;
 };
 
 export type AskRequest = {
@@ -43,7 +44,11 @@ export type ChatTurn = {
 };
 
 export type ChatRequest = {
-    history: ChatTurn[];
+    // history에 전체 대화를 보내거나, sessionId와 message로 새 메시지만 보낸다. sessionId를 보내면 서버가 턴(토큰 수 포함)을 저장해 두고 재사용한다.
+    // history 없이 보낸 요청은 서버에 세션이 없으면 code "unknown_session", 세션 백엔드가 공유되지 않으면 "history_required"와 함께 409로 거절된다.
+    history?: ChatTurn[];
+    sessionId?: string;
+    message?: string;
     approach: Approaches;
     overrides?: AskRequestOverrides;
     shouldStream?: boolean;
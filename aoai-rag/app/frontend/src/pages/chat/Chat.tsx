@@ -26,6 +26,9 @@ const Chat = () => {
     const [useSuggestFollowupQuestions, setUseSuggestFollowupQuestions] = useState<boolean>(true);
 
     const lastQuestionRef = useRef<string>("");
+    const sessionIdRef = useRef<string>(crypto.randomUUID());
+    // 서버의 세션 백엔드가 워커 사이에 공유되지 않으면 매 턴 전체 대화를 보낸다.
+    const sendHistoryRef = useRef<boolean>(false);
     const chatMessageStreamEnd = useRef<HTMLDivElement | null>(null);
 
     const [isLoading, setIsLoading] = useState<boolean>(false);
@@ -59,6 +62,9 @@ const Chat = () => {
             for await (const event of readNDJSONStream(responseBody)) {
                 if (event["data_points"]) {
                     askResponse = event;
+                } else if (event["delta"]) {
+                    setIsLoading(false);
+                    await updateState(event["delta"]);
                 } else if (event["choices"]) {
                     if (event["choices"].length == 0) {
                     } else if (event["choices"][0]["delta"]["content"]) {
@@ -83,9 +89,13 @@ const Chat = () => {
         setActiveAnalysisPanelTab(undefined);
 
         try {
+            // 첫 턴 이후에는 sessionId와 새 메시지만 보내고, 서버가 저장해 둔 턴으로 대화를 이어간다.
+            // 서버에 세션이 없거나(409 unknown_session) 세션이 공유되지 않으면(409 history_required) 전체 대화를 보낸다.
             const history: ChatTurn[] = answers.map(a => ({ user: a[0], bot: a[1].answer }));
-            const request: ChatRequest = {
-                history: [...history, { user: question, bot: undefined }],
+            const withHistory = (request: ChatRequest): ChatRequest => ({ ...request, history: [...history, { user: question, bot: undefined }], message: undefined });
+            const baseRequest: ChatRequest = {
+                sessionId: sessionIdRef.current,
+                message: question,
                 approach: Approaches.ReadRetrieveRead,
                 shouldStream: shouldStream,
                 overrides: {
@@ -98,12 +108,23 @@ const Chat = () => {
                     suggestFollowupQuestions: useSuggestFollowupQuestions
                 }
             };
+            const request = answers.length === 0 || sendHistoryRef.current ? withHistory(baseRequest) : baseRequest;
 
-            const response = await chatApi(request);
+            let response = await chatApi(request);
+            if (response.status === 409 && !request.history) {
+                const code = (await response.json()).code;
+                if (code === "history_required") {
+                    sendHistoryRef.current = true;
+                }
+                response = await chatApi(withHistory(baseRequest));
+            }
             if (!response.body) {
                 throw Error("No response body");
             }
             if (shouldStream) {
+                if (response.status > 299 || !response.ok) {
+                    throw Error((await response.json()).error || "Unknown error");
+                }
                 const parsedResponse: AskResponse = await handleAsyncRequest(question, answers, setAnswers, response.body);
                 setAnswers([...answers, [question, parsedResponse]]);
             } else {
@@ -122,6 +143,7 @@ const Chat = () => {
 
     const clearChat = () => {
         lastQuestionRef.current = "";
+        sessionIdRef.current = crypto.randomUUID();
         error && setError(undefined);
         setActiveCitation(undefined);
         setActiveAnalysisPanelTab(undefined);
@@ -21,6 +21,7 @@ export function Component(): JSX.Element {
     const [useSemanticRanker, setUseSemanticRanker] = useState<boolean>(false);
     const [useSemanticCaptions, setUseSemanticCaptions] = useState<boolean>(false);
     const [excludeCategory, setExcludeCategory] = useState<string>("");
+    const [includeThoughts, setIncludeThoughts] = useState<boolean>(true);
 
     const lastQuestionRef = useRef<string>("");
 
@@ -51,7 +52,8 @@ export function Component(): JSX.Element {
                     top: retrieveCount,
                     retrievalMode: retrievalMode,
                     semanticRanker: useSemanticRanker,
-                    semanticCaptions: useSemanticCaptions
+                    semanticCaptions: useSemanticCaptions,
+                    includeThoughts: includeThoughts
                 }
             };
             const result = await askApi(request);
@@ -95,6 +97,10 @@ export function Component(): JSX.Element {
         setUseSemanticCaptions(!!checked);
     };
 
+    const onIncludeThoughtsChange = (_ev?: React.FormEvent<HTMLElement | HTMLInputElement>, checked?: boolean) => {
+        setIncludeThoughts(!!checked);
+    };
+
     const onExcludeCategoryChanged = (_ev?: React.FormEvent, newValue?: string) => {
         setExcludeCategory(newValue || "");
     };
@@ -224,6 +230,15 @@ export function Component(): JSX.Element {
                     </>
                 )}
 
+                {(approach === Approaches.ReadRetrieveRead || approach === Approaches.ReadPluginsRetrieve) && (
+                    <Checkbox
+                        className={styles.oneshotSettingsSeparator}
+                        checked={includeThoughts}
+                        label="에이전트의 사고 과정 기록"
+                        onChange={onIncludeThoughtsChange}
+                    />
+                )}
+
                 <SpinButton
                     className={styles.oneshotSettingsSeparator}
                     label="검색된 문서의 개수:"
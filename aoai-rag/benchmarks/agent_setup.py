@@ -0,0 +1,79 @@
+"""
+Benchmark of the per-request setup cost of ReadRetrieveReadApproach ("rrr" on /ask), without the model calls.
+"before" rebuilds the LLM client, the tools and the agent executor for every request like the approach used to;
+"after" is what a request does now with the agent built once per worker.
+
+    python benchmarks/agent_setup.py --repeat 200
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+from langchain.agents import AgentType, Tool, initialize_agent
+from langchain.agents.mrkl import prompt
+from langchain.callbacks.manager import CallbackManager
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "app" / "backend"))
+
+from approaches.readretrieveread import (  # noqa: E402
+    AgentRequest,
+    CafeSearchTool,
+    ReadRetrieveReadApproach,
+    RequestScopedAzureChatOpenAI,
+    current_agent_request,
+)
+from langchainadapters import HtmlCallbackHandler  # noqa: E402
+
+ENDPOINT = "https://benchmark.openai.azure.com"
+
+
+def token_provider() -> str:
+    return "token"
+
+
+def setup_before(overrides: dict) -> None:
+    async def retrieve_and_store(q: str) -> str:
+        return q
+
+    cb_manager = CallbackManager(handlers=[HtmlCallbackHandler()])
+    tools = [
+        Tool(name="PeopleSearchTool", func=retrieve_and_store, coroutine=retrieve_and_store, description="한국사 인물 정보를 검색합니다."),
+        CafeSearchTool()
+    ]
+    llm = RequestScopedAzureChatOpenAI(azure_deployment="chat", api_version="2024-02-01", azure_endpoint=ENDPOINT,
+                                       azure_ad_token_provider=token_provider, temperature=overrides.get("temperature") or 0.3)
+    initialize_agent(tools, llm, agent=AgentType.ZERO_SHOT_REACT_DESCRIPTION, verbose=True,
+                     agent_kwargs=dict(suffix="Answer should be in Korean.\n" + prompt.SUFFIX), callback_manager=cb_manager,
+                     handle_parsing_errors=True, max_iterations=5, early_stopping_method="generate")
+
+
+def setup_after(overrides: dict) -> None:
+    request = AgentRequest(overrides, overrides.get("temperature") or 0.3)
+    HtmlCallbackHandler()
+    current_agent_request.reset(current_agent_request.set(request))
+
+
+def measure(name: str, setup, repeat: int) -> None:
+    overrides = {"temperature": 0.3, "top": 3}
+    start = time.perf_counter()
+    for _ in range(repeat):
+        setup(overrides)
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{name:<8} {elapsed * 1000:10.3f} ms/request")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the per-request setup of the rrr ask approach.")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    ReadRetrieveReadApproach(None, None, "2024-02-01", ENDPOINT, token_provider, "chat", "embedding", "sourcepage", "content", search_cache=object())
+    print(f"{'startup':<8} {(time.perf_counter() - start) * 1000:10.3f} ms once per worker")
+    measure("before", setup_before, args.repeat)
+    measure("after", setup_after, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Benchmark of query embedding micro-batching under concurrent load against a simulated embeddings endpoint.
+Reports embedding API calls, batch fill and the queueing delay added by the batching window.
+
+    python benchmarks/embedding_batching.py --requests 500 --rps 200 --window-ms 5
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "app" / "backend"))
+
+from core.embeddingbatcher import EmbeddingBatcher  # noqa: E402
+
+
+class SimulatedEmbeddings:
+    def __init__(self, latency_ms: float):
+        self.latency_ms = latency_ms
+        self.calls = 0
+
+    async def create(self, model, input):
+        self.calls += 1
+        inputs = input if isinstance(input, list) else [input]
+        await asyncio.sleep(self.latency_ms / 1000)
+        return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=[0.0] * 1536) for i in range(len(inputs))])
+
+
+async def run(requests: int, rps: float, latency_ms: float, batcher_options: dict | None) -> None:
+    embeddings = SimulatedEmbeddings(latency_ms)
+    client = SimpleNamespace(embeddings=embeddings)
+    batcher = EmbeddingBatcher(client, "embedding", **batcher_options) if batcher_options else None
+    latencies = []
+
+    async def one(i: int) -> None:
+        start = time.perf_counter()
+        if batcher:
+            await batcher.embed(f"질문 {i}")
+        else:
+            await client.embeddings.create(model="embedding", input=f"질문 {i}")
+        latencies.append(time.perf_counter() - start)
+
+    tasks = []
+    for i in range(requests):
+        tasks.append(asyncio.create_task(one(i)))
+        await asyncio.sleep(random.expovariate(rps))
+    await asyncio.gather(*tasks)
+
+    latencies.sort()
+    name = f"batched, {batcher_options['window_ms']:g} ms window" if batcher_options else "one call per query"
+    print(f"{name:<28} {embeddings.calls:>5} calls  p50 {latencies[len(latencies) // 2] * 1000:6.1f} ms  p99 {latencies[int(len(latencies) * 0.99)] * 1000:6.1f} ms")
+    if batcher:
+        stats = batcher.stats()
+        print(f"{'':<28} fill {stats['batch_fill']:.2f}  queue delay avg {stats['queue_delay_avg_ms']:.1f} ms  max {stats['queue_delay_max_ms']:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark query embedding micro-batching.")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--rps", type=float, default=200, help="Poisson arrival rate of queries")
+    parser.add_argument("--latency-ms", type=float, default=30, help="Simulated embeddings API latency")
+    parser.add_argument("--window-ms", type=float, default=5)
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    args = parser.parse_args()
+
+    random.seed(0)
+    asyncio.run(run(args.requests, args.rps, args.latency_ms, None))
+    asyncio.run(run(args.requests, args.rps, args.latency_ms, {"window_ms": args.window_ms, "max_batch_size": args.max_batch_size}))
+
+
+if __name__ == "__main__":
+    main()
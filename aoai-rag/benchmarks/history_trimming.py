@@ -0,0 +1,108 @@
+"""
+Benchmark of chat history trimming: the previous insert-and-retokenize loop against core.messagebuilder.trim_history.
+"cold" clears the worker's token count cache before every timed call, so every message is tokenized; "warm" reads the counts
+left by the previous call, as when the same worker serves the next turn of a conversation.
+
+    python benchmarks/history_trimming.py --turns 10 50 200 1000 --model gpt-35-turbo
+
+Results (best of 20, one CPU core, --byte-encoding because cl100k_base couldn't be downloaded there, so the absolute
+times are not those of the model's encoding):
+
+    gpt-35-turbo (budget 4000)    legacy cold / warm     trim_history cold / warm
+      10 turns                    5.19 ms / 0.16 ms      3.41 ms / 0.12 ms
+      50 turns                    6.95 ms / 0.21 ms      5.84 ms / 0.25 ms
+     200 turns                    7.33 ms / 0.22 ms      5.81 ms / 0.23 ms
+    1000 turns                    7.15 ms / 0.21 ms      5.58 ms / 0.23 ms
+    gpt-4 (budget 8100)
+      50 turns                   14.10 ms / 0.42 ms     10.86 ms / 0.46 ms
+    1000 turns                   14.01 ms / 0.42 ms     11.71 ms / 0.51 ms
+
+With a warm cache both take well under a millisecond, so the gain is in cold trimming (about 1.2-1.5x) and in the budget:
+the legacy loop adds the turn that crosses the budget (4068 tokens for a budget of 4000), trim_history never does.
+"""
+import argparse
+import sys
+import timeit
+from pathlib import Path
+
+import tiktoken
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "app" / "backend"))
+
+from core import modelhelper  # noqa: E402
+from core.messagebuilder import MessageBuilder, trim_history  # noqa: E402
+from core.modelhelper import (  # noqa: E402
+    get_token_limit,
+    num_tokens_from_messages,
+    token_count_cache,
+)
+
+SYSTEM_PROMPT = "너는 한국의 무신정권 역사에 관한 문제를 답변해주는 역사 교수야."
+
+
+def make_history(turns: int) -> list[dict[str, str]]:
+    history = []
+    for i in range(turns):
+        history.append({
+            "user": f"{i}번째 질문: 최충헌은 어떤 방법으로 권력을 유지했어?",
+            "bot": f"{i}번째 답변: 최충헌은 교정도감을 설치하고 도방을 확대하여 사병을 키웠으며, 경쟁자들을 제거해서 일인 집권체제를 구축했습니다.[info{i}.pdf]",
+        })
+    history.append({"user": "마지막 질문"})
+    return history
+
+
+def legacy_messages(history: list[dict[str, str]], model: str, max_tokens: int) -> list:
+    # 이전 구현: 턴마다 목록 가운데에 삽입하고 다시 토큰화하며, 턴을 추가한 뒤에야 예산을 확인한다.
+    message_builder = MessageBuilder(SYSTEM_PROMPT, model)
+    message_builder.append_message("user", history[-1]["user"], index=1)
+    for h in reversed(history[:-1]):
+        if bot_msg := h.get("bot"):
+            message_builder.append_message("assistant", bot_msg, index=1)
+        if user_msg := h.get("user"):
+            message_builder.append_message("user", user_msg, index=1)
+        if message_builder.token_length > max_tokens:
+            break
+    return message_builder.messages
+
+
+def trimmed_messages(history: list[dict[str, str]], model: str, max_tokens: int) -> list:
+    message_builder = MessageBuilder(SYSTEM_PROMPT, model)
+    user_message = {"role": "user", "content": history[-1]["user"]}
+    user_token_count = message_builder.count_tokens(user_message)
+    history_messages, history_token_count = trim_history(history[:-1], model, max_tokens - message_builder.token_length - user_token_count)
+    message_builder.append_messages(history_messages, history_token_count)
+    message_builder.append_messages([user_message], user_token_count)
+    return message_builder.messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chat history trimming.")
+    parser.add_argument("--turns", type=int, nargs="+", default=[50, 200])
+    parser.add_argument("--model", default="gpt-35-turbo")
+    parser.add_argument("--budget", type=int, help="Prompt token budget. Defaults to the model's token limit.")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--byte-encoding", action="store_true",
+                        help="Count tokens with a byte-level stand-in for the model's tiktoken encoding, on machines that can't download it. "
+                             "Token counts and times then differ from the model's.")
+    args = parser.parse_args()
+
+    if args.byte_encoding:
+        encoding = tiktoken.Encoding("bytes", pat_str=r"\S+|\s+", mergeable_ranks={bytes([i]): i for i in range(256)}, special_tokens={})
+        modelhelper.get_encoding = lambda model: encoding
+    max_tokens = args.budget or get_token_limit(args.model)
+    # 인코딩 로딩 시간이 측정에 포함되지 않도록 미리 한 번 실행한다.
+    trimmed_messages(make_history(1), args.model, max_tokens)
+    for turns in args.turns:
+        history = make_history(turns)
+        for name, build in (("legacy", legacy_messages), ("trim_history", trimmed_messages)):
+            # cold: 매번 토큰 수 캐시를 비우고 모든 메시지를 토큰화한다(새 워커, 처음 보는 대화).
+            # warm: 앞의 실행이 채운 캐시에서 토큰 수를 읽는다(같은 워커에서 이어지는 대화).
+            cold = min(timeit.repeat(lambda: build(history, args.model, max_tokens), setup=token_count_cache.clear, number=1, repeat=args.repeat))
+            warm = min(timeit.repeat(lambda: build(history, args.model, max_tokens), number=1, repeat=args.repeat))
+            messages = build(history, args.model, max_tokens)
+            tokens = sum(num_tokens_from_messages(message, args.model) for message in messages)
+            print(f"{turns:>4} turns  {name:<13} cold {cold * 1000:8.2f} ms  warm {warm * 1000:8.2f} ms  {len(messages):>4} messages  {tokens:>6} tokens (budget {max_tokens})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Benchmark of the /chat_stream encoders: today's OpenAI chunk format (model_dump + json.dumps) against the lean format,
+with and without delta coalescing. Reports encoded events per second and bytes per answer.
+
+    python benchmarks/streaming_encoding.py --chunks 400 --coalesce-bytes 64
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+
+from openai.types.chat import ChatCompletionChunk
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "app" / "backend"))
+
+from core.streaming import encode_delta, format_as_lean_ndjson  # noqa: E402
+
+ANSWER = "최충헌(崔忠獻)은 고려 시대 중기에서 후기에 활동한 무신이자 정치가로, 최씨 무신 정권의 첫 지도자입니다.[info1.pdf] "
+CONTEXT = {"data_points": ["info1.pdf: 1196년부터 1219년까지 23년 동안 고려 왕조의 실권을 맡았다."], "thoughts": "Searched for:<br>최충헌"}
+
+
+def make_chunks(count: int) -> list[ChatCompletionChunk]:
+    # Azure OpenAI가 보내는 청크와 같은 모양(대략 토큰 하나당 청크 하나)
+    pieces = [ANSWER[i % len(ANSWER):i % len(ANSWER) + 2] or "." for i in range(0, count * 2, 2)]
+    return [
+        ChatCompletionChunk.model_validate({
+            "id": "chatcmpl-8Uj0aqw3TqnDRiC0vGmrBpNrOJ9Jj",
+            "object": "chat.completion.chunk",
+            "created": 1702300000,
+            "model": "gpt-35-turbo",
+            "system_fingerprint": None,
+            "choices": [{
+                "index": 0,
+                "delta": {"content": piece, "role": None, "function_call": None, "tool_calls": None},
+                "finish_reason": None,
+                "logprobs": None,
+                "content_filter_results": {
+                    "hate": {"filtered": False, "severity": "safe"},
+                    "self_harm": {"filtered": False, "severity": "safe"},
+                    "sexual": {"filtered": False, "severity": "safe"},
+                    "violence": {"filtered": False, "severity": "safe"},
+                },
+            }],
+        })
+        for piece in pieces
+    ]
+
+
+def encode_openai(chunks: list[ChatCompletionChunk]) -> list[str]:
+    lines = [json.dumps({"choices": [{"delta": {"role": "assistant"}, "context": CONTEXT, "finish_reason": None, "index": 0}], "object": "chat.completion.chunk"}, ensure_ascii=False) + "\n"]
+    for chunk in chunks:
+        event = chunk.model_dump()
+        if event["choices"]:
+            lines.append(json.dumps(event, ensure_ascii=False) + "\n")
+    return lines
+
+
+def encode_lean(chunks: list[ChatCompletionChunk]) -> list[str]:
+    lines = [json.dumps(CONTEXT, ensure_ascii=False, separators=(",", ":")) + "\n"]
+    for chunk in chunks:
+        if chunk.choices and chunk.choices[0].delta.content:
+            lines.append(encode_delta(chunk.choices[0].delta.content))
+    lines.append('{"done":true,"finish_reason":"stop"}\n')
+    return lines
+
+
+def encode_lean_coalesced(chunks: list[ChatCompletionChunk], coalesce_bytes: int) -> list[str]:
+    async def events():
+        yield CONTEXT
+        for chunk in chunks:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield {"delta": chunk.choices[0].delta.content}
+        yield {"done": True, "finish_reason": "stop"}
+
+    async def collect():
+        return [line async for line in format_as_lean_ndjson(events(), coalesce_bytes=coalesce_bytes)]
+
+    return asyncio.run(collect())
+
+
+def measure(name: str, encode, chunks: list[ChatCompletionChunk], repeat: int) -> None:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        lines = encode(chunks)
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<24} {len(chunks) / best:>12,.0f} chunks/s  {len(lines):>5} events  {sum(len(line.encode()) for line in lines):>8,} bytes/answer")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark /chat_stream encoders.")
+    parser.add_argument("--chunks", type=int, default=400, help="Model chunks per answer")
+    parser.add_argument("--coalesce-bytes", type=int, default=64)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    chunks = make_chunks(args.chunks)
+    measure("openai (model_dump)", encode_openai, chunks, args.repeat)
+    measure("lean", encode_lean, chunks, args.repeat)
+    measure(f"lean, {args.coalesce_bytes} byte window", lambda c: encode_lean_coalesced(c, args.coalesce_bytes), chunks, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
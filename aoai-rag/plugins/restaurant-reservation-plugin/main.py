@@ -45,14 +45,20 @@ async def plugin_manifest():
     request.headers['Host']
     with open("./.well-known/ai-plugin.json") as f:
         text = f.read()
-        return quart.Response(text, mimetype="text/json")
+    # 백엔드의 플러그인 레지스트리가 If-None-Match로 재검증하면 304로 응답한다.
+    response = quart.Response(text, mimetype="text/json")
+    await response.add_etag()
+    return await response.make_conditional(request)
 
 @app.get("/openapi.yaml")
 async def openapi_spec():
     request.headers['Host']
     with open("openapi.yaml") as f:
         text = f.read()
-        return quart.Response(text, mimetype="text/yaml")
+    # 백엔드의 플러그인 레지스트리가 If-None-Match로 재검증하면 304로 응답한다.
+    response = quart.Response(text, mimetype="text/yaml")
+    await response.add_etag()
+    return await response.make_conditional(request)
 
 def main():
     app.run(debug=True, host="0.0.0.0", port=5006)
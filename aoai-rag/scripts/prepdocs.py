@@ -1,17 +1,26 @@
 import argparse
 import base64
 import glob
+import hashlib
 import html
 import io
+import json
 import logging
 import os
+import queue
 import re
+import sqlite3
+import threading
 import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 
-from openai import AzureOpenAI
+from openai import APIConnectionError, AzureOpenAI, InternalServerError, RateLimitError
 import tiktoken
 from azure.ai.formrecognizer import DocumentAnalysisClient
+from azure.core import MatchConditions
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
 from azure.identity import AzureDeveloperCliCredential, get_bearer_token_provider
 from azure.search.documents import SearchClient
 from azure.search.documents.indexes import SearchIndexClient
@@ -32,18 +41,25 @@ from azure.search.documents.indexes.models import (
 )
 from azure.storage.blob import BlobServiceClient
 from pypdf import PdfReader, PdfWriter
-from tenacity import retry, stop_after_attempt, wait_random_exponential
 
 MAX_SECTION_LENGTH = 1000
 SENTENCE_SEARCH_LIMIT = 100
 SECTION_OVERLAP = 100
 
+# The app clears its search result cache when this metadata value of the INDEX_VERSION_BLOB blob changes.
+# A blob rather than the container metadata, because only blobs support conditional (If-Match) metadata updates.
+INDEX_VERSION_BLOB = "_index_version"
+INDEX_VERSION_METADATA_KEY = "index_version"
+INDEX_VERSION_MAX_ATTEMPTS = 5
+
 open_ai_token_cache = {}
 CACHE_KEY_TOKEN_CRED = 'openai_token_cred'
 CACHE_KEY_CREATED_TIME = 'created_time'
 CACHE_KEY_TOKEN_TYPE = 'token_type'
 
 openai_client = None
+embedding_cache = None
+embedding_scheduler = None
 
 # Embedding batch support section
 SUPPORTED_BATCH_AOAI_MODEL = {
@@ -56,7 +72,11 @@ SUPPORTED_BATCH_AOAI_MODEL = {
 logger = logging.getLogger("ingester")
 
 def calculate_tokens_emb_aoai(input: str):
-    encoding = tiktoken.encoding_for_model(args.openaimodelname)
+    try:
+        encoding = tiktoken.encoding_for_model(args.openaimodelname or "")
+    except KeyError:
+        # Only used to pace the requests when the model is unknown to tiktoken
+        encoding = tiktoken.get_encoding("cl100k_base")
     return len(encoding.encode(input))
 
 def blob_name_from_file_page(filename, page = 0):
@@ -65,11 +85,16 @@ def blob_name_from_file_page(filename, page = 0):
     else:
         return os.path.basename(filename)
 
-def upload_blobs(filename):
+def get_blob_container():
     blob_service = BlobServiceClient(account_url=f"https://{args.storageaccount}.blob.core.windows.net", credential=storage_creds)
     blob_container = blob_service.get_container_client(args.container)
     if not blob_container.exists():
         blob_container.create_container()
+    return blob_container
+
+def upload_blobs(filename, blob_container=None):
+    # The pipeline shares one container client between the upload workers
+    blob_container = blob_container or get_blob_container()
 
     # if file is PDF split into pages and upload each page as a separate blob
     if os.path.splitext(filename)[1].lower() == ".pdf":
@@ -95,7 +120,8 @@ def remove_blobs(filename):
     blob_container = blob_service.get_container_client(args.container)
     if blob_container.exists():
         if filename is None:
-            blobs = blob_container.list_blob_names()
+            # Keep the index version, so it keeps increasing and the app notices this removal
+            blobs = (b for b in blob_container.list_blob_names() if b != INDEX_VERSION_BLOB)
         else:
             prefix = os.path.splitext(os.path.basename(filename))[0]
             blobs = filter(lambda b: re.match(f"{prefix}-\d+\.pdf", b), blob_container.list_blob_names(name_starts_with=os.path.splitext(os.path.basename(prefix))[0]))
@@ -242,22 +268,212 @@ def create_sections(filename, page_map, use_vectors, category):
             "sourcefile": filename
         }
         if use_vectors:
-            section["embedding"] = compute_embedding(content)
+            section["embedding"] = get_embedding(content)
         yield section
 
-def before_retry_sleep(retry_state):
-    if args.verbose: logger.info("Rate limited on the OpenAI embeddings API, sleeping before retrying...")
+def retry_after_seconds(headers, default):
+    # Azure OpenAI sends retry-after-ms along with retry-after (in seconds)
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1)):
+        try:
+            return float(headers[name]) * scale
+        except (KeyError, TypeError, ValueError):
+            pass
+    return default
+
+def header_number(headers, name):
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+class EmbeddingScheduler:
+    """
+    Admits embedding requests within the tokens per minute (TPM) and requests per minute (RPM) quota of the deployment.
+    - A request waits until its token count and one request fit in two buckets refilled continuously at the quota rate.
+      The buckets are lowered to the x-ratelimit-remaining-tokens/requests values the service returns.
+    - The number of concurrent requests is tuned with AIMD: it grows by one after as many successful requests
+      as the current limit and is halved on 429, between 1 and `max_concurrency`.
+    - A 429 pauses all requests for the Retry-After sent by the service instead of a fixed backoff.
+    """
+    def __init__(self, tpm, rpm, max_concurrency, max_attempts=15, clock=time.monotonic, sleep=time.sleep):
+        self.tpm = tpm
+        self.rpm = rpm
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_attempts = max_attempts
+        self.clock = clock
+        self.sleep = sleep
+        self.concurrency = 1.0
+        self.in_flight = 0
+        self.tokens = tpm
+        self.requests = rpm
+        self.updated = clock()
+        self.paused_until = 0.0
+        self.completed = 0
+        self.completed_tokens = 0
+        self.throttled = 0
+        self.retried = 0
+        self.started = None
+        self.finished = None
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.updated = now
+
+    def acquire(self, tokens):
+        # A request larger than the whole quota could never be admitted, so it only waits for a full bucket
+        tokens = min(tokens, self.tpm)
+        with self._cond:
+            while True:
+                now = self.clock()
+                self._refill(now)
+                wait = self.paused_until - now
+                if wait <= 0 and self.in_flight < int(self.concurrency):
+                    wait = max((tokens - self.tokens) * 60 / self.tpm, (1 - self.requests) * 60 / self.rpm)
+                    if wait <= 0:
+                        self.tokens -= tokens
+                        self.requests -= 1
+                        self.in_flight += 1
+                        if self.started is None:
+                            self.started = now
+                        return
+                # Without a time to wait for, the request waits for another one to finish
+                self._cond.wait(timeout=wait if wait > 0 else None)
+
+    def release(self, tokens=0, headers=None, retry_after=None):
+        """
+        Call after each request: with the token count of a successful one, or with the `retry_after` seconds of a throttled one
+        """
+        with self._cond:
+            now = self.clock()
+            self.in_flight -= 1
+            self.finished = now
+            if headers is not None:
+                self._refill(now)
+                remaining_tokens = header_number(headers, "x-ratelimit-remaining-tokens")
+                remaining_requests = header_number(headers, "x-ratelimit-remaining-requests")
+                if remaining_tokens is not None:
+                    self.tokens = min(self.tokens, remaining_tokens)
+                if remaining_requests is not None:
+                    self.requests = min(self.requests, remaining_requests)
+            if retry_after is not None:
+                self.throttled += 1
+                self.concurrency = max(1.0, self.concurrency / 2)
+                self.paused_until = max(self.paused_until, now + retry_after)
+            elif tokens:
+                self.completed += 1
+                self.completed_tokens += tokens
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self._cond.notify_all()
+
+    def call(self, tokens, request):
+        """
+        Runs `request`, returning a raw response of the OpenAI client, within the quota and retries it when it is throttled
+        or fails on the connection or the server. Returns the parsed response.
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            self.acquire(tokens)
+            try:
+                response = request()
+            except RateLimitError as e:
+                retry_after = retry_after_seconds(e.response.headers, min(60, 2 ** attempt))
+                self.release(headers=e.response.headers, retry_after=retry_after)
+                if args.verbose: logger.info(f"Rate limited on the OpenAI embeddings API, retrying in {retry_after:.1f}s...")
+                error = e
+            except (APIConnectionError, InternalServerError) as e:
+                self.release()
+                if args.verbose: logger.info(f"Got an error from the OpenAI embeddings API -> {e}, retrying...")
+                self.sleep(min(60, 2 ** attempt))
+                error = e
+            except BaseException:
+                self.release()
+                raise
+            else:
+                self.release(tokens=tokens, headers=response.headers)
+                return response.parse()
+            with self._cond:
+                self.retried += 1
+        raise error
+
+    def summary(self):
+        elapsed = (self.finished or 0) - (self.started or 0)
+        throughput = self.completed_tokens * 60 / elapsed if elapsed > 0 else 0
+        return (f"Embedding requests: {self.completed} requests, {self.completed_tokens} tokens in {elapsed:.1f}s ({throughput:.0f} tokens/min), "
+                f"{self.throttled} throttled, {self.retried} retried, concurrency {self.concurrency:.1f}")
 
-@retry(wait=wait_random_exponential(min=15, max=60), stop=stop_after_attempt(15), before_sleep=before_retry_sleep)
 def compute_embedding(text):
-    response= openai_client.embeddings.create(input=text, model=args.openaideployment)
+    response = embedding_scheduler.call(calculate_tokens_emb_aoai(text), lambda: openai_client.embeddings.with_raw_response.create(input=text, model=args.openaideployment))
     return response.data[0].embedding
 
-@retry(wait=wait_random_exponential(min=15, max=60), stop=stop_after_attempt(15), before_sleep=before_retry_sleep)
-def compute_embedding_in_batch(texts):
-    emb_response= openai_client.embeddings.create(input=texts, model=args.openaideployment)
+def compute_embedding_in_batch(texts, token_count):
+    emb_response = embedding_scheduler.call(token_count, lambda: openai_client.embeddings.with_raw_response.create(input=texts, model=args.openaideployment))
     return [data.embedding for data in emb_response.data]
 
+class EmbeddingCache:
+    """
+    On-disk (SQLite) cache of embeddings keyed by the hash of (model, deployment, text), so re-runs and texts repeated
+    across sections don't call the embeddings API again. Embeddings are stored as float32, the type of the index field.
+    """
+    def __init__(self, path, model, deployment):
+        self.model = model
+        self.deployment = deployment
+        self.hits = 0
+        self.deduplicated = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB NOT NULL)")
+        self._conn.commit()
+
+    def key(self, text):
+        return hashlib.sha256(f"{self.model}\0{self.deployment}\0{text}".encode()).hexdigest()
+
+    def lookup(self, texts):
+        """
+        Returns the cached embeddings by text, and the other texts to compute, each once
+        """
+        keys = {self.key(text): text for text in texts}
+        found = {}
+        with self._lock:
+            key_list = list(keys)
+            for i in range(0, len(key_list), 500):
+                chunk = key_list[i:i + 500]
+                rows = self._conn.execute(f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+                for key, blob in rows:
+                    embedding = array("f")
+                    embedding.frombytes(blob)
+                    found[keys[key]] = embedding.tolist()
+            missing = [text for text in keys.values() if text not in found]
+            hits = sum(1 for text in texts if text in found)
+            self.hits += hits
+            self.misses += len(missing)
+            self.deduplicated += len(texts) - hits - len(missing)
+        return found, missing
+
+    def put_many(self, embeddings):
+        rows = [(self.key(text), array("f", embedding).tobytes()) for text, embedding in embeddings.items()]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)", rows)
+            self._conn.commit()
+
+    def summary(self):
+        total = self.hits + self.deduplicated + self.misses
+        hit_rate = (self.hits + self.deduplicated) / total if total else 0
+        return f"Embedding cache: {self.hits} hits, {self.deduplicated} duplicates in this run, {self.misses} computed ({hit_rate:.1%} hit rate)"
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def get_embedding(text):
+    embeddings, missing = embedding_cache.lookup([text])
+    if missing:
+        embeddings[text] = compute_embedding(text)
+        embedding_cache.put_many(embeddings)
+    return embeddings[text]
+
 def create_search_index():
     if args.verbose: logger.info(f"Ensuring search index {args.index} exists")
     index_client = SearchIndexClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
@@ -321,57 +537,104 @@ def create_search_index():
     else:
         if args.verbose: logger.info(f"Search index {args.index} already exists")
 
+def embed_batch(texts, token_count):
+    embeddings = dict(zip(texts, compute_embedding_in_batch(texts, token_count)))
+    if args.verbose: logger.info(f"Batch Completed. Batch size  {len(texts)} Token count {token_count}")
+    embedding_cache.put_many(embeddings)
+    return embeddings
+
 def update_embeddings_in_batch(sections):
+    sections = list(sections)
+    # Only texts that are not cached are sent, each once
+    embeddings, texts = embedding_cache.lookup([s["content"] for s in sections])
+    token_limit = SUPPORTED_BATCH_AOAI_MODEL[args.openaimodelname]['token_limit']
+    max_batch_size = SUPPORTED_BATCH_AOAI_MODEL[args.openaimodelname]['max_batch_size']
     batch_queue = []
-    copy_s = []
-    batch_response = {}
     token_count = 0
-    for s in sections:
-        token_count += calculate_tokens_emb_aoai(s["content"])
-        if token_count <= SUPPORTED_BATCH_AOAI_MODEL[args.openaimodelname]['token_limit'] and len(batch_queue) < SUPPORTED_BATCH_AOAI_MODEL[args.openaimodelname]['max_batch_size']:
-            batch_queue.append(s)
-            copy_s.append(s)
-        else:
-            emb_responses = compute_embedding_in_batch([item["content"] for item in batch_queue])
-            if args.verbose: logger.info(f"Batch Completed. Batch size  {len(batch_queue)} Token count {token_count}")
-            for emb, item in zip(emb_responses, batch_queue):
-                batch_response[item["id"]] = emb
+    for text in texts:
+        tokens = calculate_tokens_emb_aoai(text)
+        if batch_queue and (token_count + tokens > token_limit or len(batch_queue) >= max_batch_size):
+            embeddings.update(embed_batch(batch_queue, token_count))
             batch_queue = []
-            batch_queue.append(s)
-            token_count = calculate_tokens_emb_aoai(s["content"])
+            token_count = 0
+        batch_queue.append(text)
+        token_count += tokens
 
     if batch_queue:
-        emb_responses = compute_embedding_in_batch([item["content"] for item in batch_queue])
-        if args.verbose: logger.info(f"Batch Completed. Batch size  {len(batch_queue)} Token count {token_count}")
-        for emb, item in zip(emb_responses, batch_queue):
-            batch_response[item["id"]] = emb
+        embeddings.update(embed_batch(batch_queue, token_count))
 
-    for s in copy_s:
-        s["embedding"] = batch_response[s["id"]]
+    for s in sections:
+        s["embedding"] = embeddings[s["content"]]
         yield s
 
-def index_sections(filename, sections):
+def index_sections(filename, sections, invalidate_cache=True):
+    """
+    Upload the sections to the search index and return the ids of the sections that succeeded
+    """
     if args.verbose: logger.info(f"Indexing sections from '{filename}' into search index '{args.index}'")
     search_client = SearchClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
                                     index_name=args.index,
                                     credential=search_creds)
     i = 0
     batch = []
+    succeeded_ids = set()
     for s in sections:
         batch.append(s)
         i += 1
         if i % 1000 == 0:
             results = search_client.upload_documents(documents=batch)
-            succeeded = sum([1 for r in results if r.succeeded])
-            if args.verbose: logger.info(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+            succeeded_ids.update(r.key for r in results if r.succeeded)
+            if args.verbose: logger.info(f"\tIndexed {len(results)} sections, {sum([1 for r in results if r.succeeded])} succeeded")
             batch = []
 
     if len(batch) > 0:
         results = search_client.upload_documents(documents=batch)
-        succeeded = sum([1 for r in results if r.succeeded])
-        if args.verbose: logger.info(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+        succeeded_ids.update(r.key for r in results if r.succeeded)
+        if args.verbose: logger.info(f"\tIndexed {len(results)} sections, {sum([1 for r in results if r.succeeded])} succeeded")
+    if invalidate_cache:
+        invalidate_search_cache()
+    return succeeded_ids
+
+def invalidate_search_cache():
+    """
+    Bump the index version stored in the metadata of the INDEX_VERSION_BLOB blob so that the app's search result cache
+    drops results computed before this change to the index
+    """
+    if args.storageaccount is None or args.container is None:
+        return
+    try:
+        blob_service = BlobServiceClient(account_url=f"https://{args.storageaccount}.blob.core.windows.net", credential=storage_creds)
+        blob_container = blob_service.get_container_client(args.container)
+        if not blob_container.exists():
+            return
+        version = bump_index_version(blob_container.get_blob_client(INDEX_VERSION_BLOB))
+        if args.verbose: logger.info(f"\tSet {INDEX_VERSION_METADATA_KEY} of '{args.container}/{INDEX_VERSION_BLOB}' to {version}")
+    except Exception as e:
+        logger.info(f"\tGot an error while updating the index version -> {e}")
+
+def bump_index_version(blob_client):
+    """
+    Increment the index version of `blob_client` with a conditional update on its ETag, retrying when another
+    run of this script changed it in between, and return the new version
+    """
+    for attempt in range(INDEX_VERSION_MAX_ATTEMPTS):
+        try:
+            properties = blob_client.get_blob_properties()
+        except ResourceNotFoundError:
+            try:
+                blob_client.upload_blob(b"", metadata={INDEX_VERSION_METADATA_KEY: "1"}, overwrite=False)
+                return 1
+            except ResourceExistsError:
+                continue
+        version = int(properties.metadata.get(INDEX_VERSION_METADATA_KEY) or 0) + 1
+        try:
+            blob_client.set_blob_metadata({INDEX_VERSION_METADATA_KEY: str(version)}, etag=properties.etag, match_condition=MatchConditions.IfNotModified)
+            return version
+        except ResourceModifiedError:
+            continue
+    raise RuntimeError(f"{INDEX_VERSION_BLOB} kept changing, gave up after {INDEX_VERSION_MAX_ATTEMPTS} attempts")
 
-def remove_from_index(filename):
+def remove_from_index(filename, invalidate_cache=True):
     if args.verbose: logger.info(f"Removing sections from '{filename or '<all>'}' from search index '{args.index}'")
     search_client = SearchClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
                                     index_name=args.index,
@@ -385,33 +648,325 @@ def remove_from_index(filename):
         if args.verbose: logger.info(f"\tRemoved {len(r)} sections from index")
         # It can take a few seconds for search results to reflect changes, so wait a bit
         time.sleep(2)
+    if invalidate_cache:
+        invalidate_search_cache()
+
+def list_files(path_pattern: str):
+    """
+    Recursively yield the files under `path_pattern`
+    """
+    for filename in glob.glob(path_pattern):
+        if os.path.isdir(filename):
+            yield from list_files(filename + "/*")
+        else:
+            yield filename
+
+def init_parse_worker(worker_args):
+    # Worker processes don't run the __main__ block (e.g. on Windows they are spawned), so set the globals they use here
+    global args
+    args = worker_args
+    if args.verbose:
+        logging.basicConfig(format="%(message)s")
+        logger.setLevel(logging.INFO)
+
+def split_document(filename, page_map):
+    """
+    Runs in a worker process: extracts the text with the local PDF parser when `page_map` is None and splits it into sections
+    """
+    if page_map is None:
+        page_map = get_document_text(filename)
+    category = os.path.basename(os.path.dirname(filename))
+    return list(create_sections(os.path.basename(filename), page_map, False, category))
+
+def embed_sections(sections, vectors_batch_support):
+    if vectors_batch_support:
+        return list(update_embeddings_in_batch(sections))
+    for s in sections:
+        s["embedding"] = get_embedding(s["content"])
+    return sections
+
+def file_hash(filename):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def section_hash(section, embedding_model):
+    # Sections are re-embedded when the embedding model changes, so it is part of the hash
+    fields = {key: section[key] for key in ("id", "content", "category", "sourcepage", "sourcefile")}
+    return hashlib.sha256(json.dumps([fields, embedding_model], ensure_ascii=False, sort_keys=True).encode()).hexdigest()
 
-def read_files(path_pattern: str, use_vectors: bool, vectors_batch_support: bool):
+def delete_sections(section_ids):
+    search_client = SearchClient(endpoint=f"https://{args.searchservice}.search.windows.net/",
+                                    index_name=args.index,
+                                    credential=search_creds)
+    for i in range(0, len(section_ids), 1000):
+        r = search_client.delete_documents(documents=[{ "id": id } for id in section_ids[i:i + 1000]])
+        if args.verbose: logger.info(f"\tRemoved {len(r)} stale sections from index")
+
+class IngestionManifest:
+    """
+    Local record of the files ingested into an index, so a re-run only processes new or changed files
+    and an interrupted run resumes where it stopped.
+    For each file it keeps the file hash, the completed stages ("upload", "index"), the hash of each section in the index
+    and the embedding model the file was indexed with (None without vectors).
+    Stages are appended to a journal as they complete; the journal is folded into the manifest when the run ends,
+    or when the next run starts after an interrupted one.
+    """
+    def __init__(self, path, index):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.index = index
+        self.files = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                manifest = json.load(f)
+            # A manifest of another index doesn't tell what is in this one
+            if manifest.get("index") == index:
+                self.files = manifest["files"]
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self._apply(json.loads(line))
+                    except json.JSONDecodeError:
+                        # The last line may be cut off by the interruption
+                        break
+        self.save()
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    def _apply(self, entry):
+        if entry["index"] != self.index:
+            return
+        filename = entry["file"]
+        if entry["stage"] == "remove":
+            if filename is None:
+                self.files.clear()
+            else:
+                self.files.pop(filename, None)
+            return
+        state = self.files.get(filename)
+        if state is None or state["hash"] != entry["hash"]:
+            # The sections stay those of the previous version until the new one is indexed
+            state = {"hash": entry["hash"], "stages": [], "sections": state["sections"] if state else {}}
+            self.files[filename] = state
+        if entry["stage"] is None:
+            # Partly indexed: the file has to be indexed again, even if an earlier run completed it
+            if "index" in state["stages"]:
+                state["stages"].remove("index")
+        elif entry["stage"] not in state["stages"]:
+            state["stages"].append(entry["stage"])
+        if "sections" in entry:
+            state["sections"] = entry["sections"]
+        if "embedding_model" in entry:
+            state["embedding_model"] = entry["embedding_model"]
+
+    def record(self, filename, digest, stage, sections=None, embedding_model=None):
+        """
+        Record that `stage` is done for this version of the file.
+        With stage None only the sections are recorded, e.g. those that were indexed when some sections failed.
+        """
+        entry = {"index": self.index, "file": filename, "hash": digest, "stage": stage}
+        if sections is not None:
+            entry["sections"] = sections
+            entry["embedding_model"] = embedding_model
+        with self._lock:
+            self._journal.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._journal.flush()
+            self._apply(entry)
+
+    def is_done(self, filename, digest, stage, embedding_model=None):
+        """
+        Whether `stage` is done for this version of the file.
+        The "index" stage also has to be done with the same embedding model, so --openaideployment or --novectors re-embeds the files.
+        """
+        with self._lock:
+            state = self.files.get(filename)
+            if state is None or state["hash"] != digest or stage not in state["stages"]:
+                return False
+            return stage != "index" or state.get("embedding_model") == embedding_model
+
+    def sections(self, filename):
+        with self._lock:
+            state = self.files.get(filename)
+            return dict(state["sections"]) if state else {}
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"index": self.index, "files": self.files}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        open(self.journal_path, "w").close()
+
+    def close(self):
+        with self._lock:
+            self._journal.close()
+            self.save()
+
+STOP = object()
+
+class PipelineStage:
+    """
+    Runs `func(document)` for the documents of `inbox` in `workers` threads and puts the documents in `outbox`.
+    A document is a dict with the "filename" of the file and what the previous stages have added to it.
+    The queues between stages are bounded, so a slow stage makes the previous stages wait instead of piling up documents in memory.
+    A file whose stage fails is logged and skipped, like read_files did before.
+    """
+    def __init__(self, name, func, workers, inbox, outbox=None):
+        self.name = name
+        self.func = func
+        self.inbox = inbox
+        self.outbox = outbox
+        self.processed = 0
+        self.failed = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True) for i in range(max(1, workers))]
+        for t in self._threads:
+            t.start()
+
+    def _work(self):
+        while True:
+            document = self.inbox.get()
+            if document is STOP:
+                return
+            start = time.perf_counter()
+            try:
+                self.func(document)
+            except Exception as e:
+                logger.info(f"\tGot an error in the {self.name} stage for {document['filename']} -> {e} --> skipping file")
+                with self._lock:
+                    self.failed += 1
+                continue
+            with self._lock:
+                self.processed += 1
+                self.seconds += time.perf_counter() - start
+            if self.outbox is not None:
+                self.outbox.put(document)
+
+    def close(self):
+        """
+        Wait until all the documents put in the inbox are processed
+        """
+        for _ in self._threads:
+            self.inbox.put(STOP)
+        for t in self._threads:
+            t.join()
+        logger.info(f"\t{self.name}: {self.processed} files ({self.seconds:.1f}s of work), {self.failed} failed")
+
+def read_files(path_pattern: str, use_vectors: bool, vectors_batch_support: bool, manifest: IngestionManifest):
     """
     Recursively read directory structure under `path_pattern`
     and execute indexing for the individual files
     """
-    for filename in glob.glob(path_pattern):
-        if args.verbose: logger.info(f"Processing '{filename}'")
-        if args.remove:
+    if args.remove:
+        for filename in glob.glob(path_pattern):
+            if args.verbose: logger.info(f"Processing '{filename}'")
             remove_blobs(filename)
-            remove_from_index(filename)
+            remove_from_index(filename, invalidate_cache=False)
+            manifest.record(filename, None, "remove")
+        # The index version is bumped once for all removed files
+        invalidate_search_cache()
+        return
+
+    # Each stage runs concurrently with its own number of workers:
+    #   upload blobs (threads)
+    #   Document Intelligence (threads) -> split (process pool) -> embeddings (threads) -> index (threads)
+    # The local PDF parser runs in the process pool together with the split.
+    start = time.perf_counter()
+    embedding_model = args.openaideployment if use_vectors else None
+    counts = {"skipped files": 0, "changed sections": 0, "unchanged sections": 0, "stale sections": 0}
+    counts_lock = threading.Lock()
+
+    def make_queue():
+        return queue.Queue(maxsize=args.queuesize)
+
+    def upload(document):
+        upload_blobs(document["filename"], blob_container)
+        manifest.record(document["filename"], document["hash"], "upload")
+
+    def extract(document):
+        document["page_map"] = get_document_text(document["filename"])
+
+    def split(document):
+        filename = document["filename"]
+        sections = pool.submit(split_document, filename, document.pop("page_map", None)).result()
+        # Only new or changed sections are embedded and indexed, and sections the file no longer has are deleted
+        indexed = manifest.sections(filename)
+        document["section_hashes"] = {s["id"]: section_hash(s, embedding_model) for s in sections}
+        document["sections"] = [s for s in sections if args.force or indexed.get(s["id"]) != document["section_hashes"][s["id"]]]
+        document["stale"] = [id for id in indexed if id not in document["section_hashes"]]
+        with counts_lock:
+            counts["changed sections"] += len(document["sections"])
+            counts["unchanged sections"] += len(sections) - len(document["sections"])
+            counts["stale sections"] += len(document["stale"])
+
+    def embed(document):
+        document["sections"] = embed_sections(document["sections"], vectors_batch_support)
+
+    def index(document):
+        filename = document["filename"]
+        failed = []
+        if document["sections"]:
+            succeeded_ids = index_sections(os.path.basename(filename), document["sections"], invalidate_cache=False)
+            failed = [s["id"] for s in document["sections"] if s["id"] not in succeeded_ids]
+        if document["stale"]:
+            delete_sections(document["stale"])
+        section_hashes = document["section_hashes"]
+        if failed:
+            # Failed sections keep the hash of the version still in the index (if any), so the next run indexes them again
+            indexed = manifest.sections(filename)
+            section_hashes = {id: h for id, h in section_hashes.items() if id not in failed}
+            section_hashes.update({id: indexed[id] for id in failed if id in indexed})
+            manifest.record(filename, document["hash"], None, sections=section_hashes, embedding_model=embedding_model)
+            raise RuntimeError(f"{len(failed)} of {len(document['sections'])} sections failed to index")
+        manifest.record(filename, document["hash"], "index", sections=section_hashes, embedding_model=embedding_model)
+
+    with ProcessPoolExecutor(max_workers=args.parseworkers, initializer=init_parse_worker, initargs=(args,)) as pool:
+        split_queue, index_queue = make_queue(), make_queue()
+        stages = []
+        if not args.skipblobs:
+            blob_container = get_blob_container()
+            upload_queue = make_queue()
+            stages.append(PipelineStage("upload", upload, args.uploadworkers, upload_queue))
+        if not args.localpdfparser:
+            extract_queue = make_queue()
+            stages.append(PipelineStage("extract", extract, args.formrecognizerworkers, extract_queue, split_queue))
+        split_workers = args.parseworkers or os.cpu_count() or 1
+        if use_vectors:
+            embed_queue = make_queue()
+            stages.append(PipelineStage("split", split, split_workers, split_queue, embed_queue))
+            stages.append(PipelineStage("embed", embed, args.embeddingworkers, embed_queue, index_queue))
         else:
-            if os.path.isdir(filename):
-                read_files(filename + "/*", use_vectors, vectors_batch_support)
+            stages.append(PipelineStage("split", split, split_workers, split_queue, index_queue))
+        stages.append(PipelineStage("index", index, args.indexworkers, index_queue))
+
+        for filename in list_files(path_pattern):
+            if os.path.abspath(filename).startswith(os.path.abspath(manifest.path)):
                 continue
-            try:
-                if not args.skipblobs:
-                    upload_blobs(filename)
-                page_map = get_document_text(filename)
-                category = os.path.basename(os.path.dirname(filename))
-                sections = create_sections(os.path.basename(filename), page_map, use_vectors and not vectors_batch_support, category)
-
-                if use_vectors and vectors_batch_support:
-                    sections = update_embeddings_in_batch(sections)
-                index_sections(os.path.basename(filename), sections)
-            except Exception as e:
-                logger.info(f"\tGot an error while reading {filename} -> {e} --> skipping file")
+            document = {"filename": filename, "hash": file_hash(filename)}
+            # Stages already completed for this version of the file (by a previous or interrupted run) are skipped
+            upload_done = args.skipblobs or manifest.is_done(filename, document["hash"], "upload")
+            index_done = manifest.is_done(filename, document["hash"], "index", embedding_model)
+            if not args.force and upload_done and index_done:
+                if args.verbose: logger.info(f"Skipping unchanged '{filename}'")
+                counts["skipped files"] += 1
+                continue
+            if args.verbose: logger.info(f"Processing '{filename}'")
+            if not args.skipblobs and (args.force or not upload_done):
+                upload_queue.put(document)
+            if args.force or not index_done:
+                if args.localpdfparser:
+                    split_queue.put(document)
+                else:
+                    extract_queue.put(document)
+        # Stages are listed in pipeline order, so each one is closed after all of its inputs are done
+        for stage in stages:
+            stage.close()
+    invalidate_search_cache()
+    logger.info(f"Processed files in {time.perf_counter() - start:.1f}s: " + ", ".join(f"{count} {name}" for name, count in counts.items()))
 
 if __name__ == "__main__":
 
@@ -434,12 +989,24 @@ if __name__ == "__main__":
     parser.add_argument("--openaimodelname", help="Name of the Azure OpenAI embedding model ('text-embedding-ada-002' recommended)")
     parser.add_argument("--novectors", action="store_true", help="Don't compute embeddings for the sections (e.g. don't call the OpenAI embeddings API during indexing)")
     parser.add_argument("--disablebatchvectors", action="store_true", help="Don't compute embeddings in batch for the sections")
+    parser.add_argument("--embeddingcache", default=".prepdocs_embeddings.sqlite", help="SQLite file caching the embeddings of section texts across runs")
+    parser.add_argument("--noembeddingcache", action="store_true", help="Don't read or write the embedding cache file (identical texts are still embedded once per run)")
     parser.add_argument("--openaikey", required=False, help="Optional. Use this Azure OpenAI account key instead of the current user identity to login (use az login to set current user for Azure)")
     parser.add_argument("--remove", action="store_true", help="Remove references to this document from blob storage and the search index")
     parser.add_argument("--removeall", action="store_true", help="Remove all blobs from blob storage and documents from the search index")
     parser.add_argument("--localpdfparser", action="store_true", help="Use PyPdf local PDF parser (supports only digital PDFs) instead of Azure AI Document Intelligence service to extract text, tables and layout from the documents")
     parser.add_argument("--formrecognizerservice", required=False, help="Optional. Name of the Azure AI Document Intelligence service which will be used to extract text, tables and layout from the documents (must exist already)")
     parser.add_argument("--formrecognizerkey", required=False, help="Optional. Use this Azure AI Document Intelligence account key instead of the current user identity to login (use az login to set current user for Azure)")
+    parser.add_argument("--manifest", default=".prepdocs_manifest.json", help="Local file recording the files and sections already ingested, so unchanged files are skipped and an interrupted run resumes")
+    parser.add_argument("--force", action="store_true", help="Process all files again, even if the manifest says they are unchanged")
+    parser.add_argument("--uploadworkers", type=int, default=4, help="Number of threads uploading pages to Azure Blob Storage")
+    parser.add_argument("--formrecognizerworkers", type=int, default=4, help="Number of concurrent Azure AI Document Intelligence requests")
+    parser.add_argument("--parseworkers", type=int, default=None, help="Number of processes parsing (with --localpdfparser) and splitting documents (default: number of CPUs)")
+    parser.add_argument("--embeddingworkers", type=int, default=4, help="Number of threads computing embeddings, the maximum number of concurrent embedding requests")
+    parser.add_argument("--openaitpm", type=int, default=120000, help="Tokens per minute quota of the Azure OpenAI embedding deployment")
+    parser.add_argument("--openairpm", type=int, default=720, help="Requests per minute quota of the Azure OpenAI embedding deployment")
+    parser.add_argument("--indexworkers", type=int, default=2, help="Number of threads uploading sections to the search index")
+    parser.add_argument("--queuesize", type=int, default=16, help="Maximum number of documents waiting between two stages of the pipeline")
     parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
     args = parser.parse_args()
 
@@ -456,8 +1023,7 @@ if __name__ == "__main__":
     use_vectors = not args.novectors
     compute_vectors_in_batch = not args.disablebatchvectors and args.openaimodelname in SUPPORTED_BATCH_AOAI_MODEL
 
-    if not args.skipblobs:
-        storage_creds = default_creds if args.storagekey is None else args.storagekey
+    storage_creds = default_creds if args.storagekey is None else args.storagekey
     if not args.localpdfparser:
         # check if Azure AI Document Intelligence credentials are provided
         if args.formrecognizerservice is None:
@@ -478,17 +1044,31 @@ if __name__ == "__main__":
                 api_version=openai_api_version,
                 azure_endpoint=openai_endpoint,
                 azure_ad_token_provider=token_provider,
+                max_retries=0,
             )
         else:
             # openai_api_type = "azure"
             openai_api_key = args.openaikey
-            openai_client = AzureOpenAI(api_key=openai_api_key, api_version=openai_api_version, endpoint=openai_endpoint)
+            openai_client = AzureOpenAI(api_key=openai_api_key, api_version=openai_api_version, azure_endpoint=openai_endpoint, max_retries=0)
 
-    if args.removeall:
-        remove_blobs(None)
-        remove_from_index(None)
-    else:
-        if not args.remove:
-            create_search_index()
-        logger.info("Processing files...")
-        read_files(args.files, use_vectors, compute_vectors_in_batch)
\ No newline at end of file
+        # The scheduler retries throttled requests, so the client doesn't retry them itself
+        embedding_scheduler = EmbeddingScheduler(args.openaitpm, args.openairpm, args.embeddingworkers)
+        embedding_cache = EmbeddingCache(":memory:" if args.noembeddingcache else args.embeddingcache, args.openaimodelname, args.openaideployment)
+
+    manifest = IngestionManifest(args.manifest, args.index)
+    try:
+        if args.removeall:
+            remove_blobs(None)
+            remove_from_index(None)
+            manifest.record(None, None, "remove")
+        else:
+            if not args.remove:
+                create_search_index()
+            logger.info("Processing files...")
+            read_files(args.files, use_vectors, compute_vectors_in_batch, manifest)
+    finally:
+        manifest.close()
+        if embedding_cache is not None:
+            logger.info(embedding_cache.summary())
+            logger.info(embedding_scheduler.summary())
+            embedding_cache.close()
\ No newline at end of file
@@ -0,0 +1,70 @@
+from core.answercache import AnswerCache, answer_cache_scope
+
+
+def test_answercache_similar_question_hits():
+    cache = AnswerCache(threshold=0.95)
+    scope = answer_cache_scope("ask", "rtr", {"top": 3})
+    cache.store(scope, [1.0, 0.0, 0.0], {"answer": "Paris"})
+    assert cache.lookup(scope, [0.99, 0.05, 0.0]) == {"answer": "Paris"}
+    assert cache.lookup(scope, [0.0, 1.0, 0.0]) is None
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+
+def test_answercache_scope_separates_overrides():
+    cache = AnswerCache()
+    cache.store(answer_cache_scope("ask", "rtr", {"top": 3}), [1.0, 0.0], {"answer": "Paris"})
+    assert cache.lookup(answer_cache_scope("ask", "rtr", {"top": 5}), [1.0, 0.0]) is None
+    assert cache.lookup(answer_cache_scope("ask", "rrr", {"top": 3}), [1.0, 0.0]) is None
+    assert cache.lookup(answer_cache_scope("chat", "rtr", {"top": 3}, [{"user": "Hi", "bot": "Hello"}]), [1.0, 0.0]) is None
+    # overrides that don't change the result share the scope
+    assert cache.lookup(answer_cache_scope("ask", "rtr", {"top": 3, "temperature": 0.7}), [1.0, 0.0]) == {"answer": "Paris"}
+
+
+def test_answercache_ttl(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr("core.answercache.time.monotonic", lambda: now)
+    cache = AnswerCache(ttl=10)
+    cache.store("scope", [1.0, 0.0], {"answer": "Paris"})
+    now = 1011.0
+    assert cache.lookup("scope", [1.0, 0.0]) is None
+    assert len(cache) == 0
+
+
+def test_answercache_store_prunes_expired_answers_of_other_scopes(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr("core.answercache.time.monotonic", lambda: now)
+    cache = AnswerCache(ttl=10)
+    cache.store("a", [1.0, 0.0], {"answer": "Paris"})
+    cache.store("b", [1.0, 0.0], {"answer": "Seoul"})
+    now = 1011.0
+    # scope a는 다시 조회되지 않아도 다른 scope에 저장할 때 만료된 답변이 정리된다.
+    cache.store("c", [1.0, 0.0], {"answer": "Tokyo"})
+    assert len(cache) == 1
+    assert list(cache._scope_ids) == ["c"]
+    assert cache._scope_matrix == {}
+
+
+def test_answercache_expired_best_match_falls_back_to_fresh_entry(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr("core.answercache.time.monotonic", lambda: now)
+    cache = AnswerCache(threshold=0.95, ttl=10)
+    cache.store("scope", [1.0, 0.0], {"answer": "old"})
+    now = 1005.0
+    cache.store("scope", [0.99, 0.05], {"answer": "new"})
+    now = 1012.0
+    assert cache.lookup("scope", [1.0, 0.0]) == {"answer": "new"}
+    assert len(cache) == 1
+    now = 1016.0
+    cache.store("scope", [0.0, 1.0], {"answer": "other"})
+    assert len(cache) == 1
+
+def test_answercache_lru_eviction():
+    cache = AnswerCache(max_entries=2)
+    cache.store("scope", [1.0, 0.0, 0.0], {"answer": "a"})
+    cache.store("scope", [0.0, 1.0, 0.0], {"answer": "b"})
+    assert cache.lookup("scope", [1.0, 0.0, 0.0]) == {"answer": "a"}
+    cache.store("scope", [0.0, 0.0, 1.0], {"answer": "c"})
+    assert len(cache) == 2
+    assert cache.lookup("scope", [0.0, 1.0, 0.0]) is None
+    assert cache.lookup("scope", [1.0, 0.0, 0.0]) == {"answer": "a"}
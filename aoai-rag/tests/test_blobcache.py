@@ -0,0 +1,174 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+from quart import Quart, Response, request
+
+from core.blobcache import (
+    BlobCache,
+    BlobStreamBody,
+    CachedFileBody,
+    CachingBlobBody,
+    make_conditional,
+)
+
+LAST_MODIFIED = datetime(2023, 12, 1, tzinfo=timezone.utc)
+
+
+class MockDownloader:
+    def __init__(self, data):
+        self.data = data
+
+    async def chunks(self):
+        for i in range(0, len(self.data), 4):
+            yield self.data[i:i + 4]
+
+
+class MockBlobClient:
+    def __init__(self, data):
+        self.data = data
+        self.downloads = []
+
+    async def download_blob(self, offset=None, length=None):
+        self.downloads.append((offset, length))
+        start = offset or 0
+        end = start + length if length is not None else len(self.data)
+        return MockDownloader(self.data[start:end])
+
+
+@pytest.mark.asyncio
+async def test_blobcache_put_and_get(tmp_path):
+    cache = BlobCache(str(tmp_path))
+    assert cache.get("info1-1.pdf") is None
+    blob_client = MockBlobClient(b"%PDF-1.4 page one")
+    entry = await cache.put("info1-1.pdf", blob_client, "0x8DC", LAST_MODIFIED, "application/pdf", 17)
+    with open(entry.file_path, "rb") as f:
+        assert f.read() == b"%PDF-1.4 page one"
+    assert cache.get("info1-1.pdf") == entry
+    assert cache.stats() == {"hits": 1, "misses": 1, "entries": 1, "bytes": 17}
+
+    # 워커가 재시작돼도 디스크의 캐시를 그대로 사용한다.
+    reloaded = BlobCache(str(tmp_path))
+    assert reloaded.get("info1-1.pdf").etag == "0x8DC"
+
+
+@pytest.mark.asyncio
+async def test_blobcache_evicts_least_recently_used(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=20, max_file_bytes=10, eviction_grace=0)
+    assert not cache.accepts(11)
+    for name in ("a.pdf", "b.pdf"):
+        await cache.put(name, MockBlobClient(b"0123456789"), name, LAST_MODIFIED, "application/pdf", 10)
+    cache.get("a.pdf")
+    await cache.put("c.pdf", MockBlobClient(b"0123456789"), "c", LAST_MODIFIED, "application/pdf", 10)
+    assert cache.get("b.pdf") is None
+    assert cache.get("a.pdf") and cache.get("c.pdf")
+    assert len(list(tmp_path.glob("*.blob"))) == 2
+
+    # 같은 디렉터리를 쓰는 다른 워커도 전체 크기를 기준으로 지운다.
+    other = BlobCache(str(tmp_path), max_bytes=20, max_file_bytes=10, eviction_grace=0)
+    assert other.get("c.pdf").etag == "c"
+    await other.put("d.pdf", MockBlobClient(b"0123456789"), "d", LAST_MODIFIED, "application/pdf", 10)
+    assert cache.get("a.pdf") is None
+    assert other.stats()["bytes"] == 20
+
+
+class SlowBlobClient(MockBlobClient):
+    async def download_blob(self, offset=None, length=None):
+        await asyncio.sleep(0.01)
+        return await super().download_blob(offset, length)
+
+
+@pytest.mark.asyncio
+async def test_blobcache_concurrent_puts_download_once(tmp_path):
+    cache = BlobCache(str(tmp_path))
+    blob_client = SlowBlobClient(b"%PDF-1.4 page one")
+    entries = await asyncio.gather(*[cache.put("a.pdf", blob_client, "0x1", LAST_MODIFIED, "application/pdf", 17) for _ in range(3)])
+    assert len(blob_client.downloads) == 1
+    assert [entry is None for entry in entries] == [False, True, True]
+    assert cache.get("a.pdf").size == 17
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+@pytest.mark.asyncio
+async def test_blobcache_revalidate(tmp_path, monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr("core.blobcache.time.time", lambda: now)
+    cache = BlobCache(str(tmp_path), ttl=10)
+    entry = await cache.put("a.pdf", MockBlobClient(b"data"), "0x1", LAST_MODIFIED, "application/pdf", 4)
+    now = 1011.0
+    assert not cache.is_fresh(entry)
+    assert cache.is_fresh(cache.revalidate("a.pdf"))
+
+
+def create_app(body_factory):
+    app = Quart(__name__)
+
+    @app.route("/content/<path>")
+    async def content(path):
+        body, size = body_factory()
+        response = Response(body, mimetype="application/pdf")
+        response.content_length = size
+        response.set_etag("0x8DC")
+        response.last_modified = LAST_MODIFIED
+        return await make_conditional(response, request, size)
+
+    return app
+
+
+@pytest.mark.asyncio
+async def test_blob_stream_body_range_and_etag():
+    blob_client = MockBlobClient(b"0123456789abcdef")
+    client = create_app(lambda: (BlobStreamBody(blob_client, 16), 16)).test_client()
+
+    response = await client.get("/content/a.pdf")
+    assert response.status_code == 200
+    assert await response.get_data() == b"0123456789abcdef"
+    assert response.headers["ETag"] == '"0x8DC"'
+
+    response = await client.get("/content/a.pdf", headers={"Range": "bytes=2-5"})
+    assert response.status_code == 206
+    assert await response.get_data() == b"2345"
+    assert response.headers["Content-Range"] == "bytes 2-5/16"
+    assert blob_client.downloads[-1] == (2, 4)
+
+    response = await client.get("/content/a.pdf", headers={"Range": "bytes=-3"})
+    assert await response.get_data() == b"def"
+
+    # 304와 416 응답은 블롭을 읽지 않는다.
+    downloads = len(blob_client.downloads)
+    response = await client.get("/content/a.pdf", headers={"If-None-Match": '"0x8DC"'})
+    assert response.status_code == 304
+    response = await client.get("/content/a.pdf", headers={"Range": "bytes=20-30"})
+    assert response.status_code == 416
+    assert len(blob_client.downloads) == downloads
+
+
+@pytest.mark.asyncio
+async def test_cached_file_body_range(tmp_path):
+    cache = BlobCache(str(tmp_path))
+    entry = await cache.put("a.pdf", MockBlobClient(b"0123456789"), "0x8DC", LAST_MODIFIED, "application/pdf", 10)
+    client = create_app(lambda: (CachedFileBody(entry.file_path), 10)).test_client()
+    response = await client.get("/content/a.pdf", headers={"Range": "bytes=-4"})
+    assert response.status_code == 206
+    assert await response.get_data() == b"6789"
+    assert response.headers["Content-Range"] == "bytes 6-9/10"
+
+
+@pytest.mark.asyncio
+async def test_caching_blob_body_streams_and_caches(tmp_path):
+    cache = BlobCache(str(tmp_path))
+    blob_client = MockBlobClient(b"0123456789")
+    client = create_app(lambda: (CachingBlobBody(cache, "a.pdf", blob_client, "0x8DC", LAST_MODIFIED, "application/pdf", 10), 10)).test_client()
+
+    # Range 요청은 일부만 받으므로 캐시하지 않는다.
+    response = await client.get("/content/a.pdf", headers={"Range": "bytes=2-5"})
+    assert await response.get_data() == b"2345"
+    assert cache.get("a.pdf") is None
+
+    response = await client.get("/content/a.pdf")
+    assert await response.get_data() == b"0123456789"
+    entry = cache.get("a.pdf")
+    with open(entry.file_path, "rb") as f:
+        assert f.read() == b"0123456789"
+    assert blob_client.downloads == [(2, 4), (0, 10)]
+    assert not list(tmp_path.glob("*.tmp"))
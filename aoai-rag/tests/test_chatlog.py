@@ -0,0 +1,133 @@
+import asyncio
+
+import pytest
+
+from approaches.chatreadretrieveread_cosmosdb import (
+    ChatReadRetrieveReadApproachCosmosDB,
+)
+from core.chatlog import ChatLogWriter, CosmosChatLogSink, SqliteChatLogSink
+
+
+def chat_item(i, session="s1"):
+    return {"id": f"id-{i}", "chat_session_id": session, "timestamp": f"2023-12-01T00:00:{i:02d}.000000Z", "conversation": []}
+
+
+class MockContainer:
+    def __init__(self):
+        self.batches = []
+
+    def upsert_item(self, item):
+        self.batches.append([item["id"]])
+
+    def execute_item_batch(self, operations, partition_key):
+        assert all(operation == "upsert" for operation, _ in operations)
+        self.batches.append((partition_key, [args[0]["id"] for _, args in operations]))
+
+
+class BlockedSink:
+    def __init__(self):
+        self.released = asyncio.Event()
+        self.items = []
+
+    async def write(self, items):
+        await self.released.wait()
+        self.items.extend(items)
+
+
+class FlakySink:
+    def __init__(self, failures):
+        self.failures = failures
+        self.items = []
+
+    async def write(self, items):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("cosmos unavailable")
+        self.items.extend(items)
+
+
+@pytest.mark.asyncio
+async def test_writer_batches_and_flushes_on_close(tmp_path):
+    sink = SqliteChatLogSink(str(tmp_path / "chatlog.sqlite"))
+    writer = ChatLogWriter(sink, batch_size=3, flush_interval=10)
+    for i in range(7):
+        assert writer.submit(chat_item(i))
+    await asyncio.sleep(0.05)
+    # 가득 찬 배치 두 개는 바로 쓰고, 남은 한 개는 종료할 때 쓴다.
+    assert writer.stats()["batches"] == 2
+    await writer.close()
+    assert [item["id"] for item in sink.read_all()] == [f"id-{i}" for i in range(7)]
+    assert writer.stats() == {"queued": 0, "written": 7, "batches": 3, "dropped": 0, "failed": 0}
+
+
+@pytest.mark.asyncio
+async def test_writer_drops_when_queue_is_full():
+    sink = BlockedSink()
+    writer = ChatLogWriter(sink, max_queue=2, batch_size=1, put_timeout=0.01)
+    for i in range(3):
+        assert writer.submit(chat_item(i))
+        await asyncio.sleep(0)
+    # 저장소가 멈춰 있는 동안 큐가 가득 차면 새 항목은 버린다.
+    assert not writer.submit(chat_item(3))
+    assert not await writer.put(chat_item(4))
+    assert writer.stats()["dropped"] == 2
+    sink.released.set()
+    await writer.close()
+    assert [item["id"] for item in sink.items] == ["id-0", "id-1", "id-2"]
+
+
+@pytest.mark.asyncio
+async def test_writer_retries_failed_batches():
+    sink = FlakySink(failures=2)
+    writer = ChatLogWriter(sink, flush_interval=0.01, max_retries=2, retry_backoff=0)
+    writer.submit(chat_item(0))
+    await writer.close()
+    assert [item["id"] for item in sink.items] == ["id-0"]
+    assert writer.stats()["failed"] == 0
+
+
+@pytest.mark.asyncio
+async def test_cosmos_sink_batches_per_partition():
+    container = MockContainer()
+    await CosmosChatLogSink(container).write([chat_item(0, "a"), chat_item(1, "b"), chat_item(2, "a")])
+    assert container.batches == [("a", ["id-0", "id-2"]), ("b", ["id-1"])]
+
+
+@pytest.mark.asyncio
+async def test_cosmos_sink_upserts_a_retried_batch():
+    class PartialContainer:
+        def __init__(self):
+            self.items = {}
+
+        async def upsert_item(self, item):
+            if item["id"] == "id-1" and "id-1" not in self.items and len(self.items) == 1:
+                self.items[item["id"]] = item
+                raise ConnectionError("timed out after the write")
+            self.items[item["id"]] = item
+
+    container = PartialContainer()
+    sink = CosmosChatLogSink(container)
+    with pytest.raises(ConnectionError):
+        await sink.write([chat_item(0), chat_item(1)])
+    # 이미 쓴 기록이 있어도 다시 시도한 배치가 충돌하지 않는다.
+    await sink.write([chat_item(0), chat_item(1)])
+    assert sorted(container.items) == ["id-0", "id-1"]
+
+
+@pytest.mark.asyncio
+async def test_conversations_are_logged_per_session():
+    sink = FlakySink(0)
+    writer = ChatLogWriter(sink, flush_interval=0.01)
+    approach = ChatReadRetrieveReadApproachCosmosDB(None, None, writer, "chat", "gpt-35-turbo", "embedding", "sourcepage", "content")
+    approach.log_conversation([{"user": "q1", "bot": "a1"}, {"user": "q2"}], "a2", {"session_id": "s1"})
+    approach.log_conversation([{"user": "q1"}], "a1", {})
+    approach.log_conversation([{"user": "q3"}], "a3", {})
+    await writer.close()
+    items = sink.items
+    assert items[0]["chat_session_id"] == "s1"
+    assert items[0]["conversation"] == [{"role": "user", "content": "q2"}, {"role": "assistant", "content": "a2"}]
+    # session_id가 없으면 대화의 첫 질문으로 파티션 키를 정하므로 대화마다 다르다.
+    assert items[1]["chat_session_id"] != items[2]["chat_session_id"]
+
+    # 기록할 저장소가 없으면 대화 기록을 남기지 않는다.
+    ChatReadRetrieveReadApproachCosmosDB(None, None, None, "chat", "gpt-35-turbo", "embedding", "sourcepage", "content").log_conversation([{"user": "q"}], "a", {})
@@ -0,0 +1,162 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import approaches.chatreadretrieveread
+from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
+from core.contextpacker import ContextPacker
+from core.embeddingcache import EmbeddingCache
+from core.searchcache import SearchCache, SearchHit
+
+
+def count_chars(messages):
+    return [len(message["content"]) for message in messages]
+
+
+class MockOpenAIClient:
+    def __init__(self, query):
+        self.query = query
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+        self.embeddings = SimpleNamespace(create=self.embed)
+        self.embedded = []
+        # 이 텍스트의 임베딩은 released가 설정될 때까지 끝나지 않는다.
+        self.slow_text = None
+        self.released = asyncio.Event()
+
+    async def create(self, messages, stream=False, **kwargs):
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=self.query))])
+
+    async def embed(self, model, input):
+        self.embedded.append(input)
+        if input == self.slow_text:
+            await self.released.wait()
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[0.1, float(len(input))])])
+
+
+class MockSearchClient:
+    def __init__(self):
+        self.queries = []
+
+    async def search(self, search_text, vector_queries=None, **kwargs):
+        self.queries.append(search_text)
+
+        async def results():
+            yield {"sourcepage": f"{search_text}.pdf", "content": "최충헌", "id": "", "sourcefile": ""}
+
+        return results()
+
+
+class MockSearchCache:
+    def __init__(self, content_length=300):
+        self.content_length = content_length
+        self.queries = []
+
+    async def search(self, query_text, query_vector, filter, top, use_semantic_ranker, use_semantic_captions):
+        self.queries.append(query_text)
+        return [SearchHit(f"{query_text}-{i}.pdf", "가" * self.content_length, ()) for i in range(top)]
+
+
+@pytest.fixture(autouse=True)
+def count_tokens_by_chars(monkeypatch):
+    monkeypatch.setattr("core.messagebuilder.num_tokens_from_messages_batch", lambda messages, model, cache=None: count_chars(messages))
+    monkeypatch.setattr(approaches.chatreadretrieveread, "count_static_tokens", lambda messages, model: {})
+
+
+def make_approach(query, search_cache=None, context_packer=None):
+    return ChatReadRetrieveReadApproach(
+        None,
+        MockOpenAIClient(query),
+        "chat",
+        "gpt-35-turbo",
+        "embedding",
+        "sourcepage",
+        "content",
+        embedding_cache=SimpleNamespace(),
+        search_cache=search_cache or MockSearchCache(),
+        context_packer=context_packer or ContextPacker(lambda texts: [len(text) for text in texts], max_tokens=1000, reserve_tokens=1500),
+    )
+
+
+@pytest.mark.asyncio
+async def test_long_history_leaves_the_source_reserve():
+    approach = make_approach("고려 무신정변")
+    history = [{"user": "질" * 200, "bot": "답" * 200} for _ in range(20)] + [{"user": "무신정변은 언제 일어났나요?"}]
+    extra_info, chat_coroutine = await approach.run_until_final_call(history, {"retrieval_mode": "text", "top": 3, "prompt_template": "시스템 {follow_up_questions_prompt}"})
+    chat_coroutine.close()
+    # 대화 이력은 출처 몫(1000 토큰)을 남기고 잘라내므로 세 출처가 모두 들어간다.
+    assert extra_info["data_points"] == [f" SOURCE:고려 무신정변-{i}.pdf: " + "가" * 300 for i in range(3)]
+    assert approach.context_packer.stats()["dropped"] == 0
+
+
+def make_speculative_approach(query):
+    openai_client = MockOpenAIClient(query)
+    search_client = MockSearchClient()
+    return ChatReadRetrieveReadApproach(
+        search_client,
+        openai_client,
+        "chat",
+        "gpt-35-turbo",
+        "embedding",
+        "sourcepage",
+        "content",
+        speculative_retrieval=True,
+        embedding_cache=EmbeddingCache(openai_client, "embedding"),
+        search_cache=SearchCache(search_client, "sourcepage", "content"),
+        context_packer=ContextPacker(lambda texts: [len(text) for text in texts]),
+    )
+
+
+async def run_turn(approach, question, overrides=None):
+    extra_info, chat_coroutine = await approach.run_until_final_call([{"user": question}], {"top": 1, **(overrides or {})})
+    chat_coroutine.close()
+    return extra_info
+
+
+@pytest.mark.asyncio
+async def test_speculative_result_is_used_when_the_query_matches_the_question():
+    approach = make_speculative_approach("  무신정변은 언제 일어났나요? ")
+    extra_info = await run_turn(approach, "무신정변은  언제 일어났나요?")
+    assert extra_info["retrieval_path"] == "speculative"
+    assert extra_info["data_points"] == [" SOURCE:무신정변은  언제 일어났나요?.pdf: 최충헌"]
+    # 원래 질문으로 한 번만 임베딩하고 검색한다.
+    assert approach.openai_client.embedded == ["무신정변은  언제 일어났나요?"]
+    assert approach.search_client.queries == ["무신정변은  언제 일어났나요?"]
+
+    # 더 나은 쿼리를 만들지 못하면("0") 원래 질문을 사용하므로 추측 검색 결과를 그대로 쓴다.
+    approach.openai_client.query = "0"
+    assert (await run_turn(approach, "최충헌은 누구인가요?"))["retrieval_path"] == "speculative"
+    assert approach.search_client.queries == ["무신정변은  언제 일어났나요?", "최충헌은 누구인가요?"]
+
+
+@pytest.mark.asyncio
+async def test_cancelled_speculative_retrieval_leaves_the_caches_usable():
+    approach = make_speculative_approach("고려 무신정변 연도")
+    approach.openai_client.slow_text = "무신정변은 언제?"
+    extra_info = await run_turn(approach, "무신정변은 언제?")
+    assert extra_info["retrieval_path"] == "speculative_cancelled"
+    assert extra_info["data_points"] == [" SOURCE:고려 무신정변 연도.pdf: 최충헌"]
+    # 취소된 추측 검색은 검색하지 않았고, 공유된 임베딩 계산은 취소되지 않고 계속된다.
+    assert approach.search_client.queries == ["고려 무신정변 연도"]
+    approach.openai_client.released.set()
+    vector = await approach.embedding_cache.embed("무신정변은 언제?")
+    assert vector.tolist() == [pytest.approx(0.1), 9.0]
+    assert sorted(approach.openai_client.embedded) == ["고려 무신정변 연도", "무신정변은 언제?"]
+
+    # 다음 턴에서 원래 질문으로 검색하면 남은 임베딩과 검색 결과 캐시를 그대로 사용한다.
+    approach.openai_client.query = "무신정변은 언제?"
+    extra_info = await run_turn(approach, "무신정변은 언제?")
+    assert extra_info["retrieval_path"] == "speculative"
+    assert sorted(approach.openai_client.embedded) == ["고려 무신정변 연도", "무신정변은 언제?"]
+    assert approach.search_client.queries == ["고려 무신정변 연도", "무신정변은 언제?"]
+    await run_turn(approach, "무신정변은 언제?")
+    assert approach.search_client.queries == ["고려 무신정변 연도", "무신정변은 언제?"]
+
+
+@pytest.mark.asyncio
+async def test_sequential_retrieval_path():
+    approach = make_speculative_approach("고려 무신정변 연도")
+    extra_info = await run_turn(approach, "무신정변은 언제?", {"speculative_retrieval": False})
+    assert extra_info["retrieval_path"] == "sequential"
+    assert approach.openai_client.embedded == ["고려 무신정변 연도"]
+    assert approach.search_client.queries == ["고려 무신정변 연도"]
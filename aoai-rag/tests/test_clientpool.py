@@ -0,0 +1,64 @@
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from core.clientpool import AioHttpConnectionPool, ConnectionPool, HttpxConnectionPool
+
+
+def test_connection_pool_stats():
+    pool = HttpxConnectionPool("openai", "https://localhost", size=4, keepalive=60)
+    assert pool.stats() == {"size": 4, "in_use": 0, "utilization": 0, "waiting": 0, "requests": 0, "wait_avg_ms": 0, "wait_max_ms": 0}
+
+    started = pool.request_started()
+    assert pool.stats()["waiting"] == 1
+    pool.connection_acquired(started - 0.5)
+    stats = pool.stats()
+    assert stats["waiting"] == 0
+    assert stats["requests"] == 1
+    assert stats["wait_max_ms"] >= 500
+
+
+@pytest.mark.asyncio
+async def test_stats_without_private_pool_internals():
+    with pytest.raises(TypeError):
+        ConnectionPool("upstream", "https://localhost", size=1, keepalive=60)
+    httpx_pool = HttpxConnectionPool("openai", "https://localhost", size=4, keepalive=60)
+    aiohttp_pool = AioHttpConnectionPool("search", "https://localhost", size=4, keepalive=60)
+    # the private attributes may change between versions of httpcore and aiohttp
+    connections, acquired = httpx_pool.transport._pool, aiohttp_pool.connector._acquired
+    httpx_pool.transport._pool = None
+    aiohttp_pool.connector._acquired = None
+    assert httpx_pool.stats()["in_use"] == 0
+    assert aiohttp_pool.stats()["in_use"] == 0
+    httpx_pool.transport._pool, aiohttp_pool.connector._acquired = connections, acquired
+    await httpx_pool.close()
+    await aiohttp_pool.close()
+
+
+async def ok(request):
+    return web.Response(text="ok")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("pool_class", [HttpxConnectionPool, AioHttpConnectionPool])
+async def test_warm_up_opens_connections(pool_class):
+    app = web.Application()
+    app.router.add_get("/", ok)
+    async with TestServer(app, host="127.0.0.1") as server:
+        pool = pool_class("upstream", str(server.make_url("/")), size=2, keepalive=60)
+        await pool.warm_up(5)
+        stats = pool.stats()
+        assert stats["requests"] == 2
+        assert stats["waiting"] == 0
+        assert stats["in_use"] == 0
+        await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_warm_up_failure_does_not_raise(caplog):
+    pool = AioHttpConnectionPool("search", "http://127.0.0.1:1", size=2, keepalive=60)
+    await pool.warm_up(5)
+    assert pool.stats()["waiting"] == 0
+    assert pool.stats()["requests"] == 0
+    assert "Connection warm-up of search failed" in caplog.text
+    await pool.close()
@@ -0,0 +1,68 @@
+from core.contextpacker import ContextPacker, overlap_length
+from core.searchcache import SearchHit
+
+TEXT = "".join(f"최충헌은 {i}번째 문장에서 고려의 실권을 장악했다. " for i in range(40))
+
+
+def section(number, start, end, page=1):
+    return SearchHit(f"history-{page}.pdf", TEXT[start:end], (f"caption {number}",), "history.pdf", f"file-history_pdf-page-{number}")
+
+
+def count_chars(texts):
+    return [len(text) for text in texts]
+
+
+def test_neighbors_are_merged_without_the_overlap():
+    packer = ContextPacker(count_chars)
+    other = SearchHit("other-1.pdf", "무신정변", (), "other.pdf", "file-other_pdf-page-0")
+    hits = [section(1, 400, 900), other, section(0, 0, 500), section(1, 400, 900), section(3, 1200, 1700)]
+    packed = packer.pack(hits, 100000)
+    assert [hit.content for hit in packed] == [TEXT[0:900], "무신정변", TEXT[1200:1700]]
+    assert packed[0].captions == ("caption 0", "caption 1")
+    assert packer.stats() == {"merged": 1, "deduplicated_chars": 100, "dropped": 0, "unmerged": 0}
+
+
+def test_neighbors_on_other_pages_keep_their_citation():
+    packer = ContextPacker(count_chars)
+    packed = packer.pack([section(0, 0, 500, page=1), section(1, 400, 900, page=2)])
+    assert [(hit.sourcepage, hit.content) for hit in packed] == [("history-1.pdf", TEXT[0:500]), ("history-2.pdf", TEXT[500:900])]
+
+
+def test_sources_fit_the_token_budget():
+    packer = ContextPacker(count_chars, max_tokens=1000, reserve_tokens=300)
+    hits = [SearchHit(f"{i}.pdf", "가" * length, ()) for i, length in enumerate((500, 400, 200, 100))]
+    assert [hit.sourcepage for hit in packer.pack(hits, 1000)] == ["0.pdf", "2.pdf"]
+    assert [hit.sourcepage for hit in packer.pack(hits)] == ["0.pdf", "1.pdf", "3.pdf"]
+    assert packer.dropped == 3
+
+
+def test_measured_prompt_tokens_replace_the_reserve():
+    packer = ContextPacker(count_chars, max_tokens=1000, reserve_tokens=300)
+    hits = [SearchHit(f"{i}.pdf", "가" * length, ()) for i, length in enumerate((500, 400, 200, 100))]
+    assert [hit.sourcepage for hit in packer.pack(hits, 1000, prompt_tokens=100)] == ["0.pdf", "1.pdf"]
+    assert [hit.sourcepage for hit in packer.pack(hits, 1000, prompt_tokens=800)] == ["2.pdf"]
+
+
+def test_merged_source_over_the_budget_falls_back_to_its_hits():
+    packer = ContextPacker(count_chars)
+    # the top hit is section 1; section 0 ranks last but is merged in front of it
+    hits = [section(1, 400, 900), SearchHit("other-1.pdf", "무신정변", (), "other.pdf", "file-other_pdf-page-0"), section(0, 0, 500)]
+    packed = packer.pack(hits, 700, prompt_tokens=0)
+    assert [hit.content for hit in packed] == [TEXT[400:900], "무신정변"]
+    assert packer.stats()["unmerged"] == 1
+    assert packer.dropped == 1
+
+
+def test_unmerged_hits_are_added_in_rank_order():
+    packer = ContextPacker(count_chars)
+    # sections 0-2 merge into 1300 characters; the hits of sections 2 and 0 still fit on their own
+    hits = [section(2, 800, 1300), section(0, 0, 500), section(1, 400, 900)]
+    packed = packer.pack(hits, 1000, prompt_tokens=0)
+    assert [hit.content for hit in packed] == [TEXT[800:1300], TEXT[0:500]]
+    assert packer.stats()["unmerged"] == 2
+    assert packer.dropped == 1
+
+def test_overlap_length():
+    assert overlap_length("abcdefghij", "fghijklmn", 100, 3) == 5
+    assert overlap_length("abcdefghij", "hijklmn", 100, 5) == 0
+    assert overlap_length("abc", "xyz", 100, 1) == 0
@@ -0,0 +1,95 @@
+import asyncio
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from core.embeddingbatcher import EmbeddingBatcher
+from core.embeddingcache import EmbeddingCache
+
+
+class MockBatchEmbeddings:
+    def __init__(self, error=None, drop=None):
+        self.calls = []
+        self.error = error
+        self.drop = drop
+
+    async def create(self, model, input):
+        self.calls.append(list(input))
+        await asyncio.sleep(0.01)
+        if self.error:
+            raise self.error
+        # 응답 순서가 입력 순서와 달라도 index로 맞춘다.
+        data = [SimpleNamespace(index=i, embedding=[float(len(text)), float(i)]) for i, text in enumerate(input) if text != self.drop]
+        return SimpleNamespace(data=data[::-1])
+
+
+@pytest.mark.asyncio
+async def test_concurrent_texts_share_one_call():
+    client = SimpleNamespace(embeddings=MockBatchEmbeddings())
+    batcher = EmbeddingBatcher(client, "test-ada", window_ms=10)
+    vectors = await asyncio.gather(*(batcher.embed(text) for text in ["first", "a", "bb", "a", "ccc"]))
+    # 보내는 중인 배치가 없으면 바로 보내고, 그동안 들어온 텍스트를 모아서 보낸다.
+    assert client.embeddings.calls == [["first"], ["a", "bb", "ccc"]]
+    assert [vector[0] for vector in vectors] == [5, 1, 2, 1, 3]
+    assert vectors[0].dtype == np.float32
+    stats = batcher.stats()
+    assert stats["batches"] == 2 and stats["inputs"] == 5
+    assert stats["queue_delay_max_ms"] >= 5
+
+
+@pytest.mark.asyncio
+async def test_lone_text_is_sent_without_waiting_for_the_window():
+    client = SimpleNamespace(embeddings=MockBatchEmbeddings())
+    batcher = EmbeddingBatcher(client, "test-ada", window_ms=10000)
+    await asyncio.wait_for(batcher.embed("a"), 1)
+    await asyncio.wait_for(batcher.embed("b"), 1)
+    assert client.embeddings.calls == [["a"], ["b"]]
+
+
+@pytest.mark.asyncio
+async def test_full_batch_is_sent_without_waiting_for_the_window():
+    client = SimpleNamespace(embeddings=MockBatchEmbeddings())
+    batcher = EmbeddingBatcher(client, "test-ada", window_ms=10000, max_batch_size=2)
+    await asyncio.wait_for(asyncio.gather(batcher.embed("first"), batcher.embed("a"), batcher.embed("b")), 1)
+    assert client.embeddings.calls == [["first"], ["a", "b"]]
+
+
+@pytest.mark.asyncio
+async def test_token_budget_splits_batches():
+    client = SimpleNamespace(embeddings=MockBatchEmbeddings())
+    batcher = EmbeddingBatcher(client, "test-ada", window_ms=1, max_batch_tokens=10)
+    await asyncio.gather(batcher.embed("first"), batcher.embed("x" * 10), batcher.embed("y" * 10))
+    assert client.embeddings.calls == [["first"], ["x" * 10], ["y" * 10]]
+
+
+@pytest.mark.asyncio
+async def test_error_is_returned_to_every_waiter():
+    client = SimpleNamespace(embeddings=MockBatchEmbeddings(error=ValueError("429")))
+    batcher = EmbeddingBatcher(client, "test-ada", window_ms=1)
+    results = await asyncio.gather(batcher.embed("a"), batcher.embed("b"), return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+@pytest.mark.asyncio
+async def test_missing_or_cancelled_batch_never_leaves_waiters_hanging():
+    client = SimpleNamespace(embeddings=MockBatchEmbeddings(drop="b"))
+    batcher = EmbeddingBatcher(client, "test-ada", window_ms=1)
+    results = await asyncio.wait_for(asyncio.gather(batcher.embed("first"), batcher.embed("a"), batcher.embed("b"), return_exceptions=True), 1)
+    assert results[1][0] == 1 and isinstance(results[2], LookupError)
+
+    waiter = asyncio.ensure_future(batcher.embed("c"))
+    await asyncio.sleep(0)
+    for task in list(batcher._tasks):
+        task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await asyncio.wait_for(waiter, 1)
+
+
+@pytest.mark.asyncio
+async def test_embeddingcache_uses_batcher():
+    client = SimpleNamespace(embeddings=MockBatchEmbeddings())
+    cache = EmbeddingCache(client, "test-ada", batcher=EmbeddingBatcher(client, "test-ada", window_ms=1))
+    await asyncio.gather(cache.embed("first"), cache.embed("a"), cache.embed("b"))
+    await cache.embed("a")
+    assert client.embeddings.calls == [["first"], ["a", "b"]]
@@ -0,0 +1,80 @@
+import asyncio
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from core.embeddingcache import EmbeddingCache
+
+
+class MockEmbeddings:
+    def __init__(self):
+        self.calls = []
+
+    async def create(self, model, input):
+        self.calls.append((model, input))
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[0.1, 0.2, float(len(input))])])
+
+
+def mock_openai_client():
+    return SimpleNamespace(embeddings=MockEmbeddings())
+
+
+@pytest.mark.asyncio
+async def test_embeddingcache_reuses_normalized_text():
+    client = mock_openai_client()
+    cache = EmbeddingCache(client, "test-ada")
+    first = await cache.embed("capital of  France")
+    second = await cache.embed(" capital of France\n")
+    assert first.dtype == np.float32
+    assert second is first
+    assert client.embeddings.calls == [("test-ada", "capital of  France")]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+@pytest.mark.asyncio
+async def test_embeddingcache_key_includes_deployment():
+    client = mock_openai_client()
+    await EmbeddingCache(client, "ada-1").embed("hello")
+    assert EmbeddingCache(client, "ada-1").key("hello") != EmbeddingCache(client, "ada-2").key("hello")
+
+
+@pytest.mark.asyncio
+async def test_embeddingcache_evicts_least_recently_used():
+    client = mock_openai_client()
+    cache = EmbeddingCache(client, "test-ada", max_bytes=2 * 3 * 4)
+    await cache.embed("a")
+    await cache.embed("b")
+    await cache.embed("a")
+    await cache.embed("c")
+    await cache.embed("a")
+    await cache.embed("b")
+    assert [call[1] for call in client.embeddings.calls] == ["a", "b", "c", "b"]
+
+
+@pytest.mark.asyncio
+async def test_embeddingcache_disk_tier(tmp_path):
+    disk_path = str(tmp_path / "embeddings.sqlite")
+    client = mock_openai_client()
+    cache = EmbeddingCache(client, "test-ada", disk_path=disk_path)
+    vector = await cache.embed("hello")
+    await cache.close()
+
+    # a new worker starts with an empty memory tier but reads the vector from disk
+    recycled = EmbeddingCache(client, "test-ada", disk_path=disk_path)
+    assert np.array_equal(await recycled.embed("hello"), vector)
+    assert recycled.disk_hits == 1
+    assert len(client.embeddings.calls) == 1
+    await recycled.close()
+
+
+@pytest.mark.asyncio
+async def test_embeddingcache_concurrent_misses_share_one_call(tmp_path):
+    client = mock_openai_client()
+    cache = EmbeddingCache(client, "test-ada", disk_path=str(tmp_path / "embeddings.sqlite"))
+    vectors = await asyncio.gather(*(cache.embed("hello") for _ in range(3)))
+    assert len(client.embeddings.calls) == 1
+    assert all(vector is vectors[0] for vector in vectors)
+    # 디스크 쓰기는 응답 뒤에 처리되고, 닫을 때 모두 끝난다.
+    await cache.close()
+    assert EmbeddingCache(client, "test-ada", disk_path=str(tmp_path / "embeddings.sqlite"))._read_disk(cache.key("hello")) is not None
@@ -0,0 +1,76 @@
+import asyncio
+import json
+import time
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from httptools import AsyncHttpClient, load_async_requests_tools
+
+
+async def slow_search(request):
+    await asyncio.sleep(0.3)
+    return web.json_response({"name": request.query["q"], "cafename": "The black tea"})
+
+
+async def reserve(request):
+    return web.Response(text="OK " + json.dumps(await request.json(), ensure_ascii=False))
+
+
+def create_plugin_app():
+    app = web.Application()
+    app.router.add_get("/search", slow_search)
+    app.router.add_post("/reserve", reserve)
+    return app
+
+
+@pytest.mark.asyncio
+async def test_tool_calls_do_not_stall_other_requests():
+    async with TestServer(create_plugin_app(), host="127.0.0.1") as server:
+        client = AsyncHttpClient(timeout=5)
+        requests_get = load_async_requests_tools(client)[0]
+        url = str(server.make_url("/search"))
+
+        # 툴이 플러그인 응답을 기다리는 동안 같은 이벤트 루프의 다른 요청이 얼마나 늦어지는지 잰다.
+        lags = []
+
+        async def other_requests():
+            for _ in range(25):
+                start = time.perf_counter()
+                await asyncio.sleep(0.01)
+                lags.append(time.perf_counter() - start - 0.01)
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(requests_get.arun(f"{url}?q=이의방") for _ in range(5)), other_requests())
+        elapsed = time.perf_counter() - start
+
+        assert all("The black tea" in result for result in results[:5])
+        assert elapsed < 0.3 * 2
+        assert max(lags) < 0.1
+        await client.close()
+
+
+@pytest.mark.asyncio
+async def test_post_and_errors_are_returned_as_text():
+    async with TestServer(create_plugin_app(), host="127.0.0.1") as server:
+        client = AsyncHttpClient(timeout=0.05)
+        tools = {tool.name: tool for tool in load_async_requests_tools(client)}
+        data = json.dumps({"url": str(server.make_url("/reserve")), "data": {"datetime": "2023-12-01 19:00"}})
+        assert await tools["requests_post"].arun(data) == 'OK {"datetime": "2023-12-01 19:00"}'
+        assert await tools["requests_get"].arun(str(server.make_url("/search?q=a"))) == "Request timed out after 0.05 seconds"
+        assert (await tools["requests_post"].arun("not json")).startswith("JSONDecodeError")
+        await client.close()
+
+
+@pytest.mark.asyncio
+async def test_sync_calls_use_the_sync_client():
+    async with TestServer(create_plugin_app(), host="127.0.0.1") as server:
+        client = AsyncHttpClient(timeout=0.05, max_response_chars=5)
+        tools = {tool.name: tool for tool in load_async_requests_tools(client)}
+        data = json.dumps({"url": str(server.make_url("/reserve")), "data": {"datetime": "2023-12-01 19:00"}})
+        # 동기 에이전트처럼 이벤트 루프 밖의 스레드에서 호출한다.
+        assert await asyncio.to_thread(tools["requests_post"].run, data) == "OK {\""
+        assert await asyncio.to_thread(tools["requests_get"].run, str(server.make_url("/search?q=a"))) == "Request timed out after 0.05 seconds"
+        assert (await asyncio.to_thread(tools["requests_put"].run, "not json")).startswith("JSONDecodeError")
+        await client.close()
@@ -0,0 +1,26 @@
+from langchain.schema import AgentFinish
+
+from langchainadapters import HtmlCallbackHandler
+
+
+def test_events_are_rendered_on_demand():
+    handler = HtmlCallbackHandler()
+    handler.on_chain_start({"name": "AgentExecutor"}, {})
+    handler.on_tool_end("<b>{result}</b>", color="green", observation_prefix="Observation:", llm_prefix="Thought:")
+    handler.on_agent_finish(AgentFinish({"output": "done"}, "Final Answer:\ndone"), color="blue")
+    assert handler.render() == (
+        "Entering chain: AgentExecutor<br>"
+        "Observation:<br><span style='color:green'>&lt;b&gt;{result}&lt;/b&gt;</span><br>Thought:<br>"
+        "<span style='color:blue'>Final Answer:<br>done</span><br>"
+    )
+
+
+def test_buffer_is_bounded():
+    handler = HtmlCallbackHandler(max_events=2, max_event_chars=6)
+    for i in range(4):
+        handler.on_text(f"step {i}")
+    handler.on_llm_start({}, ["a very long prompt"])
+    assert handler.dropped == 3
+    assert handler.render() == "(3 earlier events omitted)<br><span style='color:None'>step 3</span><br>LLM prompts:<br>a very...<br>"
+    assert handler.get_and_reset_log().startswith("(3 earlier")
+    assert handler.render() == ""
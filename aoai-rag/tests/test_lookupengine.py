@@ -0,0 +1,68 @@
+import os
+import time
+
+import pytest
+
+from approaches.readretrieveread import CafeSearchTool
+from core.lookupengine import CsvLookupEngine, get_lookup_engine
+from lookuptool import CsvLookupTool
+
+CSV = """name,category,restaurant,ratings,location
+이의방,카페,"The black tea",3.5,전주
+경대승,카페,"Cafe Moderate",3.4,청주
+최충헌,카페,"Cafe Choi",4.1,개경
+"""
+
+
+@pytest.fixture
+def csv_path(tmp_path):
+    path = tmp_path / "restaurantinfo.csv"
+    path.write_text(CSV, encoding="utf-8")
+    return path
+
+
+def test_lookup_exact_normalized_and_prefix(csv_path, tmp_path):
+    engine = CsvLookupEngine(csv_path, "name", db_path=str(tmp_path / "lookup.sqlite"))
+    assert engine.lookup("경대승") == "name:경대승\ncategory:카페\nrestaurant:Cafe Moderate\nratings:3.4\nlocation:청주"
+    assert engine.lookup(" 경대승 ").startswith("name:경대승")
+    assert engine.lookup("최충헌의 카페").startswith("name:최충헌")
+    assert engine.lookup("최충").startswith("name:최충헌")
+    assert engine.lookup("정중부") == ""
+    assert engine.stats()["rows"] == 3
+    engine.close()
+
+    exact = CsvLookupEngine(csv_path, "name", db_path=str(tmp_path / "exact.sqlite"), fuzzy=False)
+    assert exact.lookup("최충") == ""
+    exact.close()
+
+
+def test_reuses_sqlite_file_and_reloads_on_change(csv_path, tmp_path):
+    db_path = str(tmp_path / "lookup.sqlite")
+    engine = CsvLookupEngine(csv_path, "name", db_path=db_path, check_interval=0)
+    engine.lookup("이의방")
+    built = os.stat(db_path).st_mtime_ns
+
+    # 다른 워커는 CSV가 그대로면 SQLite 파일을 다시 만들지 않는다.
+    other = CsvLookupEngine(csv_path, "name", db_path=db_path)
+    assert other.lookup("이의방").startswith("name:이의방")
+    assert os.stat(db_path).st_mtime_ns == built
+    other.close()
+
+    csv_path.write_text(CSV + "정중부,카페,Cafe Jung,3.9,개경\n", encoding="utf-8")
+    os.utime(csv_path, (time.time() + 10, time.time() + 10))
+    engine.lookup("이의방")
+    for _ in range(100):
+        if engine.reloads:
+            break
+        time.sleep(0.01)
+    assert engine.lookup("정중부").startswith("name:정중부")
+    engine.close()
+
+
+@pytest.mark.asyncio
+async def test_tools_share_the_engine(csv_path):
+    lookup_tool = CsvLookupTool(csv_path, "name")
+    cafe_tool = CafeSearchTool(filename=str(csv_path))
+    assert CsvLookupTool(csv_path, "name").engine is lookup_tool.engine is get_lookup_engine(str(csv_path), "name")
+    assert lookup_tool.run("이의방").startswith("name:이의방")
+    assert (await cafe_tool.arun("이의방")).startswith("name:이의방")
@@ -1,4 +1,4 @@
-from core.messagebuilder import MessageBuilder
+from core.messagebuilder import MessageBuilder, trim_history
 
 
 def test_messagebuilder():
@@ -22,3 +22,51 @@ def test_messagebuilder_append():
     ]
     assert builder.model == "gpt-35-turbo"
     assert builder.token_length == 17
+
+
+def test_messagebuilder_uses_known_token_counts():
+    # 미리 계산된 토큰 수가 있으면 다시 토큰화하지 않는다.
+    builder = MessageBuilder("You are a bot.", "gpt-35-turbo", {("system", "You are a bot."): 8, ("assistant", "I am fine."): 7})
+    builder.append_message("assistant", "I am fine.")
+    builder.append_message("user", "Hello, how are you?", token_count=9)
+    assert builder.token_length == 24
+
+
+def fake_token_counts(messages, model, cache=None):
+    return [len(message["content"]) for message in messages]
+
+
+def test_trim_history_keeps_recent_turns_within_budget(monkeypatch):
+    monkeypatch.setattr("core.messagebuilder.num_tokens_from_messages_batch", fake_token_counts)
+    history = [{"user": "aaaa", "bot": "bbbb"}, {"user": "cc", "bot": "dd"}, {"user": "e"}]
+    assert trim_history(history, "gpt-35-turbo", 4) == ([{"role": "user", "content": "e"}], 1)
+    assert trim_history(history, "gpt-35-turbo", 5) == (
+        [
+            {"role": "user", "content": "cc"},
+            {"role": "assistant", "content": "dd"},
+            {"role": "user", "content": "e"},
+        ],
+        5,
+    )
+    # 턴 단위로 자르기 때문에 예산을 넘지 않는다.
+    messages, token_count = trim_history(history, "gpt-35-turbo", 12)
+    assert token_count == 5 and len(messages) == 3
+    assert trim_history(history, "gpt-35-turbo", 13)[1] == 13
+    assert trim_history(history, "gpt-35-turbo", 0) == ([], 0)
+    assert trim_history(history, "gpt-35-turbo", -10) == ([], 0)
+    assert trim_history([], "gpt-35-turbo", 100) == ([], 0)
+
+
+def test_trim_history_stops_counting_past_the_budget(monkeypatch):
+    counted = []
+
+    def counting_token_counts(messages, model, cache=None):
+        counted.extend(messages)
+        return fake_token_counts(messages, model, cache)
+
+    monkeypatch.setattr("core.messagebuilder.num_tokens_from_messages_batch", counting_token_counts)
+    history = [{"user": "aaaa", "bot": "bbbb"} for _ in range(1000)] + [{"user": "e"}]
+    messages, token_count = trim_history(history, "gpt-35-turbo", 100)
+    assert len(messages) == 25 and token_count == 97
+    # 최근 턴부터 8턴, 16턴씩 세고 예산을 넘으면 나머지 976턴은 세지 않는다.
+    assert len(counted) == 1 + 2 * (8 + 16 - 1)
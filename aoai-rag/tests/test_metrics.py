@@ -0,0 +1,60 @@
+import uuid
+
+import httpx
+import pytest
+from azure.core.pipeline import PipelineContext, PipelineRequest
+from azure.core.rest import HttpRequest
+from langchain.schema import LLMResult
+from openai import AsyncOpenAI, RateLimitError
+
+from core.metrics import Metrics, RetryCountingPolicy, count_openai_retries
+from langchainadapters import MetricsCallbackHandler
+
+
+def test_stages_are_rendered_as_prometheus_histograms():
+    metrics = Metrics()
+    with metrics.stage("chat_rrr", "search"):
+        pass
+    metrics.observe_stage("chat_rrr", "first_token", 0.3)
+    metrics.observe_stage("chat_rrr", "first_token", 60)
+    metrics.observe_prompt_tokens("chat_rrr", "answer", 1200)
+    text = metrics.render()
+    assert '# TYPE rag_stage_duration_seconds histogram' in text
+    assert 'rag_stage_duration_seconds_bucket{approach="chat_rrr",stage="search",le="0.005"} 1' in text
+    assert 'rag_stage_duration_seconds_bucket{approach="chat_rrr",stage="first_token",le="0.25"} 0' in text
+    assert 'rag_stage_duration_seconds_bucket{approach="chat_rrr",stage="first_token",le="0.5"} 1' in text
+    assert 'rag_stage_duration_seconds_bucket{approach="chat_rrr",stage="first_token",le="+Inf"} 2' in text
+    assert 'rag_stage_duration_seconds_sum{approach="chat_rrr",stage="first_token"} 60.3' in text
+    assert 'rag_prompt_tokens_bucket{approach="chat_rrr",stage="answer",le="2000"} 1' in text
+
+
+@pytest.mark.asyncio
+async def test_upstream_retries_are_counted():
+    metrics = Metrics()
+    policy = RetryCountingPolicy("search", metrics)
+    request = PipelineRequest(HttpRequest("GET", "https://search"), PipelineContext(None))
+    for _ in range(3):
+        policy.on_request(request)
+    policy.on_request(PipelineRequest(HttpRequest("GET", "https://search"), PipelineContext(None)))
+
+    responses = iter([httpx.Response(500), httpx.Response(429), httpx.Response(200, json={"data": [], "model": "m", "object": "list", "usage": {"prompt_tokens": 0, "total_tokens": 0}}),
+                      httpx.Response(429), httpx.Response(429), httpx.Response(429)])
+    client = AsyncOpenAI(api_key="key", base_url="https://openai", max_retries=2,
+                         http_client=httpx.AsyncClient(transport=httpx.MockTransport(lambda request: next(responses))))
+    client._calculate_retry_timeout = lambda *args: 0
+    count_openai_retries(client, "openai", metrics)
+    await client.embeddings.create(input="a", model="m")
+    # the last 429 is not retried because the SDK gave up
+    with pytest.raises(RateLimitError):
+        await client.embeddings.create(input="a", model="m")
+    assert metrics.upstream_retries.values == {("search",): 2, ("openai",): 4}
+
+
+def test_agent_llm_calls_are_recorded():
+    metrics = Metrics()
+    handler = MetricsCallbackHandler("ask_rrr", metrics)
+    run_id = uuid.uuid4()
+    handler.on_llm_start({}, ["prompt"], run_id=run_id)
+    handler.on_llm_end(LLMResult(generations=[], llm_output={"token_usage": {"prompt_tokens": 321}}), run_id=run_id)
+    assert metrics.stage_seconds.values[("ask_rrr", "llm")][0][0] == 1
+    assert metrics.prompt_tokens.values[("ask_rrr", "llm")][1] == [321]
@@ -1,9 +1,13 @@
 import pytest
 
 from core.modelhelper import (
+    TokenCountCache,
+    count_static_tokens,
+    get_encoding,
     get_oai_chatmodel_tiktok,
     get_token_limit,
     num_tokens_from_messages,
+    num_tokens_from_messages_batch,
 )
 
 
@@ -59,3 +63,55 @@ def test_get_oai_chatmodel_tiktok_error():
         get_oai_chatmodel_tiktok(None)
     with pytest.raises(ValueError, match="Expected Azure OpenAI ChatGPT model name"):
         get_oai_chatmodel_tiktok("gpt-3")
+
+
+def test_get_encoding_is_shared():
+    assert get_encoding("gpt-35-turbo") is get_encoding("gpt-35-turbo")
+
+
+def test_num_tokens_from_messages_batch():
+    messages = [
+        {"role": "user", "content": "Hello, how are you?"},
+        {"role": "assistant", "content": "I am fine."},
+        {"role": "user", "content": ""},
+    ]
+    model = "gpt-35-turbo"
+    assert num_tokens_from_messages_batch(messages, model) == [num_tokens_from_messages(message, model) for message in messages]
+    assert num_tokens_from_messages_batch([], model) == []
+
+
+def test_count_static_tokens():
+    assert count_static_tokens([{"role": "user", "content": "Hello, how are you?"}], "gpt-35-turbo") == {("user", "Hello, how are you?"): 9}
+
+
+class CountingEncoding:
+    def __init__(self):
+        self.encoded = []
+
+    def encode_batch(self, values):
+        self.encoded.extend(values)
+        return [value.split() for value in values]
+
+
+def test_num_tokens_from_messages_batch_uses_cache(monkeypatch):
+    encoding = CountingEncoding()
+    monkeypatch.setattr("core.modelhelper.get_encoding", lambda model: encoding)
+    cache = TokenCountCache()
+    history = [{"role": "user", "content": "one two"}, {"role": "assistant", "content": "three"}]
+    assert num_tokens_from_messages_batch(history, "gpt-35-turbo", cache) == [5, 4]
+    # 다음 턴에서는 새 메시지만 토큰화한다.
+    new_message = {"role": "user", "content": "four five six"}
+    assert num_tokens_from_messages_batch([*history, new_message], "gpt-35-turbo", cache) == [5, 4, 6]
+    assert encoding.encoded == ["user", "one two", "assistant", "three", "user", "four five six"]
+    assert cache.stats() == {"hits": 2, "misses": 3, "entries": 3}
+    assert TokenCountCache.key(new_message, "gpt-35-turbo") != TokenCountCache.key(new_message, "gpt-4")
+
+
+def test_token_count_cache_evicts_least_recently_used():
+    cache = TokenCountCache(max_entries=2)
+    cache.put(b"a", 1)
+    cache.put(b"b", 2)
+    assert cache.get(b"a") == 1
+    cache.put(b"c", 3)
+    assert cache.get(b"b") is None
+    assert (cache.get(b"a"), cache.get(b"c")) == (1, 3)
@@ -0,0 +1,83 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from core.pluginregistry import PluginRegistry
+
+SPEC = """openapi: 3.0.1
+info:
+  title: Cafe Review
+  version: v1
+paths: {}
+"""
+
+
+def create_plugin_app(requests: list):
+    async def manifest(request):
+        requests.append((request.path, request.headers.get("If-None-Match")))
+        body = json.dumps({
+            "schema_version": "v1",
+            "name_for_human": "Cafe Review List (no auth)",
+            "name_for_model": "cafereview",
+            "description_for_human": "Searching cafe user Reviews.",
+            "description_for_model": "Plugin to search for cafe information.",
+            "auth": {"type": "none"},
+            "api": {"type": "openapi", "url": str(request.url.with_path("/openapi.yaml"))},
+            "logo_url": None,
+            "contact_email": None,
+            "legal_info_url": None,
+        })
+        return conditional(request, body, '"manifest-1"')
+
+    async def spec(request):
+        requests.append((request.path, request.headers.get("If-None-Match")))
+        return conditional(request, SPEC, '"spec-1"')
+
+    def conditional(request, body, etag):
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(text=body, headers={"ETag": etag})
+
+    app = web.Application()
+    app.router.add_get("/.well-known/ai-plugin.json", manifest)
+    app.router.add_get("/openapi.yaml", spec)
+    return app
+
+
+@pytest.mark.asyncio
+async def test_prefetch_and_revalidate():
+    requests = []
+    async with TestServer(create_plugin_app(requests), host="127.0.0.1") as server:
+        registry = PluginRegistry([str(server.make_url("/.well-known/ai-plugin.json"))], ttl=0)
+        await registry.prefetch()
+        assert requests == [("/.well-known/ai-plugin.json", None), ("/openapi.yaml", None)]
+        tool = registry.tools()[0]
+        assert tool.name == "cafereview"
+        assert "Cafe Review" in tool.api_spec
+
+        # TTL이 지나면 백그라운드에서 재검증하고, 304이면 같은 툴을 계속 쓴다.
+        await asyncio.sleep(0.05)
+        assert registry.tools() == [tool]
+        assert requests[-2:] == [("/.well-known/ai-plugin.json", '"manifest-1"'), ("/openapi.yaml", '"spec-1"')]
+        assert registry.tools()[0] is tool
+        assert registry.stats()["not_modified"] >= 2
+        await registry.close()
+
+
+@pytest.mark.asyncio
+async def test_unavailable_plugin_is_left_out():
+    requests = []
+    async with TestServer(create_plugin_app(requests), host="127.0.0.1") as server:
+        up = str(server.make_url("/.well-known/ai-plugin.json"))
+        down = "http://127.0.0.1:1/.well-known/ai-plugin.json"
+        registry = PluginRegistry([up, down], timeout=1)
+        await registry.prefetch()
+        assert [tool.name for tool in registry.tools()] == ["cafereview"]
+        stats = registry.stats()
+        assert stats["failures"] == 1
+        assert stats["plugins"][down]["available"] is False
+        assert stats["plugins"][up]["error"] is None
+        await registry.close()
@@ -1,4 +1,20 @@
-from scripts.prepdocs import filename_to_id
+import json
+import queue
+import threading
+from types import SimpleNamespace
+
+import httpx
+import scripts.prepdocs as prepdocs
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
+from openai import APIConnectionError, RateLimitError
+from scripts.prepdocs import (
+    EmbeddingCache,
+    EmbeddingScheduler,
+    IngestionManifest,
+    PipelineStage,
+    filename_to_id,
+)
 
 
 def test_filename_to_id():
@@ -8,3 +24,248 @@ def test_filename_to_id():
     assert filename_to_id("foo\u00A9.txt") == "file-foo__txt-666F6FC2A92E747874"
     # test filenaming starting with unicode
     assert filename_to_id("ファイル名.pdf") == "file-______pdf-E38395E382A1E382A4E383ABE5908D2E706466"
+
+
+def test_manifest_replays_journal_of_interrupted_run(tmp_path):
+    path = str(tmp_path / "manifest.json")
+    manifest = IngestionManifest(path, "index")
+    manifest.record("a.pdf", "h1", "upload")
+    manifest.record("a.pdf", "h1", "index", sections={"s1": "x"}, embedding_model="emb")
+    manifest.record("b.pdf", "h2", "upload")
+    # interrupted: the journal is not folded into the manifest and its last line is cut off
+    manifest._journal.write(json.dumps({"index": "index", "file": "b.pdf", "hash": "h2", "stage": "index"})[:20])
+    manifest._journal.close()
+
+    manifest = IngestionManifest(path, "index")
+    assert manifest.is_done("a.pdf", "h1", "index", "emb")
+    assert manifest.sections("a.pdf") == {"s1": "x"}
+    assert manifest.is_done("b.pdf", "h2", "upload")
+    assert not manifest.is_done("b.pdf", "h2", "index", "emb")
+    manifest.close()
+    # another index starts empty
+    assert not IngestionManifest(path, "other").is_done("a.pdf", "h1", "upload")
+
+
+def test_manifest_changed_file_or_embedding_model_is_not_done(tmp_path):
+    manifest = IngestionManifest(str(tmp_path / "manifest.json"), "index")
+    manifest.record("a.pdf", "h1", "index", sections={"s1": "x"}, embedding_model="emb")
+    assert not manifest.is_done("a.pdf", "h2", "index", "emb")
+    assert not manifest.is_done("a.pdf", "h1", "index", "other-emb")
+    assert not manifest.is_done("a.pdf", "h1", "index", None)
+    manifest.record("a.pdf", "h2", "upload")
+    # the sections stay those of the indexed version until the new one is indexed
+    assert manifest.sections("a.pdf") == {"s1": "x"}
+    manifest.close()
+
+
+def test_manifest_partly_indexed_file_is_not_done(tmp_path):
+    manifest = IngestionManifest(str(tmp_path / "manifest.json"), "index")
+    manifest.record("a.pdf", "h1", "index", sections={"s1": "x", "s2": "y"}, embedding_model=None)
+    manifest.record("a.pdf", "h1", None, sections={"s1": "x"}, embedding_model="emb")
+    assert not manifest.is_done("a.pdf", "h1", "index", "emb")
+    assert manifest.sections("a.pdf") == {"s1": "x"}
+    manifest.close()
+
+
+def test_pipeline_stage_skips_failed_files():
+    inbox, outbox = queue.Queue(), queue.Queue()
+
+    def func(document):
+        if document["filename"] == "bad.pdf":
+            raise ValueError("broken")
+        document["done"] = True
+
+    stage = PipelineStage("test", func, 2, inbox, outbox)
+    for filename in ["a.pdf", "bad.pdf", "b.pdf"]:
+        inbox.put({"filename": filename})
+    stage.close()
+    assert stage.processed == 2
+    assert stage.failed == 1
+    passed = [outbox.get_nowait() for _ in range(outbox.qsize())]
+    assert sorted(d["filename"] for d in passed) == ["a.pdf", "b.pdf"]
+    assert all(d["done"] for d in passed)
+
+
+def test_embedding_cache_lookup_deduplicates_and_counts_hits(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "embeddings.sqlite"), "model", "deployment")
+    cache.put_many({"a": [0.5, 1.0]})
+    found, missing = cache.lookup(["a", "b", "b", "a", "c"])
+    assert found == {"a": [0.5, 1.0]}
+    assert missing == ["b", "c"]
+    assert (cache.hits, cache.deduplicated, cache.misses) == (2, 1, 2)
+    # another deployment doesn't share the embeddings
+    other = EmbeddingCache(str(tmp_path / "embeddings.sqlite"), "model", "other-deployment")
+    assert other.lookup(["a"]) == ({}, ["a"])
+    cache.close()
+    other.close()
+
+
+def test_update_embeddings_in_batch_respects_token_and_size_limits(tmp_path, monkeypatch):
+    monkeypatch.setattr(prepdocs, "args", SimpleNamespace(openaimodelname="text-embedding-ada-002", verbose=False), raising=False)
+    monkeypatch.setattr(prepdocs, "embedding_cache", EmbeddingCache(str(tmp_path / "embeddings.sqlite"), "model", "deployment"))
+    monkeypatch.setattr(prepdocs, "calculate_tokens_emb_aoai", lambda text: int(text.split("-")[1]))
+    batches = []
+
+    def compute_embedding_in_batch(texts, token_count):
+        batches.append((list(texts), token_count))
+        return [[float(i)] for i in range(len(texts))]
+
+    monkeypatch.setattr(prepdocs, "compute_embedding_in_batch", compute_embedding_in_batch)
+    prepdocs.embedding_cache.put_many({"cached-1": [9.0]})
+    texts = ["cached-1"] + [f"small{i}-1" for i in range(20)] + ["big0-5000", "big1-5000", "small0-1"]
+    sections = list(prepdocs.update_embeddings_in_batch({"content": text} for text in texts))
+
+    assert [len(texts) for texts, _ in batches] == [16, 5, 1]
+    assert all(token_count <= 8100 for _, token_count in batches)
+    # cached and repeated texts are not sent again
+    assert sum(len(texts) for texts, _ in batches) == 22
+    assert len(sections) == len(texts)
+    assert sections[0]["embedding"] == [9.0]
+    assert sections[-1]["embedding"] == sections[1]["embedding"]
+    prepdocs.embedding_cache.close()
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeRawResponse:
+    def __init__(self, parsed, headers=None):
+        self.parsed = parsed
+        self.headers = headers or {}
+
+    def parse(self):
+        return self.parsed
+
+
+def wait_blocked(thread):
+    thread.join(timeout=0.05)
+    return thread.is_alive()
+
+
+def test_embedding_scheduler_admits_within_token_quota():
+    clock = FakeClock()
+    scheduler = EmbeddingScheduler(tpm=600, rpm=60, max_concurrency=4, clock=clock)
+    scheduler.acquire(600)
+    scheduler.release(tokens=600)
+    # the token bucket is empty: 60 tokens are refilled in 6 seconds
+    thread = threading.Thread(target=scheduler.acquire, args=(60,))
+    thread.start()
+    assert wait_blocked(thread)
+    clock.now = 6.0
+    with scheduler._cond:
+        scheduler._cond.notify_all()
+    thread.join(timeout=1)
+    assert not thread.is_alive()
+    assert scheduler.in_flight == 1
+
+
+def test_embedding_scheduler_lowers_buckets_to_remaining_headers():
+    scheduler = EmbeddingScheduler(tpm=1000, rpm=100, max_concurrency=4, clock=FakeClock())
+    scheduler.acquire(100)
+    scheduler.release(tokens=100, headers={"x-ratelimit-remaining-tokens": "50", "x-ratelimit-remaining-requests": "3"})
+    assert scheduler.tokens == 50
+    assert scheduler.requests == 3
+
+
+def test_embedding_scheduler_aimd_concurrency():
+    clock = FakeClock()
+    scheduler = EmbeddingScheduler(tpm=10**9, rpm=10**9, max_concurrency=3, clock=clock)
+    for expected in [2.0, 2.5, 2.9, 3, 3]:
+        scheduler.acquire(1)
+        scheduler.release(tokens=1)
+        assert round(scheduler.concurrency, 1) == expected
+    scheduler.acquire(1)
+    scheduler.release(retry_after=1)
+    assert scheduler.concurrency == 1.5
+    clock.now = 1.0
+    scheduler.acquire(1)
+    scheduler.release(retry_after=1)
+    assert scheduler.concurrency == 1.0
+
+
+def test_embedding_scheduler_pauses_for_retry_after(monkeypatch):
+    monkeypatch.setattr(prepdocs, "args", SimpleNamespace(verbose=False), raising=False)
+    clock = FakeClock()
+    sleeps = []
+    scheduler = EmbeddingScheduler(tpm=10**6, rpm=10**6, max_concurrency=4, clock=clock, sleep=sleeps.append)
+    request = httpx.Request("POST", "https://example.openai.azure.com/")
+    throttled = RateLimitError("throttled", response=httpx.Response(429, headers={"retry-after-ms": "1500"}, request=request), body=None)
+    responses = iter([throttled, APIConnectionError(request=request), FakeRawResponse("ok")])
+
+    def send():
+        response = next(responses)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    thread = threading.Thread(target=lambda: scheduler.call(10, send))
+    thread.start()
+    # the retry waits for Retry-After, not for a fixed backoff
+    assert wait_blocked(thread)
+    assert scheduler.paused_until == 1.5
+    clock.now = 1.5
+    with scheduler._cond:
+        scheduler._cond.notify_all()
+    thread.join(timeout=1)
+    assert not thread.is_alive()
+    # only the connection error backs off with sleep
+    assert sleeps == [4]
+    assert (scheduler.throttled, scheduler.retried, scheduler.completed) == (1, 2, 1)
+
+
+class FakeVersionBlob:
+    def __init__(self):
+        self.metadata = None
+        self.etag = 0
+        # 읽은 직후 다른 prepdocs 실행이 버전을 올리는 경우를 흉내 낸다.
+        self.concurrent_bumps = 0
+
+    def get_blob_properties(self):
+        if self.metadata is None:
+            raise ResourceNotFoundError("not found")
+        properties = SimpleNamespace(metadata=dict(self.metadata), etag=str(self.etag))
+        if self.concurrent_bumps:
+            self.concurrent_bumps -= 1
+            self.set_blob_metadata({"index_version": str(int(self.metadata["index_version"]) + 1)}, str(self.etag), MatchConditions.IfNotModified)
+        return properties
+
+    def upload_blob(self, data, metadata, overwrite):
+        assert not overwrite and self.metadata is None
+        self.metadata = metadata
+        self.etag += 1
+
+    def set_blob_metadata(self, metadata, etag, match_condition):
+        assert match_condition == MatchConditions.IfNotModified
+        if etag != str(self.etag):
+            raise ResourceModifiedError("precondition failed")
+        self.metadata = metadata
+        self.etag += 1
+
+
+def test_index_version_is_bumped_with_etag_and_retried():
+    blob = FakeVersionBlob()
+    assert prepdocs.bump_index_version(blob) == 1
+    assert prepdocs.bump_index_version(blob) == 2
+    blob.concurrent_bumps = 1
+    # 다른 실행의 변경을 덮어쓰지 않고 다시 읽어서 올린다.
+    assert prepdocs.bump_index_version(blob) == 4
+    assert blob.metadata == {"index_version": "4"}
+
+
+def test_remove_bumps_the_index_version_once(monkeypatch):
+    monkeypatch.setattr(prepdocs, "args", SimpleNamespace(remove=True, verbose=False), raising=False)
+    monkeypatch.setattr(prepdocs.glob, "glob", lambda pattern: ["a.pdf", "b.pdf", "c.pdf"])
+    monkeypatch.setattr(prepdocs, "remove_blobs", lambda filename: None)
+    removed = []
+    monkeypatch.setattr(prepdocs, "remove_from_index", lambda filename, invalidate_cache=True: removed.append((filename, invalidate_cache)))
+    bumps = []
+    monkeypatch.setattr(prepdocs, "invalidate_search_cache", lambda: bumps.append(True))
+    manifest = SimpleNamespace(record=lambda filename, digest, stage: None)
+    prepdocs.read_files("*.pdf", False, False, manifest)
+    assert removed == [("a.pdf", False), ("b.pdf", False), ("c.pdf", False)]
+    assert bumps == [True]
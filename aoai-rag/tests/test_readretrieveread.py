@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+from langchain.schema import AIMessage, ChatGeneration, ChatResult
+from langchain_community.chat_models.openai import ChatOpenAI
+
+from approaches.readretrieveread import ReadRetrieveReadApproach
+from core.searchcache import SearchHit
+
+
+class MockSearchCache:
+    async def search(self, query_text, query_vector, filter, top, use_semantic_ranker, use_semantic_captions):
+        await asyncio.sleep(0.01)
+        return [SearchHit(f"{query_text}.pdf", f"top={top}", ())]
+
+
+@pytest.fixture
+def approach():
+    return ReadRetrieveReadApproach(None, None, "2024-02-01", "https://test.openai.azure.com", lambda: "token", "chat", "embedding", "sourcepage", "content", search_cache=MockSearchCache())
+
+
+@pytest.mark.asyncio
+async def test_agent_is_shared_and_request_state_is_not(approach, monkeypatch):
+    temperatures = []
+
+    async def mock_agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        temperatures.append(kwargs.get("temperature"))
+        question, scratchpad = messages[-1].content.split("Question: ")[-1].split("\n", 1)
+        if "Observation:" in scratchpad:
+            text = f"Thought: done\nFinal Answer: {question}"
+        else:
+            text = f"Thought: search\nAction: PeopleSearchTool\nAction Input: {question}"
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    monkeypatch.setattr(ChatOpenAI, "_agenerate", mock_agenerate)
+    agent_chain = approach.agent_chain
+    results = await asyncio.gather(
+        approach.run("최충헌", {"retrieval_mode": "text", "top": 1, "temperature": 0.1}),
+        approach.run("정중부", {"retrieval_mode": "text", "top": 2}),
+    )
+    assert approach.agent_chain is agent_chain
+    assert results[0]["answer"] == "최충헌"
+    assert results[0]["data_points"] == ["최충헌.pdf:top=1"]
+    assert results[1]["data_points"] == ["정중부.pdf:top=2"]
+    assert "Entering chain" in results[0]["thoughts"] and "Entering chain" in results[1]["thoughts"]
+    assert sorted(temperatures) == [0.1, 0.1, 0.3, 0.3]
+
+
+@pytest.mark.asyncio
+async def test_thoughts_are_only_recorded_when_asked(approach, monkeypatch):
+    async def mock_agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="Thought: done\nFinal Answer: 최충헌"))])
+
+    monkeypatch.setattr(ChatOpenAI, "_agenerate", mock_agenerate)
+    result = await approach.run("최충헌", {"include_thoughts": False})
+    assert result["answer"] == "최충헌"
+    assert result["thoughts"] is None
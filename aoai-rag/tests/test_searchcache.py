@@ -0,0 +1,157 @@
+import asyncio
+
+import pytest
+
+from core.searchcache import SearchCache, SearchHit
+
+
+class Caption:
+    def __init__(self, text):
+        self.text = text
+
+
+class MockSearchClient:
+    def __init__(self):
+        self.calls = []
+
+    async def search(self, **kwargs):
+        self.calls.append(kwargs)
+
+        async def results():
+            yield {"sourcepage": "Benefit_Options-2.pdf", "content": "There is a whistleblower policy.", "@search.captions": [Caption("A whistleblower policy.")]}
+
+        return results()
+
+
+@pytest.mark.asyncio
+async def test_searchcache_projects_and_reuses_results():
+    search_client = MockSearchClient()
+    cache = SearchCache(search_client, "sourcepage", "content")
+    hits = await cache.search("whistleblower", [0.1, 0.2], None, 3, use_semantic_ranker=True, use_semantic_captions=True)
+    assert hits == [SearchHit("Benefit_Options-2.pdf", "There is a whistleblower policy.", ("A whistleblower policy.",))]
+    assert await cache.search("whistleblower", [0.1, 0.2], None, 3, use_semantic_ranker=True, use_semantic_captions=True) == hits
+    assert len(search_client.calls) == 1
+    assert cache.stats() == {"hits": 1, "misses": 1, "entries": 1}
+
+
+@pytest.mark.asyncio
+async def test_searchcache_key():
+    search_client = MockSearchClient()
+    cache = SearchCache(search_client, "sourcepage", "content")
+    await cache.search("whistleblower", [0.1, 0.2], None, 3)
+    await cache.search("whistleblower", [0.1, 0.3], None, 3)
+    await cache.search("whistleblower", [0.1, 0.2], "category ne 'x'", 3)
+    await cache.search("whistleblower", [0.1, 0.2], None, 5)
+    await cache.search("whistleblower", [0.1, 0.2], None, 3, use_semantic_ranker=True)
+    assert len(search_client.calls) == 5
+    assert "query_type" not in search_client.calls[0]
+    assert search_client.calls[-1]["query_type"] == "semantic"
+
+
+@pytest.mark.asyncio
+async def test_searchcache_ttl(monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr("core.searchcache.time.monotonic", lambda: now)
+    search_client = MockSearchClient()
+    cache = SearchCache(search_client, "sourcepage", "content", ttl=10)
+    await cache.search("whistleblower", None, None, 3)
+    now = 1011.0
+    await cache.search("whistleblower", None, None, 3)
+    assert len(search_client.calls) == 2
+
+
+class SlowSearchClient(MockSearchClient):
+    def __init__(self):
+        super().__init__()
+        self.started = asyncio.Event()
+        self.release = asyncio.Event()
+
+    async def search(self, **kwargs):
+        self.started.set()
+        await self.release.wait()
+        return await super().search(**kwargs)
+
+
+@pytest.mark.asyncio
+async def test_searchcache_does_not_store_results_started_before_invalidate():
+    search_client = SlowSearchClient()
+    cache = SearchCache(search_client, "sourcepage", "content")
+    pending = asyncio.ensure_future(cache.search("whistleblower", None, None, 3))
+    await search_client.started.wait()
+    cache.invalidate()
+    search_client.release.set()
+    assert await pending
+    assert cache.stats()["entries"] == 0
+
+
+@pytest.mark.asyncio
+async def test_searchcache_index_version_invalidates():
+    version = "1"
+
+    async def index_version():
+        return version
+
+    search_client = MockSearchClient()
+    cache = SearchCache(search_client, "sourcepage", "content", index_version=index_version)
+    await cache.refresh_index_version()
+    await cache.search("whistleblower", None, None, 3)
+    await cache.search("whistleblower", None, None, 3)
+    assert len(search_client.calls) == 1
+    version = "2"
+    await cache.refresh_index_version()
+    await cache.search("whistleblower", None, None, 3)
+    assert len(search_client.calls) == 2
+
+    cache.invalidate()
+    await cache.search("whistleblower", None, None, 3)
+    assert len(search_client.calls) == 3
+
+
+@pytest.mark.asyncio
+async def test_searchcache_checks_index_version_in_background():
+    checked = asyncio.Event()
+
+    async def index_version():
+        checked.set()
+        return "1"
+
+    cache = SearchCache(MockSearchClient(), "sourcepage", "content", index_version=index_version, version_check_interval=60)
+    await cache.search("whistleblower", None, None, 3)
+    await asyncio.wait_for(checked.wait(), 1)
+
+
+@pytest.mark.asyncio
+async def test_searchcache_checks_index_version_before_serving_a_cached_result():
+    version = "1"
+    invalidated = []
+
+    async def index_version():
+        return version
+
+    search_client = MockSearchClient()
+    cache = SearchCache(search_client, "sourcepage", "content", index_version=index_version, version_check_interval=0, on_invalidate=lambda: invalidated.append(version))
+    await cache.search("whistleblower", None, None, 3)
+    await cache.search("whistleblower", None, None, 3)
+    assert len(search_client.calls) == 1
+    # 확인 간격이 지났으면 캐시된 결과를 돌려주기 전에 버전을 확인하므로 이전 결과를 쓰지 않는다.
+    version = "2"
+    await cache.search("whistleblower", None, None, 3)
+    assert len(search_client.calls) == 2
+    assert invalidated == ["1", "2"]
+
+
+@pytest.mark.asyncio
+async def test_searchcache_polls_index_version_without_searches():
+    version = "1"
+    invalidated = asyncio.Event()
+
+    async def index_version():
+        return version
+
+    cache = SearchCache(MockSearchClient(), "sourcepage", "content", index_version=index_version, version_check_interval=0.02)
+    cache.start()
+    await asyncio.sleep(0.05)
+    cache.on_invalidate = invalidated.set
+    version = "2"
+    await asyncio.wait_for(invalidated.wait(), 1)
+    await cache.close()
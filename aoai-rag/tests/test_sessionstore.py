@@ -0,0 +1,160 @@
+import copy
+
+import pytest
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError,
+)
+
+from core.messagebuilder import trim_history
+from core.sessionstore import (
+    CosmosSessionBackend,
+    InMemorySessionBackend,
+    SessionHistoryRequiredError,
+    SessionStore,
+    UnknownSessionError,
+)
+
+
+def count_chars(messages):
+    return [len(message["content"]) for message in messages]
+
+
+@pytest.mark.asyncio
+async def test_session_turns_are_stored_with_token_counts():
+    store = SessionStore(InMemorySessionBackend(), count_chars)
+    assert await store.history("s1", [{"user": "aaaa"}]) == [{"user": "aaaa"}]
+    await store.append("s1", "aaaa", "bbbbbb")
+    assert await store.history("s1", [{"user": "aaaa", "bot": "bbbbbb"}, {"user": "cc"}]) == [
+        {"user": "aaaa", "bot": "bbbbbb", "user_tokens": 4, "bot_tokens": 6},
+        {"user": "cc"},
+    ]
+    assert store.stats() == {"sessions": 1, "turns": 1, "evictions": 0, "reused": 1, "mismatched": 0}
+
+
+@pytest.mark.asyncio
+async def test_session_is_used_only_when_it_matches_the_sent_history():
+    store = SessionStore(InMemorySessionBackend(), count_chars)
+    await store.append("s1", "q2", "a2")
+    # 첫 턴을 다른 워커가 처리했으면 저장된 턴 대신 보낸 대화를 사용하고 세션을 그 대화로 다시 저장한다.
+    sent = [{"user": "q1", "bot": "a1"}, {"user": "q2", "bot": "a2"}, {"user": "q3"}]
+    assert await store.history("s1", sent) == sent
+    assert store.stats()["mismatched"] == 1
+    assert await store.backend.get("s1") == [
+        {"user": "q1", "bot": "a1", "user_tokens": 2, "bot_tokens": 2},
+        {"user": "q2", "bot": "a2", "user_tokens": 2, "bot_tokens": 2},
+    ]
+    # 세션이 워커마다 따로 보관되면 history 없이 보낸 요청은 대화를 잃지 않도록 오류로 알린다.
+    with pytest.raises(SessionHistoryRequiredError):
+        await store.history("s1", None, "q")
+
+
+@pytest.mark.asyncio
+async def test_sessions_are_bounded():
+    backend = InMemorySessionBackend(max_sessions=2)
+    store = SessionStore(backend, count_chars, max_turns=2)
+    for i in range(3):
+        await store.append("s1", f"q{i}", f"a{i}")
+    assert [turn["user"] for turn in await backend.get("s1")] == ["q1", "q2"]
+    await store.append("s2", "q", "a")
+    await store.append("s3", "q", "a")
+    # 가장 오래 사용하지 않은 세션부터 버린다.
+    assert await backend.get("s1") is None
+    assert backend.stats()["evictions"] == 1
+
+    expired = InMemorySessionBackend(ttl=0)
+    await expired.append("s1", {"user": "q", "bot": "a"}, 10)
+    assert await expired.get("s1") is None
+
+
+def test_trim_history_uses_stored_token_counts(monkeypatch):
+    counted = []
+
+    def fake_token_counts(messages, model, cache=None):
+        counted.extend(message["content"] for message in messages)
+        return count_chars(messages)
+
+    monkeypatch.setattr("core.messagebuilder.num_tokens_from_messages_batch", fake_token_counts)
+    history = [{"user": "aaaa", "bot": "bbbb", "user_tokens": 1, "bot_tokens": 1}, {"user": "cc", "bot": "dd"}]
+    messages, token_count = trim_history(history, "gpt-35-turbo", 100)
+    assert len(messages) == 4 and token_count == 6
+    assert counted == ["cc", "dd"]
+
+
+class FakeSessionContainer:
+    def __init__(self):
+        self.items = {}
+        self.versions = 0
+        # 읽은 직후 다른 요청이 세션을 바꾸는 경우를 흉내 낸다.
+        self.on_read = None
+
+    def _stored(self, body):
+        self.versions += 1
+        self.items[body["id"]] = {**copy.deepcopy(body), "_etag": str(self.versions)}
+
+    async def read_item(self, item, partition_key):
+        assert item == partition_key
+        if item not in self.items:
+            raise CosmosResourceNotFoundError(message="not found")
+        read = copy.deepcopy(self.items[item])
+        if self.on_read:
+            on_read, self.on_read = self.on_read, None
+            on_read()
+        return read
+
+    async def create_item(self, body):
+        if body["id"] in self.items:
+            raise CosmosResourceExistsError(message="conflict")
+        self._stored(body)
+
+    async def replace_item(self, item, body, etag, match_condition):
+        assert match_condition == MatchConditions.IfNotModified
+        if self.items[item]["_etag"] != etag:
+            raise CosmosAccessConditionFailedError(message="precondition failed")
+        self._stored(body)
+
+    async def upsert_item(self, body):
+        self._stored(body)
+
+    async def delete_item(self, item, partition_key):
+        if self.items.pop(item, None) is None:
+            raise CosmosResourceNotFoundError(message="not found")
+
+
+@pytest.mark.asyncio
+async def test_cosmos_backend_continues_the_session_without_history():
+    container = FakeSessionContainer()
+    store = SessionStore(CosmosSessionBackend(container, ttl=600), count_chars, max_turns=2)
+    # 세션이 없으면 클라이언트가 history를 다시 보내도록 알린다.
+    with pytest.raises(UnknownSessionError) as e:
+        await store.history("s1", None, "q1")
+    assert e.value.code == "unknown_session"
+    await store.history("s1", [{"user": "q1"}])
+    await store.append("s1", "q1", "a1")
+    # 다른 워커도 같은 컨테이너를 보므로 새 메시지만으로 대화를 이어간다.
+    other_worker = SessionStore(CosmosSessionBackend(container, ttl=600), count_chars, max_turns=2)
+    assert await other_worker.history("s1", None, "q2") == [
+        {"user": "q1", "bot": "a1", "user_tokens": 2, "bot_tokens": 2},
+        {"user": "q2"},
+    ]
+    await other_worker.append("s1", "q2", "a2")
+    await store.append("s1", "q3", "a3")
+    assert [turn["user"] for turn in container.items["s1"]["turns"]] == ["q2", "q3"]
+    assert container.items["s1"]["ttl"] == 600
+    await store.delete("s1")
+    await store.delete("s1")
+    assert "s1" not in container.items
+
+
+@pytest.mark.asyncio
+async def test_cosmos_backend_retries_concurrent_appends():
+    container = FakeSessionContainer()
+    backend = CosmosSessionBackend(container)
+    await backend.append("s1", {"user": "q1", "bot": "a1"}, 10)
+    container.on_read = lambda: container._stored({"id": "s1", "turns": container.items["s1"]["turns"] + [{"user": "q2", "bot": "a2"}]})
+    await backend.append("s1", {"user": "q3", "bot": "a3"}, 10)
+    # 먼저 저장된 턴을 잃지 않고 다시 읽어서 붙인다.
+    assert [turn["user"] for turn in await backend.get("s1")] == ["q1", "q2", "q3"]
+    assert backend.stats()["conflicts"] == 1
@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+
+from approaches.coalescing import CoalescingChatApproach
+from core.singleflight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_run_coalesces_concurrent_calls():
+    singleflight = SingleFlight()
+    calls = 0
+
+    async def answer():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return {"answer": "42"}
+
+    results = await asyncio.gather(*(singleflight.run("q", answer) for _ in range(5)))
+    assert results == [{"answer": "42"}] * 5
+    assert calls == 1
+    assert singleflight.stats() == {"executions": 1, "coalesced": 4, "in_flight": 0}
+
+    # 끝난 실행은 기억하지 않는다.
+    await singleflight.run("q", answer)
+    assert calls == 2
+
+
+@pytest.mark.asyncio
+async def test_run_shares_errors():
+    singleflight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream error")
+
+    results = await asyncio.gather(singleflight.run("q", fail), singleflight.run("q", fail), return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results)
+
+
+@pytest.mark.asyncio
+async def test_stream_late_joiner_gets_prefix_then_live_events():
+    singleflight = SingleFlight()
+    release = asyncio.Event()
+    calls = 0
+
+    async def stream():
+        nonlocal calls
+        calls += 1
+        yield {"delta": "a"}
+        yield {"delta": "b"}
+        await release.wait()
+        yield {"delta": "c"}
+
+    first = singleflight.stream("q", stream)
+    assert await first.__anext__() == {"delta": "a"}
+    assert await first.__anext__() == {"delta": "b"}
+
+    async def collect():
+        return [event async for event in singleflight.stream("q", stream)]
+
+    late = asyncio.create_task(collect())
+    await asyncio.sleep(0)
+    release.set()
+    assert [event async for event in first] == [{"delta": "c"}]
+    assert await late == [{"delta": "a"}, {"delta": "b"}, {"delta": "c"}]
+    assert calls == 1
+
+
+@pytest.mark.asyncio
+async def test_execution_is_cancelled_when_every_caller_leaves():
+    singleflight = SingleFlight()
+    cancelled = asyncio.Event()
+
+    async def stream():
+        try:
+            yield {"delta": "a"}
+            await asyncio.sleep(10)
+        finally:
+            cancelled.set()
+
+    r = singleflight.stream("q", stream)
+    await r.__anext__()
+    await r.aclose()
+    await asyncio.wait_for(cancelled.wait(), 1)
+    assert singleflight.stats()["in_flight"] == 0
+
+
+def test_chat_key_uses_normalized_question_and_history_tail():
+    approach = CoalescingChatApproach(None, "rrr", SingleFlight(), history_turns=1)
+    history = [{"user": "first", "bot": "1"}, {"user": "second", "bot": "2"}, {"user": "Where is  the cafe?"}]
+    other_start = [{"user": "other", "bot": "0"}, {"user": "second", "bot": "2"}, {"user": "where is the cafe? "}]
+    assert approach.key("run_with_streaming", history, {}) == approach.key("run_with_streaming", other_start, {})
+    assert approach.key("run_with_streaming", history, {}) != approach.key("run_with_streaming", history, {"top": 5})
+    assert approach.key("run_with_streaming", history, {}) != approach.key("run_with_lean_streaming", history, {})
@@ -0,0 +1,49 @@
+import asyncio
+import json
+
+import pytest
+
+from core.streaming import encode_event, format_as_lean_ndjson
+
+
+async def lean_events(deltas, delay=0):
+    yield {"data_points": ["info1.pdf: 최충헌"], "thoughts": ""}
+    for delta in deltas:
+        if delay:
+            await asyncio.sleep(delay)
+        yield {"delta": delta}
+    yield {"done": True, "finish_reason": "stop"}
+
+
+async def collect(r):
+    return [json.loads(line) async for line in r]
+
+
+def test_encode_event():
+    assert encode_event({"delta": '최충헌 "장군"'}) == '{"delta":"최충헌 \\"장군\\""}\n'
+    assert encode_event({"done": True, "finish_reason": "stop"}) == '{"done":true,"finish_reason":"stop"}\n'
+
+
+@pytest.mark.asyncio
+async def test_lean_ndjson_without_coalescing():
+    events = await collect(format_as_lean_ndjson(lean_events(["최", "충", "헌"])))
+    assert [event.get("delta") for event in events[1:-1]] == ["최", "충", "헌"]
+    assert events[0]["data_points"] == ["info1.pdf: 최충헌"]
+    assert events[-1] == {"done": True, "finish_reason": "stop"}
+
+
+@pytest.mark.asyncio
+async def test_lean_ndjson_coalesces_by_bytes():
+    events = await collect(format_as_lean_ndjson(lean_events(["ab", "cd", "ef", "g"]), coalesce_bytes=4))
+    assert [event.get("delta") for event in events[1:-1]] == ["abcd", "efg"]
+    assert events[-1]["done"]
+
+
+@pytest.mark.asyncio
+async def test_lean_ndjson_coalesces_by_time():
+    # 조각이 20ms 간격으로 오면 50ms 창마다 여러 조각이 합쳐지고, 내용과 순서는 유지된다.
+    events = await collect(format_as_lean_ndjson(lean_events(list("abcdefgh"), delay=0.02), coalesce_ms=50))
+    deltas = [event["delta"] for event in events[1:-1]]
+    assert "".join(deltas) == "abcdefgh"
+    assert 1 < len(deltas) < 8
+    assert events[-1]["done"]